@@ -4,11 +4,13 @@ import re
 
 import json
 
-import time
+import math
+
+import tempfile
 
-import requests
+import time
 
-import base64
+import uuid
 
 try:
 
@@ -26,6 +28,8 @@ from functools import wraps
 
 from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
 
+import click
+
 from flask_login import login_user, logout_user, login_required, current_user
 
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -38,50 +42,28 @@ load_dotenv()
 
 
 
-from extensions import db, login_manager
-
-
-
-BASE_DIR = os.path.abspath(os.path.dirname(__file__))
-
-
-
-# Configure timezone (Kenya - EAT)
-
-try:
-
-    # Use Kenya timezone (EAT = UTC+3)
+import database
 
-    if ZoneInfo is not None:
+from replica import use_replica
 
-        local_tz = ZoneInfo('Africa/Nairobi')
+from extensions import db, login_manager, cache, payment_store, daraja, mpesa_tokens, job_queue, callback_processor, reservation_sweeper, order_numbers, dashboard_stats, sales_rollup, replica_router
 
-    else:
 
-        raise RuntimeError('ZoneInfo unavailable')
 
-    current_time = datetime.now(local_tz)
-
-    print(f"Timezone set to: {local_tz}")
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 
-    print(f"Current Kenya time: {current_time.strftime('%Y-%m-%d %I:%M %p')}")
 
-    print(f"UTC time for reference: {datetime.now(timezone.utc).strftime('%Y-%m-%d %I:%M %p')}")
 
-except Exception as e:
+# Kenya time (EAT), or a fixed UTC+3 offset where the tz database is unavailable
 
-    # Fallback to manual timezone if timezone support fails
+try:
 
-    print(f"Timezone error: {e}, using manual EAT timezone")
+    local_tz = ZoneInfo('Africa/Nairobi')
 
-    # Kenya is UTC+3, so use a fixed UTC+3 offset
+except Exception:
 
     local_tz = timezone(timedelta(hours=3))
 
-    current_time = datetime.now(local_tz)
-
-    print(f"Manual timezone time: {current_time.strftime('%Y-%m-%d %I:%M %p')}")
-
 
 
 def get_local_time():
@@ -180,22 +162,82 @@ def create_app():
 
     # Database configuration
 
-    db_path = os.path.join(BASE_DIR, "shifaa.db")
+    # DATABASE_URL (e.g. PostgreSQL on Render) or the local SQLite file
+
+    app.config["SQLALCHEMY_DATABASE_URI"] = database.database_uri(
 
-    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{db_path}"
+        os.getenv("DATABASE_URL"), os.path.join(BASE_DIR, "shifaa.db")
+
+    )
 
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
-    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    # Pool class and settings follow the backend (see database.py). Request threads, STK Push
+
+    # job threads and the background threads may all hold a connection at once
+
+    db_threads = database.thread_count() + int(os.getenv("JOB_QUEUE_WORKERS", 4)) + database.BACKGROUND_THREADS
+
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = database.engine_options(
+
+        app.config["SQLALCHEMY_DATABASE_URI"],
+
+        pool_size=int(os.getenv("DB_POOL_SIZE", 0)) or None,
+
+        workers=database.worker_count(),
+
+        threads=db_threads,
+
+        max_connections=int(os.getenv("DB_MAX_CONNECTIONS", 100)),
+
+        statement_timeout=int(os.getenv("DB_STATEMENT_TIMEOUT", 30000)),
+
+    )
+
+    shortfall = database.pool_shortfall(app.config["SQLALCHEMY_ENGINE_OPTIONS"], db_threads)
 
-        "pool_size": 10,
+    if shortfall:
 
-        "pool_recycle": 3600,
+        app.logger.warning(
 
-        "pool_pre_ping": True,
+            "The database pool of each of %d workers is %d connections short of its %d threads; they will wait "
+
+            "up to pool_timeout for one. Raise DB_MAX_CONNECTIONS or DB_POOL_SIZE, or lower WEB_CONCURRENCY, "
+
+            "GUNICORN_THREADS or JOB_QUEUE_WORKERS.", database.worker_count(), shortfall, db_threads
+
+        )
+
+    # Applied to every SQLite connection: WAL so readers never block the writer, and a busy timeout for writers
+
+    app.config["SQLITE_PRAGMAS"] = {
+
+        "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+
+        "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT", 5000)),
 
     }
 
+    # Optional read replica for catalog and reporting views (see replica.py); a second SQLite file works locally
+
+    replica_url = os.getenv("DATABASE_REPLICA_URL")
+
+    if replica_url:
+
+        replica_uri = database.database_uri(replica_url, None)
+
+        app.config["SQLALCHEMY_BINDS"] = {
+
+            "replica": {
+                "url": replica_uri,
+                **database.engine_options(replica_uri, workers=database.worker_count(), threads=database.thread_count()),
+            },
+
+        }
+
+    app.config["REPLICA_STICKY_SECONDS"] = int(os.getenv("REPLICA_STICKY_SECONDS", 10))
+
+
     
 
     # Business configuration
@@ -206,6 +248,66 @@ def create_app():
 
     app.config["MPESA_TILL_NUMBER"] = "622255"
 
+
+
+    # M-Pesa API configuration
+
+    app.config["MPESA_BASE_URL"] = os.getenv("MPESA_BASE_URL", "https://sandbox.safaricom.co.ke")
+
+    app.config["MPESA_CONSUMER_KEY"] = os.getenv("MPESA_CONSUMER_KEY", CONSUMER_KEY)
+
+    app.config["MPESA_CONSUMER_SECRET"] = os.getenv("MPESA_CONSUMER_SECRET", CONSUMER_SECRET)
+
+    app.config["MPESA_SHORTCODE"] = os.getenv("MPESA_SHORTCODE", SHORTCODE)
+
+    app.config["MPESA_PASSKEY"] = os.getenv("MPESA_PASSKEY", PASSKEY)
+
+    app.config["MPESA_TOKEN_REFRESH_MARGIN"] = int(os.getenv("MPESA_TOKEN_REFRESH_MARGIN", 300))
+
+    app.config["MPESA_POOL_SIZE"] = int(os.getenv("MPESA_POOL_SIZE", 10))
+
+    app.config["MPESA_CONNECT_TIMEOUT"] = float(os.getenv("MPESA_CONNECT_TIMEOUT", 5))
+
+    app.config["MPESA_READ_TIMEOUT"] = float(os.getenv("MPESA_READ_TIMEOUT", 30))
+
+    app.config["MPESA_MAX_RETRIES"] = int(os.getenv("MPESA_MAX_RETRIES", 2))
+
+    # Answer Daraja calls from the local simulator in daraja_sim.py instead of Safaricom
+
+    app.config["MPESA_SIMULATOR"] = os.getenv("MPESA_SIMULATOR", "False").lower() == "true"
+
+    app.config["DARAJA_SIM_LATENCY_MS"] = float(os.getenv("DARAJA_SIM_LATENCY_MS", 150))
+
+    app.config["DARAJA_SIM_LATENCY_SIGMA"] = float(os.getenv("DARAJA_SIM_LATENCY_SIGMA", 0.5))
+
+    app.config["DARAJA_SIM_ERROR_RATE"] = float(os.getenv("DARAJA_SIM_ERROR_RATE", 0))
+
+    app.config["DARAJA_SIM_DECLINE_RATE"] = float(os.getenv("DARAJA_SIM_DECLINE_RATE", 0.1))
+
+    app.config["DARAJA_SIM_CALLBACK_DELAY"] = float(os.getenv("DARAJA_SIM_CALLBACK_DELAY", 3))
+
+    app.config["DARAJA_SIM_CALLBACK_DROP_RATE"] = float(os.getenv("DARAJA_SIM_CALLBACK_DROP_RATE", 0))
+
+    app.config["DARAJA_SIM_CALLBACK_MODE"] = os.getenv("DARAJA_SIM_CALLBACK_MODE", "inprocess")
+
+
+
+    # Background queue used to send STK Push requests
+
+    app.config["JOB_QUEUE_WORKERS"] = int(os.getenv("JOB_QUEUE_WORKERS", 4))
+
+    app.config["JOB_QUEUE_MAX_PENDING"] = int(os.getenv("JOB_QUEUE_MAX_PENDING", 50))
+
+    app.config["JOB_TIMEOUT"] = float(os.getenv("JOB_TIMEOUT", 45))
+
+
+
+    # M-Pesa callbacks are journalled, then applied to orders in batches
+
+    app.config["CALLBACK_BATCH_SIZE"] = int(os.getenv("CALLBACK_BATCH_SIZE", 100))
+
+    app.config["CALLBACK_PROCESS_INTERVAL"] = float(os.getenv("CALLBACK_PROCESS_INTERVAL", 5))
+
     
 
     # Security settings
@@ -218,6 +320,50 @@ def create_app():
 
     
 
+    # Checkout holds cart stock for this many seconds while the shopper pays
+
+    app.config["RESERVATION_TTL"] = int(os.getenv("RESERVATION_TTL", 900))
+
+    app.config["RESERVATION_SWEEP_INTERVAL"] = float(os.getenv("RESERVATION_SWEEP_INTERVAL", 60))
+
+    
+
+    # Order number node id; leased from the database per process when unset, for ORDER_NODE_LEASE_TTL
+
+    # seconds at a time and renewed while the process numbers orders
+
+    app.config["ORDER_NODE_ID"] = os.getenv("ORDER_NODE_ID")
+
+    app.config["ORDER_NODE_LEASE_TTL"] = int(os.getenv("ORDER_NODE_LEASE_TTL", 60))
+
+    
+
+    # Cache backend (Flask-Caching). Cart and dashboard invalidations must reach every worker, so with more
+
+    # than one the default is a FileSystemCache shared by the workers on this machine; use RedisCache when
+
+    # several machines serve the app
+
+    app.config["CACHE_TYPE"] = os.getenv("CACHE_TYPE") or (
+
+        "SimpleCache" if database.worker_count() == 1 else "FileSystemCache"
+
+    )
+
+    app.config["CACHE_DIR"] = os.getenv("CACHE_DIR") or os.path.join(tempfile.gettempdir(), "shifaa-cache")
+
+    app.config["CACHE_REDIS_URL"] = os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/1")
+
+    app.config["CACHE_DEFAULT_TIMEOUT"] = int(os.getenv("CACHE_DEFAULT_TIMEOUT", 300))
+
+    # Per-process caches cannot see other workers' invalidations, so keep this short with SimpleCache
+
+    app.config["CART_SUMMARY_TTL"] = int(os.getenv("CART_SUMMARY_TTL", 60))
+
+    app.config["DASHBOARD_STATS_TTL"] = int(os.getenv("DASHBOARD_STATS_TTL", 30))
+
+    
+
     # Pagination settings
 
     app.config["PRODUCTS_PER_PAGE"] = 12
@@ -228,71 +374,109 @@ def create_app():
 
 
 
+    # Payment status store shared by all workers ("database", "redis" or "memory")
+
+    app.config["PAYMENT_STORE"] = os.getenv("PAYMENT_STORE", "database")
+
+    app.config["PAYMENT_STORE_URL"] = os.getenv("PAYMENT_STORE_URL", "redis://localhost:6379/0")
+
+    app.config["PAYMENT_STATUS_TTL"] = int(os.getenv("PAYMENT_STATUS_TTL", 3600))
+
+    # Longest time /wait-payment-status holds a request; keep below the gunicorn timeout. A sync
+
+    # worker serves one request at a time, so there it answers at once and the page polls instead
+
+    app.config["PAYMENT_WAIT_TIMEOUT"] = (
+
+        0.0 if database.worker_class() == "sync" else float(os.getenv("PAYMENT_WAIT_TIMEOUT", 20))
+
+    )
+
+    app.config["PAYMENT_WAIT_INTERVAL"] = float(os.getenv("PAYMENT_WAIT_INTERVAL", 0.5))
+
+    # Compiled templates are kept on disk, so a new or recycled worker loads them instead of recompiling
+
+    # them on its first requests (Jinja's own per-user temp directory when unset)
+
+    app.config["TEMPLATE_CACHE_DIR"] = os.getenv("TEMPLATE_CACHE_DIR")
+
+
+
     db.init_app(app)
 
-    login_manager.init_app(app)
+    database.init_app(app)
 
-    login_manager.login_view = "login"
+    cache.init_app(app)
 
-    login_manager.login_message = "Please log in to access this page."
+    if app.config["CACHE_TYPE"] in ("SimpleCache", "simple") and database.worker_count() > 1:
 
-    login_manager.login_message_category = "warning"
+        app.logger.warning(
 
+            "CACHE_TYPE=SimpleCache is per process: with %d workers a cart write clears the badge only in the "
 
+            "worker that handled it. Use FileSystemCache or RedisCache.", database.worker_count()
 
-    from models import User
+        )
 
+    payment_store.init_app(app)
 
+    daraja.init_app(app)
 
-    @login_manager.user_loader
+    mpesa_tokens.init_app(app)
 
-    def load_user(user_id):
+    job_queue.init_app(app)
 
-        return db.session.get(User, int(user_id))
+    callback_processor.init_app(app)
 
+    reservation_sweeper.init_app(app)
 
+    order_numbers.init_app(app)
 
-    # ========== M-PESA HELPER FUNCTIONS ==========
+    dashboard_stats.init_app(app)
 
-    def get_access_token():
+    sales_rollup.init_app(app)
+
+    replica_router.init_app(app)
 
-        """Get OAuth access token from Safaricom"""
+    login_manager.init_app(app)
 
-        url = "https://sandbox.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials"
+    login_manager.login_view = "login"
 
-        try:
+    login_manager.login_message = "Please log in to access this page."
 
-            print("Fetching access token...")
+    login_manager.login_message_category = "warning"
 
-            response = requests.get(
+    from jinja2 import FileSystemBytecodeCache
 
-                url, 
+    if app.config["TEMPLATE_CACHE_DIR"]:
 
-                auth=(CONSUMER_KEY, CONSUMER_SECRET),
+        os.makedirs(app.config["TEMPLATE_CACHE_DIR"], exist_ok=True)
 
-                timeout=30,
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config["TEMPLATE_CACHE_DIR"])
 
-                verify=True
 
-            )
 
-            print(f"Token response status: {response.status_code}")
+    from models import User
 
-            
 
-            if response.status_code == 200:
 
-                token_data = response.json()
+    @login_manager.user_loader
 
-                print("Access token obtained successfully")
+    def load_user(user_id):
 
-                return token_data['access_token']
+        return db.session.get(User, int(user_id))
 
-            else:
 
-                print(f"Failed to get token: {response.text}")
 
-                return None
+    # ========== M-PESA HELPER FUNCTIONS ==========
+
+    def get_access_token():
+
+        """Get OAuth access token from Safaricom (cached until shortly before expiry)"""
+
+        try:
+
+            return mpesa_tokens.get_token()
 
         except Exception as e:
 
@@ -302,17 +486,27 @@ def create_app():
 
 
 
-    # Store payment statuses
+    def checkout_totals(cart_items, checkout_info):
+
+        """(shipping_cost, grand_total) for the shopper's cart, recomputed in case it changed since checkout"""
 
-    payments = {}
+        shipping_cost = float(cart_items.shipping_cost(checkout_info.get("delivery_option", "standard")))
+
+        return shipping_cost, float(cart_items.total) + shipping_cost
 
 
 
     @app.route('/initiate-stk-push', methods=['POST'])
 
+    @login_required
+
     def initiate_stk_push():
 
-        """Initiate STK Push to customer's phone"""
+        """Queue an STK Push for the shopper's order total and return its job id"""
+
+        from mpesa import JOB_ID_PREFIX, send_stk_push, expire_stk_push
+
+        from cart import load_cart
 
         try:
 
@@ -324,20 +518,38 @@ def create_app():
 
             phone = data.get('phone_number')
 
-            amount = data.get('amount')
+            
+
+            if not phone:
+
+                return jsonify({
+
+                    'success': False,
+
+                    'message': 'Phone number is required'
+
+                }), 400
 
             
 
-            if not phone or not amount:
+            # The amount comes from the server-side cart, never from the browser
+
+            cart_items = load_cart(current_user.id)
+
+            if "checkout_info" not in session or not cart_items:
 
                 return jsonify({
 
                     'success': False,
 
-                    'message': 'Phone number and amount are required'
+                    'message': 'Please complete the checkout process first.'
 
                 }), 400
 
+            _, grand_total = checkout_totals(cart_items, session["checkout_info"])
+
+            amount = math.ceil(grand_total)
+
             
 
             # Format phone number
@@ -366,51 +578,19 @@ def create_app():
 
             
 
-            # Get access token
-
-            access_token = get_access_token()
-
-            if not access_token:
-
-                return jsonify({
-
-                    'success': False,
-
-                    'message': 'Failed to authenticate with M-Pesa. Please try again.'
-
-                }), 500
-
-            
-
             # Generate timestamp and password
 
-            timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-
-            password_str = f"{SHORTCODE}{PASSKEY}{timestamp}"
+            shortcode = app.config["MPESA_SHORTCODE"]
 
-            password = base64.b64encode(password_str.encode()).decode('utf-8')
-
-            
+            password, timestamp = daraja.stk_password()
 
             # Prepare STK Push request for TILL NUMBER (Buy Goods)
 
-            url = "https://sandbox.safaricom.co.ke/mpesa/stkpush/v1/processrequest"
-
-            headers = {
-
-                "Authorization": f"Bearer {access_token}",
-
-                "Content-Type": "application/json"
-
-            }
-
-            
-
             # CORRECTED: For Till Number, use CustomerBuyGoodsOnline
 
             payload = {
 
-                "BusinessShortCode": SHORTCODE,
+                "BusinessShortCode": shortcode,
 
                 "Password": password,
 
@@ -422,7 +602,7 @@ def create_app():
 
                 "PartyA": phone,
 
-                "PartyB": SHORTCODE,
+                "PartyB": shortcode,
 
                 "PhoneNumber": phone,
 
@@ -436,81 +616,69 @@ def create_app():
 
             
 
-            print(f"Sending STK Push payload: {payload}")
-
-            
-
-            # Make request to Safaricom
-
-            response = requests.post(url, json=payload, headers=headers, timeout=30)
+            # The push is sent by a background job; the job id is polled like a CheckoutRequestID
 
-            response_data = response.json()
+            job_id = f"{JOB_ID_PREFIX}{uuid.uuid4().hex}"
 
-            
-
-            print(f"STK Push Response: {response_data}")
+            payment_store.set(job_id, "pending", owner=current_user.id, amount=amount)
 
-            
+            if not job_queue.submit(send_stk_push, job_id, payload, on_timeout=expire_stk_push):
 
-            # Check for successful response
+                payment_store.set(job_id, "failed")
 
-            if response_data.get("ResponseCode") == "0":
+                response = jsonify({
 
-                checkout_id = response_data.get("CheckoutRequestID")
+                    'success': False,
 
-                payments[checkout_id] = "pending"
+                    'message': 'M-Pesa is busy right now. Please try again in a moment.'
 
-                
+                })
 
-                return jsonify({
+                response.headers['Retry-After'] = '5'
 
-                    'success': True,
+                return response, 503
 
-                    'checkout_request_id': checkout_id,
+            return jsonify({
 
-                    'message': 'STK Push sent successfully. Check your phone for the prompt.'
+                'success': True,
 
-                })
+                'checkout_request_id': job_id,
 
-            else:
+                'message': 'STK Push sent successfully. Check your phone for the prompt.'
 
-                error_msg = response_data.get("errorMessage", response_data.get("ResponseDescription", "STK Push failed"))
+            })
 
                 
 
-                # Provide user-friendly error messages
-
-                if "Invalid TransactionType" in error_msg:
+        except Exception as e:
 
-                    error_msg = "Your till number may not support STK Push. Please use the manual payment method below."
+            print(f"STK Push error: {e}")
 
-                elif "Invalid Access Token" in error_msg:
+            return jsonify({
 
-                    error_msg = "Authentication failed. Please try again."
+                'success': False,
 
-                    
+                'message': 'An error occurred. Please use manual payment method.'
 
-                return jsonify({
+            }), 500
 
-                    'success': False,
 
-                    'message': error_msg
 
-                }), 400
+    def payment_status_response(checkout_id, status):
 
-                
+        """Status poll body; failed payments carry the reason to show the shopper"""
 
-        except Exception as e:
+        body = {'status': status}
 
-            print(f"STK Push error: {e}")
+        if status == 'failed':
 
-            return jsonify({
+            message = payment_store.message(checkout_id)
 
-                'success': False,
+            if message:
 
-                'message': 'An error occurred. Please use manual payment method.'
+                body['message'] = message
 
-            }), 500
+        return body
 
 
 
@@ -534,9 +702,9 @@ def create_app():
 
             
 
-            status = payments.get(checkout_id, "pending")
+            status = payment_store.get(checkout_id)
 
-            return jsonify({'status': status})
+            return jsonify(payment_status_response(checkout_id, status))
 
             
 
@@ -546,75 +714,93 @@ def create_app():
 
             return jsonify({'status': 'unknown'}), 500
 
+    @app.route('/wait-payment-status', methods=['POST'])
 
+    def wait_payment_status():
 
-    @app.route('/callback', methods=['POST'])
-
-    def mpesa_callback():
-
-        """Handle M-Pesa callback after payment"""
+        """Long-poll: hold the request until the payment completes or fails"""
 
         try:
 
             data = request.get_json()
 
-            print(f"Callback received: {data}")
+            checkout_id = data.get('checkout_request_id')
 
-            
+            if not checkout_id:
 
-            stk_callback = data.get('Body', {}).get('stkCallback', {})
+                return jsonify({'status': 'unknown'}), 400
 
-            checkout_id = stk_callback.get('CheckoutRequestID')
+            max_wait = app.config["PAYMENT_WAIT_TIMEOUT"]
 
-            result_code = stk_callback.get('ResultCode')
+            try:
 
-            result_desc = stk_callback.get('ResultDesc')
+                wait = min(float(data.get('timeout', max_wait)), max_wait)
 
-            
+            except (TypeError, ValueError):
 
-            if result_code == 0:
+                wait = max_wait
 
-                payments[checkout_id] = "completed"
+            status = payment_store.wait(checkout_id, max(wait, 0))
 
-                print(f"Payment completed for {checkout_id}")
+            return jsonify(payment_status_response(checkout_id, status))
 
-                
+        except Exception as e:
 
-                # Extract payment details
+            print(f"Wait status error: {e}")
 
-                callback_metadata = stk_callback.get('CallbackMetadata', {})
+            return jsonify({'status': 'unknown'}), 500
 
-                if callback_metadata:
 
-                    items = callback_metadata.get('Item', [])
 
-                    for item in items:
+    @app.route('/callback', methods=['POST'])
 
-                        if item.get('Name') == 'Amount':
+    def mpesa_callback():
 
-                            print(f"Amount paid: {item.get('Value')}")
+        """Journal the M-Pesa callback; orders are updated by the callback processor"""
 
-                        elif item.get('Name') == 'MpesaReceiptNumber':
+        from callbacks import parse_callback, record_callback
 
-                            print(f"Receipt number: {item.get('Value')}")
+        try:
 
-            else:
+            data = request.get_json()
 
-                payments[checkout_id] = "failed"
+            print(f"Callback received: {data}")
 
-                print(f"Payment failed for {checkout_id}: {result_desc}")
+            values = parse_callback(data)
 
-            
+            checkout_id = values["checkout_request_id"]
 
-            return jsonify({
+            # The journal row is written before we acknowledge, so Safaricom retries if this fails
 
-                "ResultCode": 0,
+            if record_callback(values):
 
-                "ResultDesc": "Success"
+                if values["result_code"] == 0:
 
-            })
+                    payment_store.set(checkout_id, "completed")
 
-            
+                    print(f"Payment completed for {checkout_id}: {values['amount']} (receipt {values['receipt_number']})")
+
+                else:
+
+                    payment_store.set(checkout_id, "failed")
+
+                    print(f"Payment failed for {checkout_id}: {values['result_desc']}")
+
+                callback_processor.wake()
+
+            else:
+
+                print(f"Duplicate callback ignored for {checkout_id}")
+
+            return jsonify({
+
+                "ResultCode": 0,
+
+                "ResultDesc": "Success"
+
+            })
+
+            
 
         except Exception as e:
 
@@ -644,7 +830,7 @@ def create_app():
 
         try:
 
-            response = requests.get('https://sandbox.safaricom.co.ke', timeout=10)
+            response = daraja.get('/', name='probe', retries=0)
 
             results['safaricom_reachable'] = True
 
@@ -674,7 +860,9 @@ def create_app():
 
             results['authentication'] = f'error: {str(e)}'
 
-        
+        # Test 3: Latency of Daraja calls made by this worker
+
+        results['latency'] = daraja.metrics()
 
         return jsonify(results)
 
@@ -742,6 +930,22 @@ def create_app():
 
 
 
+    @app.context_processor
+
+    def inject_cart_summary():
+
+        from cart import cart_summary
+
+        if not current_user.is_authenticated:
+
+            return {}
+
+        summary = cart_summary(current_user.id)
+
+        return {"cart_summary": summary, "cart_count": summary["count"]}
+
+
+
     @app.template_filter("currency")
 
     def currency_filter(value):
@@ -1216,7 +1420,7 @@ def create_app():
 
         
 
-        from models import Order, Appointment, CartItem
+        from models import Order, Appointment
 
         recent_orders = Order.query.filter_by(user_id=current_user.id).order_by(Order.created_at.desc()).limit(5).all()
 
@@ -1228,8 +1432,6 @@ def create_app():
 
         ).filter(Appointment.appointment_date >= datetime.utcnow()).order_by(Appointment.appointment_date).limit(5).all()
 
-        cart_count = CartItem.query.filter_by(user_id=current_user.id).count()
-
         
 
         return render_template(
@@ -1240,8 +1442,6 @@ def create_app():
 
             upcoming_appointments=upcoming_appointments,
 
-            cart_count=cart_count,
-
         )
 
 
@@ -1254,21 +1454,11 @@ def create_app():
 
     def admin_dashboard():
 
-        from models import Order, Product, Appointment, Practitioner
+        from models import Order, Appointment
 
         
 
-        product_count = Product.query.count()
-
-        order_count = Order.query.count()
-
-        user_count = User.query.count()
-
-        practitioner_count = Practitioner.query.count()
-
-        pending_orders = Order.query.filter_by(status="pending").count()
-
-        total_revenue = db.session.query(db.func.coalesce(db.func.sum(Order.total_amount), 0)).scalar() or 0
+        stats = dashboard_stats.get()
 
         recent_orders = Order.query.order_by(Order.created_at.desc()).limit(5).all()
 
@@ -1280,31 +1470,17 @@ def create_app():
 
         ).order_by(Appointment.appointment_date).limit(5).all()
 
-        low_stock = Product.query.filter(Product.stock > 0, Product.stock < 10).count()
-
         
 
         return render_template(
 
             "admin/dashboard.html",
 
-            product_count=product_count,
-
-            order_count=order_count,
-
-            user_count=user_count,
-
-            practitioner_count=practitioner_count,
-
-            pending_orders=pending_orders,
-
             recent_orders=recent_orders,
 
             upcoming_appointments=upcoming_appointments,
 
-            low_stock=low_stock,
-
-            total_revenue=total_revenue,
+            **stats,
 
         )
 
@@ -1327,6 +1503,8 @@ def create_app():
 
     @app.route("/products")
 
+    @use_replica
+
     def products():
 
         from models import Product
@@ -1385,9 +1563,11 @@ def create_app():
 
     @app.route("/products/<int:product_id>")
 
+    @use_replica
+
     def product_detail(product_id):
 
-        from models import Product, CartItem
+        from models import Product
 
         product = db.session.get(Product, product_id)
 
@@ -1399,15 +1579,7 @@ def create_app():
 
         
 
-        cart_count = 0
-
-        if current_user.is_authenticated:
-
-            cart_count = CartItem.query.filter_by(user_id=current_user.id).count()
-
-        
-
-        return render_template("user/product_detail.html", product=product, cart_count=cart_count)
+        return render_template("user/product_detail.html", product=product)
 
 
 
@@ -1419,11 +1591,9 @@ def create_app():
 
     def cart_count():
 
-        from models import CartItem
-
-        cart_count = CartItem.query.filter_by(user_id=current_user.id).count()
+        from cart import cart_summary
 
-        return jsonify({'cart_count': cart_count})
+        return jsonify({'cart_count': cart_summary(current_user.id)['count']})
 
 
 
@@ -1433,67 +1603,9 @@ def create_app():
 
     def cart_sync():
 
-        from models import CartItem, Product
-
-        cart_items = CartItem.query.filter_by(user_id=current_user.id).all()
-
-        
+        from cart import load_cart
 
-        cart_data = []
-
-        total_quantity = 0
-
-        total_amount = 0
-
-        
-
-        for item in cart_items:
-
-            item_total = item.product.price * item.quantity
-
-            total_quantity += item.quantity
-
-            total_amount += item_total
-
-            
-
-            cart_data.append({
-
-                'id': item.id,
-
-                'product_id': item.product_id,
-
-                'name': item.product.name,
-
-                'price': float(item.product.price),
-
-                'quantity': item.quantity,
-
-                'total': float(item_total),
-
-                'stock': item.product.stock,
-
-                'is_active': item.product.is_active,
-
-                'image_url': item.product.image_url
-
-            })
-
-        
-
-        return jsonify({
-
-            'cart_items': cart_data,
-
-            'total_quantity': total_quantity,
-
-            'total_amount': float(total_amount),
-
-            'cart_count': len(cart_items),
-
-            'shipping_cost': (total_quantity // 72 + (1 if total_quantity % 72 > 0 else 0)) * 300
-
-        })
+        return jsonify(load_cart(current_user.id).to_dict())
 
 
 
@@ -1505,6 +1617,8 @@ def create_app():
 
         from models import CartItem, Product
 
+        from cart import cart_summary, invalidate_cart_summary
+
         
 
         try:
@@ -1573,7 +1687,9 @@ def create_app():
 
             db.session.commit()
 
-            cart_count = CartItem.query.filter_by(user_id=current_user.id).count()
+            invalidate_cart_summary(current_user.id)
+
+            cart_count = cart_summary(current_user.id)['count']
 
             
 
@@ -1603,19 +1719,67 @@ def create_app():
 
     
 
+    @app.route("/cart/bulk", methods=["POST"])
+
+    @login_required
+
+    def cart_bulk():
+
+        """Apply many quantity changes in one request: {"items": [{"product_id": 1, "quantity": 3}, ...]}"""
+
+        from cart import apply_cart_deltas, cart_summary
+
+        data = request.get_json(silent=True) or {}
+
+        items = data.get("items")
+
+        if not isinstance(items, list) or not items:
+
+            return jsonify({'success': False, 'message': 'items must be a non-empty list'}), 400
+
+        try:
+
+            deltas = [(int(item["product_id"]), int(item["quantity"])) for item in items]
+
+        except (KeyError, TypeError, ValueError):
+
+            return jsonify({'success': False, 'message': 'Each item needs an integer product_id and quantity'}), 400
+
+        try:
+
+            errors = apply_cart_deltas(current_user.id, deltas)
+
+        except Exception as e:
+
+            db.session.rollback()
+
+            print(f"Bulk cart update error: {e}")
+
+            return jsonify({'success': False, 'message': 'An error occurred. Please try again.'}), 500
+
+        if errors:
+
+            db.session.rollback()
+
+            return jsonify({'success': False, 'message': 'Cart not updated', 'errors': errors}), 400
+
+        summary = cart_summary(current_user.id)
+
+        return jsonify({'success': True, 'cart_count': summary['count'], 'cart_summary': summary})
+
+
+
     @app.route("/cart")
 
     @login_required
 
     def cart():
 
-        from models import CartItem
-
-        cart_items = CartItem.query.filter_by(user_id=current_user.id).all()
+        from cart import load_cart
 
-        total = sum(item.product.price * item.quantity for item in cart_items)
+        cart_items = load_cart(current_user.id)
 
-        return render_template("user/cart.html", cart_items=cart_items, total=total)
+        return render_template("user/cart.html", cart_items=cart_items, total=cart_items.total)
 
     
 
@@ -1627,6 +1791,8 @@ def create_app():
 
         from models import CartItem
 
+        from cart import invalidate_cart_summary
+
         cart_item = db.session.get(CartItem, item_id)
 
         if not cart_item or cart_item.user_id != current_user.id:
@@ -1651,6 +1817,8 @@ def create_app():
 
         db.session.commit()
 
+        invalidate_cart_summary(current_user.id)
+
         return redirect(url_for("cart"))
 
     
@@ -1663,6 +1831,8 @@ def create_app():
 
         from models import CartItem
 
+        from cart import invalidate_cart_summary
+
         cart_item = db.session.get(CartItem, item_id)
 
         if not cart_item or cart_item.user_id != current_user.id:
@@ -1677,6 +1847,8 @@ def create_app():
 
         db.session.commit()
 
+        invalidate_cart_summary(current_user.id)
+
         return redirect(url_for("cart"))
 
 
@@ -1689,9 +1861,9 @@ def create_app():
 
     def checkout():
 
-        from models import CartItem, Product
+        from cart import load_cart
 
-        cart_items = CartItem.query.filter_by(user_id=current_user.id).all()
+        cart_items = load_cart(current_user.id)
 
         
 
@@ -1703,23 +1875,7 @@ def create_app():
 
         
 
-        stock_issues = []
-
-        for item in cart_items:
-
-            if not item.product.is_active:
-
-                stock_issues.append(f"{item.product.name} is no longer available")
-
-            elif item.quantity > item.product.stock:
-
-                if item.product.stock == 0:
-
-                    stock_issues.append(f"{item.product.name} is out of stock")
-
-                else:
-
-                    stock_issues.append(f"Only {item.product.stock} {item.product.name} available (you have {item.quantity} in cart)")
+        stock_issues = cart_items.stock_issues()
 
         
 
@@ -1747,8 +1903,6 @@ def create_app():
 
             contact_phone = sanitize_input(request.form.get("contact_phone", current_user.phone or ""))
 
-            shipping_cost_raw = request.form.get("shipping_cost")
-
             
 
             if not shipping_address:
@@ -1775,15 +1929,29 @@ def create_app():
 
 
 
-            shipping_cost = 0.0
+            from reservations import reserve_cart
 
-            try:
+            # Hold the stock while the shopper pays; another shopper may have taken it since the cart loaded
 
-                shipping_cost = float(shipping_cost_raw) if shipping_cost_raw else 0.0
+            hold_issues = reserve_cart(current_user.id, cart_items, app.config["RESERVATION_TTL"])
 
-            except (TypeError, ValueError):
+            if hold_issues:
+
+                flash("Cannot proceed to checkout - Stock Issues:", "error")
+
+                for issue in hold_issues:
+
+                    flash(issue, "error")
+
+                return redirect(url_for("cart"))
+
+            reservation_sweeper.start()
+
+            
+
+            # Charged from the cart on the server rather than the figure the page computed
 
-                shipping_cost = 0.0
+            shipping_cost = float(cart_items.shipping_cost(delivery_option))
 
             
 
@@ -1809,13 +1977,7 @@ def create_app():
 
         
 
-        total = sum(item.product.price * item.quantity for item in cart_items)
-
-        total_quantity = sum(item.quantity for item in cart_items)
-
-        
-
-        return render_template("user/checkout.html", cart_items=cart_items, total=float(total), total_quantity=total_quantity)
+        return render_template("user/checkout.html", cart_items=cart_items, total=float(cart_items.total), total_quantity=cart_items.total_quantity)
 
     
 
@@ -1825,9 +1987,7 @@ def create_app():
 
     def payment():
 
-        from models import CartItem, Order, OrderItem
-
-        import random
+        from cart import load_cart, invalidate_cart_summary
 
 
 
@@ -1839,7 +1999,7 @@ def create_app():
 
         
 
-        cart_items = CartItem.query.filter_by(user_id=current_user.id).all()
+        cart_items = load_cart(current_user.id)
 
         if not cart_items:
 
@@ -1853,79 +2013,113 @@ def create_app():
 
         checkout_info = session["checkout_info"]
 
-        total = sum(item.product.price * item.quantity for item in cart_items)
-
-        shipping_cost = float(checkout_info.get("shipping_cost", 0) or 0)
+        total = cart_items.total
 
-        grand_total = float(total) + shipping_cost
+        shipping_cost, grand_total = checkout_totals(cart_items, checkout_info)
 
 
 
         if request.method == "POST":
 
-            order_number = f"SHF{random.randint(100000, 999999)}"
+            from sqlalchemy.exc import IntegrityError
 
-            order = Order(
+            from models import Order
 
-                user_id=current_user.id,
+            from orders import place_order, InsufficientStock
 
-                order_number=order_number,
+            # The payment page posts the STK Push job id; store Safaricom's CheckoutRequestID instead
 
-                total_amount=grand_total,
+            checkout_request_id = request.form.get("checkout_request_id", "").strip()
 
-                shipping_address=checkout_info["shipping_address"],
+            resolved = payment_store.resolve(checkout_request_id) if checkout_request_id else None
 
-                delivery_option=checkout_info["delivery_option"],
+            mpesa_amount = None
 
-                status="pending"
+            if checkout_request_id:
 
-            )
+                # Only link a push this shopper requested, for at least this total, that no other order holds
 
-            db.session.add(order)
+                requested = payment_store.requested(checkout_request_id)
 
-            db.session.flush()
+                if (
 
-            
+                    requested is None
 
-            for cart_item in cart_items:
+                    or requested[0] != current_user.id
 
-                product = cart_item.product
+                    or requested[1] is None
 
-                if product.stock >= cart_item.quantity:
+                    or Decimal(str(requested[1])) < Decimal(str(grand_total))
 
-                    product.stock -= cart_item.quantity
+                    or db.session.query(
 
-                else:
+                        Order.query.filter(Order.checkout_request_id.in_({checkout_request_id, resolved})).exists()
 
-                    flash(f"Insufficient stock for {product.name}. Order cancelled.", "error")
+                    ).scalar()
 
-                    db.session.rollback()
+                ):
 
-                    return redirect(url_for("cart"))
+                    flash("That M-Pesa payment request does not match this order. Please request a new one.", "error")
 
-                
+                    return redirect(url_for("payment"))
+
+                mpesa_amount = requested[1]
+
+            try:
+
+                order = place_order(
+
+                    current_user.id,
 
-                order_item = OrderItem(
+                    cart_items,
 
-                    order_id=order.id,
+                    checkout_info,
 
-                    product_id=cart_item.product_id,
+                    shipping_cost,
 
-                    quantity=cart_item.quantity,
+                    checkout_request_id=resolved,
 
-                    price=cart_item.product.price
+                    mpesa_amount=mpesa_amount,
 
                 )
 
-                db.session.add(order_item)
+            except InsufficientStock as e:
 
-            
+                for name in e.products:
+
+                    flash(f"Insufficient stock for {name}. Order cancelled.", "error")
+
+                return redirect(url_for("cart"))
+
+            except IntegrityError:
+
+                # Another order linked the same push between the check and the insert
+
+                db.session.rollback()
+
+                flash("That M-Pesa payment request does not match this order. Please request a new one.", "error")
+
+                return redirect(url_for("payment"))
+
+            if checkout_request_id and order.checkout_request_id == checkout_request_id:
+
+                # Saved with the job id: the job relinks the order once Safaricom answers,
+
+                # unless it already had before the order was committed
+
+                from callbacks import link_checkout_request
+
+                resolved = payment_store.resolve(checkout_request_id)
+
+                if resolved != checkout_request_id:
 
-            CartItem.query.filter_by(user_id=current_user.id).delete()
+                    link_checkout_request(checkout_request_id, resolved)
 
             session.pop("checkout_info", None)
 
-            db.session.commit()
+            invalidate_cart_summary(current_user.id)
+
+            order_number = order.order_number
 
             
 
@@ -1949,8 +2143,6 @@ def create_app():
 
             checkout_info=checkout_info,
 
-            cart_count=len(cart_items),
-
         )
 
 
@@ -2015,6 +2207,8 @@ def create_app():
 
         from models import Order, OrderItem, CartItem
 
+        from cart import invalidate_cart_summary
+
         order = db.session.get(Order, order_id)
 
         if not order or order.user_id != current_user.id:
@@ -2043,6 +2237,8 @@ def create_app():
 
         db.session.commit()
 
+        invalidate_cart_summary(current_user.id)
+
         flash("Items added to your cart.", "success")
 
         return redirect(url_for("cart"))
@@ -2053,6 +2249,8 @@ def create_app():
 
     @app.route("/practitioners")
 
+    @use_replica
+
     def practitioners():
 
         from models import Practitioner
@@ -2510,6 +2708,7 @@ Shifaa Herbal Team"""
     
 
     @app.route("/community")
+    @use_replica
     def community():
         from models import Question, Story, Discussion, User, QuestionReply
         
@@ -2612,12 +2811,7 @@ Shifaa Herbal Team"""
         # Load replies for this discussion
         replies = QuestionReply.query.filter_by(question_id=discussion_id).order_by(QuestionReply.created_at.asc()).all()
         
-        cart_count = 0
-        if current_user.is_authenticated:
-            from models import CartItem
-            cart_count = CartItem.query.filter_by(user_id=current_user.id).count()
-        
-        return render_template("user/discussion_detail.html", discussion=discussion, replies=replies, cart_count=cart_count)
+        return render_template("user/discussion_detail.html", discussion=discussion, replies=replies)
 
     @app.route("/post_reply/<int:discussion_id>", methods=["POST"])
     @login_required
@@ -2675,7 +2869,7 @@ Shifaa Herbal Team"""
 
     @app.route("/question/<int:question_id>")
     def view_question(question_id):
-        from models import Question, QuestionReply, CartItem
+        from models import Question, QuestionReply
 
         question = db.session.get(Question, question_id)
         if not question:
@@ -2685,11 +2879,7 @@ Shifaa Herbal Team"""
         # Load replies for this question
         replies = QuestionReply.query.filter_by(question_id=question_id).order_by(QuestionReply.created_at.asc()).all()
         
-        cart_count = 0
-        if current_user.is_authenticated:
-            cart_count = CartItem.query.filter_by(user_id=current_user.id).count()
-        
-        return render_template("user/question_detail.html", question=question, replies=replies, cart_count=cart_count)
+        return render_template("user/question_detail.html", question=question, replies=replies)
 
     @app.route("/reply_question/<int:question_id>", methods=["POST"])
     @login_required
@@ -3073,13 +3263,15 @@ Shifaa Herbal Team"""
 
         from models import Order
 
+        from orders import order_loaders
+
         status_filter = request.args.get("status", "")
 
         page = request.args.get('page', 1, type=int)
 
         
 
-        query = Order.query.order_by(Order.created_at.desc())
+        query = Order.query.options(*order_loaders("list")).order_by(Order.created_at.desc())
 
         if status_filter:
 
@@ -3111,7 +3303,9 @@ Shifaa Herbal Team"""
 
         from models import Order
 
-        order = db.session.get(Order, order_id)
+        from orders import order_loaders
+
+        order = db.session.get(Order, order_id, options=order_loaders("detail"))
 
         if not order:
 
@@ -3550,6 +3744,8 @@ Shifaa Herbal Team"""
 
     @admin_required
 
+    @use_replica
+
     def admin_sales():
 
         from datetime import timedelta
@@ -3568,6 +3764,10 @@ Shifaa Herbal Team"""
 
         
 
+        status = "delivered" if delivered_only else None
+
+        date_from = date_to = None
+
         query = Order.query
 
         if delivered_only:
@@ -3578,9 +3778,11 @@ Shifaa Herbal Team"""
 
             try:
 
-                date_from = datetime.strptime(date_from_str, "%Y-%m-%d")
+                start_of_day = datetime.strptime(date_from_str, "%Y-%m-%d")
 
-                query = query.filter(Order.created_at >= date_from)
+                query = query.filter(Order.created_at >= start_of_day)
+
+                date_from = start_of_day.date()
 
             except ValueError:
 
@@ -3596,33 +3798,29 @@ Shifaa Herbal Team"""
 
                 query = query.filter(Order.created_at < end_of_day)
 
+                date_to = date_to.date()
+
             except ValueError:
 
                 pass
 
         
 
-        order_count = query.count()
+        # Totals come from the sales_daily rollup: one row per day and status, not per order
 
-        revenue = db.session.query(db.func.coalesce(db.func.sum(Order.total_amount), 0)).filter(
+        selected = sales_rollup.totals(date_from, date_to, status)
 
-            query.whereclause
-
-        ).scalar() or 0 if query.whereclause else 0
+        all_time = sales_rollup.totals()
 
         
 
         paginated_orders = query.order_by(Order.created_at.desc()).paginate(
 
-            page=page, per_page=50, error_out=False
+            page=page, per_page=50, error_out=False, count=False
 
         )
 
-        
-
-        total_all_time = db.session.query(db.func.coalesce(db.func.sum(Order.total_amount), 0)).scalar() or 0
-
-        total_orders_all_time = Order.query.count()
+        paginated_orders.total = selected["order_count"]
 
         
 
@@ -3636,13 +3834,13 @@ Shifaa Herbal Team"""
 
             delivered_only=delivered_only,
 
-            order_count=order_count,
+            order_count=selected["order_count"],
 
-            revenue=float(revenue) if revenue else 0,
+            revenue=selected["revenue"],
 
-            total_orders_all_time=total_orders_all_time,
+            total_orders_all_time=all_time["order_count"],
 
-            total_revenue_all_time=float(total_all_time) if total_all_time else 0,
+            total_revenue_all_time=all_time["revenue"],
 
             orders=paginated_orders.items,
 
@@ -3656,6 +3854,42 @@ Shifaa Herbal Team"""
 
 
 
+    @app.route("/admin/orders/export")
+
+    @login_required
+
+    @admin_required
+
+    @use_replica
+
+    def admin_export_orders():
+
+        """Stream orders matching the sales/orders filters as CSV or NDJSON (?format=ndjson)."""
+
+        from exports import export_response
+
+        return export_response("orders", request.args, request.headers.get("Accept-Encoding"))
+
+
+
+    @app.route("/admin/orders/items/export")
+
+    @login_required
+
+    @admin_required
+
+    @use_replica
+
+    def admin_export_order_items():
+
+        """Stream the line items of matching orders as CSV or NDJSON."""
+
+        from exports import export_response
+
+        return export_response("order-items", request.args, request.headers.get("Accept-Encoding"))
+
+
+
     # ========== CLEANUP ROUTES ==========
 
     @app.route("/admin/cleanup-orders", methods=["POST"])
@@ -3728,15 +3962,27 @@ Shifaa Herbal Team"""
 
     # ========== CLI COMMANDS ==========
 
-    @app.cli.command("init-db")
+    @app.cli.command("upgrade-schema")
 
-    def init_db():
+    def upgrade_schema_command():
 
-        from models import User
+        """Create missing tables, add missing columns and make indexes unique."""
+
+        from schema import upgrade_schema
+
+        for change in upgrade_schema():
 
+            print(f"Added {change}")
 
 
-        db.create_all()
+
+    @app.cli.command("create-admin")
+
+    def create_admin():
+
+        """Create the ADMIN_EMAIL / ADMIN_PASSWORD admin account if it does not exist."""
+
+        from models import User
 
         admin_email = os.getenv("ADMIN_EMAIL", "admin@shifaaherbal.com")
 
@@ -3770,8 +4016,496 @@ Shifaa Herbal Team"""
 
 
 
+    @app.cli.command("compile-templates")
+
+    def compile_templates():
+
+        """Compile every template into the bytecode cache, so workers start with warm templates."""
+
+        names = app.jinja_env.list_templates()
+
+        for name in names:
+
+            app.jinja_env.get_template(name)
+
+        print(f"Compiled {len(names)} templates")
+
+
+
+    @app.cli.command("init-db")
+
+    @click.pass_context
+
+    def init_db(ctx):
+
+        """Upgrade the schema and create the admin account; run once per deploy, not on worker start."""
+
+        ctx.invoke(upgrade_schema_command)
+
+        ctx.invoke(create_admin)
+
         print("Database initialized.")
 
+    @app.cli.command("process-callbacks")
+
+    def process_callbacks():
+
+        """Apply journalled M-Pesa callbacks that have not reached their orders yet."""
+
+        processed = callback_processor.process_pending()
+
+        print(f"Processed {processed} callbacks.")
+
+    @app.cli.command("backfill-order-summaries")
+
+    @click.option("--batch-size", default=500, show_default=True, help="Orders updated per statement.")
+
+    @click.option("--all", "recompute", is_flag=True, help="Recompute every order, not just those without a summary.")
+
+    def backfill_order_summaries_command(batch_size, recompute):
+
+        """Fill the item count, quantity and preview columns of existing orders."""
+
+        from orders import backfill_order_summaries
+
+        updated = backfill_order_summaries(batch_size=batch_size, recompute=recompute)
+
+        print(f"Updated {updated} orders.")
+
+    @app.cli.command("rebuild-sales-rollup")
+
+    def rebuild_sales_rollup():
+
+        """Recompute the sales_daily rollup from the order table."""
+
+        rows = sales_rollup.rebuild()
+
+        print(f"Rebuilt sales_daily: {rows} day/status rows.")
+
+    @app.cli.command("copy-database")
+
+    @click.option("--source", default=f"sqlite:///{os.path.join(BASE_DIR, 'shifaa.db')}", show_default=True, help="Database to copy from.")
+
+    @click.option("--target", envvar="DATABASE_URL", required=True, help="Database to copy into (default: $DATABASE_URL).")
+
+    @click.option("--batch-size", default=5000, show_default=True, help="Rows per COPY batch.")
+
+    @click.option("--truncate", is_flag=True, help="Empty non-empty target tables first.")
+
+    def copy_database(source, target, batch_size, truncate):
+
+        """Copy every table into another database (e.g. SQLite to PostgreSQL) and verify row counts."""
+
+        from db_copy import copy_database as copy_tables
+
+        report = copy_tables(source, database.database_uri(target, None), batch_size=batch_size, truncate=truncate)
+
+        print(json.dumps(report, indent=2))
+
+        if not report["ok"]:
+
+            raise SystemExit(1)
+
+    @app.cli.command("sync-replica")
+
+    @click.option("--every", default=0, help="Repeat every N seconds (0 = once).")
+
+    def sync_replica(every):
+
+        """Refresh a SQLite stand-in replica from the primary database file."""
+
+        from sqlalchemy.engine import make_url
+
+        from replica import sync_sqlite_replica
+
+        if "replica" not in app.config.get("SQLALCHEMY_BINDS", {}):
+
+            raise click.ClickException("DATABASE_REPLICA_URL is not set.")
+
+        primary = make_url(app.config["SQLALCHEMY_DATABASE_URI"])
+
+        replica = make_url(app.config["SQLALCHEMY_BINDS"]["replica"]["url"])
+
+        if primary.get_backend_name() != "sqlite" or replica.get_backend_name() != "sqlite":
+
+            raise click.ClickException("sync-replica only copies SQLite files; use database replication otherwise.")
+
+        while True:
+
+            sync_sqlite_replica(primary.database, replica.database)
+
+            print(f"Replica {replica.database} synced from {primary.database}.")
+
+            if not every:
+
+                break
+
+            time.sleep(every)
+
+    @app.cli.command("check-queued-payment")
+
+    @click.option("--database-url", envvar="SCRATCH_DATABASE_URL", default=None,
+
+                  help="Empty scratch database to run against (default: a temporary SQLite file).")
+
+    def check_queued_payment(database_url):
+
+        """Check that an order confirmed before its STK Push job ran is settled by the callback."""
+
+        from loadtest import run_queued_payment_check
+
+        report = run_queued_payment_check(database_url)
+
+        print(json.dumps(report, indent=2, default=str))
+
+        if not report["ok"]:
+
+            raise SystemExit(1)
+
+    @app.cli.command("check-payment-links")
+
+    @click.option("--database-url", envvar="SCRATCH_DATABASE_URL", default=None,
+
+                  help="Empty scratch database to run against (default: a temporary SQLite file).")
+
+    def check_payment_links(database_url):
+
+        """Check that orders are only paid by their own shopper's STK Push for the full total."""
+
+        from loadtest import run_payment_guard_check
+
+        report = run_payment_guard_check(database_url)
+
+        print(json.dumps(report, indent=2, default=str))
+
+        if not report["ok"]:
+
+            raise SystemExit(1)
+
+
+
+    @app.cli.command("sweep-reservations")
+
+    def sweep_reservations():
+
+        """Delete expired checkout stock holds."""
+
+        removed = reservation_sweeper.sweep()
+
+        print(f"Removed {removed} expired reservations.")
+
+    @app.cli.command("reconcile-payments")
+
+    @click.option("--older-than", default=10, show_default=True, help="Only check orders pending for at least this many minutes.")
+
+    @click.option("--batch-size", default=100, show_default=True, help="Orders read and updated per batch.")
+
+    @click.option("--workers", default=4, show_default=True, help="Concurrent STK Push Query requests.")
+
+    @click.option("--rate", default=5.0, show_default=True, help="Maximum STK Push Query requests per second.")
+
+    @click.option("--every", default=0, help="Keep running, reconciling every N seconds.")
+
+    def reconcile_payments(older_than, batch_size, workers, rate, every):
+
+        """Query Daraja for orders whose payment callback never arrived."""
+
+        from reconcile import reconcile_pending_payments
+
+        while True:
+
+            stats = reconcile_pending_payments(older_than, batch_size, workers, rate)
+
+            print(f"Checked {stats['checked']} orders: {stats['paid']} paid, "
+
+                  f"{stats['underpaid']} underpaid, {stats['failed']} failed, {stats['unresolved']} still pending, "
+
+                  f"{stats['unverified']} paid with no recorded push amount.")
+
+            if not every:
+
+                break
+
+            time.sleep(every)
+
+    @app.cli.command("stress-checkout")
+
+    @click.option("--products", default=4, show_default=True, help="Test products shared by the carts.")
+
+    @click.option("--stock", default=50, show_default=True, help="Units of each test product in stock.")
+
+    @click.option("--shoppers", default=40, show_default=True, help="Shoppers checking out.")
+
+    @click.option("--lines", default=3, show_default=True, help="Products in each shopper's cart.")
+
+    @click.option("--quantity", default=3, show_default=True, help="Units of each product in a cart.")
+
+    @click.option("--processes", default=4, show_default=True, help="Processes checking out at once.")
+
+    @click.option("--concurrency", default=4, show_default=True, help="Checkouts running at once in each process.")
+
+    @click.option("--database-url", envvar="SCRATCH_DATABASE_URL", default=None,
+
+                  help="Empty scratch database to run against (default: a temporary SQLite file).")
+
+    def stress_checkout(products, stock, shoppers, lines, quantity, processes, concurrency, database_url):
+
+        """Race parallel checkouts of overlapping carts on a scratch database and verify nothing is oversold."""
+
+        from loadtest import run_stock_contention
+
+        report = run_stock_contention(
+
+            database_url, products=products, stock=stock, shoppers=shoppers, lines=lines, quantity=quantity,
+
+            processes=processes, concurrency=concurrency,
+
+        )
+
+        print(json.dumps(report, indent=2))
+
+        if not report["ok"]:
+
+            raise SystemExit(1)
+
+    @app.cli.command("bench-order-numbers")
+
+    @click.option("--count", default=10_000_000, show_default=True, help="Ids to generate for the collision check.")
+
+    @click.option("--nodes", default=4, show_default=True, help="Simulated processes generating at once.")
+
+    @click.option("--database-url", envvar="SCRATCH_DATABASE_URL", default=None,
+
+                  help="Empty scratch database for the node id lease checks (default: a temporary SQLite file).")
+
+    def bench_order_numbers(count, nodes, database_url):
+
+        """Benchmark order number generation and check for collisions, lease expiry, handover and clock steps."""
+
+        from loadtest import run_order_number_benchmark
+
+        report = run_order_number_benchmark(count=count, nodes=nodes, database_url=database_url)
+
+        print(json.dumps(report, indent=2))
+
+        if not report["ok"]:
+
+            raise SystemExit(1)
+
+    @app.cli.command("check-query-counts")
+
+    @click.option("--page-size", "page_sizes", multiple=True, type=int, default=(5, 20, 50), show_default=True, help="Admin order list page sizes to compare.")
+
+    @click.option("--lines", default=5, show_default=True, help="Items in each test order.")
+
+    @click.option("--database-url", envvar="SCRATCH_DATABASE_URL", default=None,
+
+                  help="Empty scratch database to run against (default: a temporary SQLite file).")
+
+    def check_query_counts(page_sizes, lines, database_url):
+
+        """Check that the admin order pages run a fixed number of queries on a scratch database."""
+
+        from loadtest import run_query_count_check
+
+        report = run_query_count_check(page_sizes=page_sizes, lines=lines, database_url=database_url)
+
+        print(json.dumps(report, indent=2))
+
+        if not report["ok"]:
+
+            raise SystemExit(1)
+
+    @app.cli.command("bench-export")
+
+    @click.option("--orders", default=1_000_000, show_default=True, help="Synthetic orders to export.")
+
+    @click.option("--kind", type=click.Choice(["orders", "order-items"]), default="orders", show_default=True)
+
+    @click.option("--format", "fmt", type=click.Choice(["csv", "ndjson"]), default="csv", show_default=True)
+
+    @click.option("--gzip/--no-gzip", "compress", default=True, show_default=True)
+
+    @click.option("--max-rss-growth", default=64, show_default=True, help="Largest acceptable RSS growth in MB.")
+
+    @click.option("--database-url", envvar="SCRATCH_DATABASE_URL", default=None,
+
+                  help="Empty scratch database to run against (default: a temporary SQLite file).")
+
+    def bench_export(orders, kind, fmt, compress, max_rss_growth, database_url):
+
+        """Stream an export of synthetic orders on a scratch database and check that memory stays bounded."""
+
+        from loadtest import run_export_benchmark
+
+        report = run_export_benchmark(database_url, orders=orders, kind=kind, fmt=fmt, compress=compress, max_rss_growth_mb=max_rss_growth)
+
+        print(json.dumps(report, indent=2))
+
+        if not report["ok"]:
+
+            raise SystemExit(1)
+
+    @app.cli.command("bench-sqlite")
+
+    @click.option("--writers", default=4, show_default=True, help="Writer processes.")
+
+    @click.option("--readers", default=8, show_default=True, help="Reader processes.")
+
+    @click.option("--duration", default=10, show_default=True, help="Seconds per mode.")
+
+    def bench_sqlite(writers, readers, duration):
+
+        """Compare SQLite read/write contention with the old and the tuned engine settings."""
+
+        from loadtest import run_sqlite_contention
+
+        print(json.dumps(run_sqlite_contention(writers=writers, readers=readers, duration=duration), indent=2))
+
+    @app.cli.command("tune-workers")
+
+    @click.option("--workers", "worker_counts", type=int, multiple=True, help="Worker counts to try (repeatable).")
+
+    @click.option("--threads", "thread_counts", type=int, multiple=True, help="Threads per worker to try (repeatable).")
+
+    @click.option("--worker-class", type=click.Choice(["gthread", "gevent", "sync"]), default="gthread", show_default=True)
+
+    @click.option("--checkouts", default=100, show_default=True, help="Checkouts run alongside the page load.")
+
+    @click.option("--page-requests", default=1000, show_default=True, help="Catalog page requests per combination.")
+
+    @click.option("--concurrency", default=20, show_default=True, help="Concurrent shoppers and page clients each.")
+
+    @click.option("--daraja-latency-ms", default=1000.0, show_default=True, help="Simulated Daraja response time.")
+
+    @click.option("--database-url", envvar="SCRATCH_DATABASE_URL", default=None,
+
+                  help="Empty scratch database to run against (default: a temporary SQLite file).")
+
+    def tune_workers(worker_counts, thread_counts, worker_class, checkouts, page_requests, concurrency, daraja_latency_ms, database_url):
+
+        """Benchmark gunicorn workers x threads combinations on a scratch database and report the best for this machine."""
+
+        import multiprocessing
+
+        from loadtest import run_worker_tuning
+
+        cpus = multiprocessing.cpu_count()
+
+        report = run_worker_tuning(
+
+            worker_counts or sorted({1, cpus, cpus + 1, cpus * 2 + 1}), thread_counts or (1, 4, 8, 16),
+
+            worker_class=worker_class, checkouts=checkouts, checkout_concurrency=concurrency,
+
+            page_requests=page_requests, page_concurrency=concurrency, daraja_latency_ms=daraja_latency_ms,
+
+            database_url=database_url,
+
+        )
+
+        print(json.dumps(report, indent=2))
+
+        if not report["ok"]:
+
+            raise SystemExit(1)
+
+    @app.cli.command("bench-startup")
+
+    @click.option("--runs", default=5, show_default=True, help="Cold starts to time.")
+
+    @click.option("--workers", default=2, show_default=True, help="Gunicorn workers to recycle.")
+
+    @click.option("--max-requests", default=50, show_default=True, help="Requests before a worker is recycled.")
+
+    @click.option("--target-ms", default=200, show_default=True, help="Longest acceptable cold start, server start and worker boot.")
+
+    @click.option("--database-url", envvar="SCRATCH_DATABASE_URL", default=None,
+
+                  help="Empty scratch database to run against (default: a temporary SQLite file).")
+
+    def bench_startup(runs, workers, max_requests, target_ms, database_url):
+
+        """Time cold starts of the app, gunicorn server start and worker boots while workers are recycled."""
+
+        from loadtest import run_startup_benchmark
+
+        report = run_startup_benchmark(runs=runs, workers=workers, max_requests=max_requests, target_ms=target_ms,
+
+                                       database_url=database_url)
+
+        print(json.dumps(report, indent=2))
+
+        if not report["ok"]:
+
+            raise SystemExit(1)
+
+    @app.cli.command("daraja-sim")
+
+    @click.option("--host", default="127.0.0.1", show_default=True)
+
+    @click.option("--port", default=8001, show_default=True)
+
+    def daraja_sim(host, port):
+
+        """Serve the Daraja simulator over HTTP (set MPESA_BASE_URL to its address)."""
+
+        from werkzeug.serving import run_simple
+
+        from daraja_sim import DarajaSimulator, create_simulator_app
+
+        simulator = DarajaSimulator(app.config)
+
+        run_simple(host, port, create_simulator_app(simulator), threaded=True)
+
+    @app.cli.command("loadtest-checkout")
+
+    @click.option("--checkouts", default=100, show_default=True, help="Total checkouts to run.")
+
+    @click.option("--concurrency", default=10, show_default=True, help="Shoppers checking out at once.")
+
+    @click.option("--poll-interval", default=0.25, show_default=True, help="Seconds between status checks.")
+
+    @click.option("--timeout", default=60, show_default=True, help="Give up on a checkout after this many seconds.")
+
+    @click.option("--base-url", default=None,
+
+                  help="Run against a server over HTTP instead of in process; it must use --database-url.")
+
+    @click.option("--database-url", envvar="SCRATCH_DATABASE_URL", default=None,
+
+                  help="Empty scratch database to seed shoppers into (default: a temporary SQLite file).")
+
+    def loadtest_checkout(checkouts, concurrency, poll_interval, timeout, base_url, database_url):
+
+        """Measure checkout throughput and latency through STK Push, callback and status check."""
+
+        from loadtest import run_checkout_scenario, scratch_app, _seed_catalog, _seed_shoppers
+
+        if base_url is not None and database_url is None:
+
+            raise click.UsageError("--base-url needs --database-url: the scratch database the server runs on.")
+
+        with scratch_app(database_url, {"MPESA_SIMULATOR": "true"}) as scratch:
+
+            _seed_catalog(scratch, 1)
+
+            shoppers = _seed_shoppers(scratch, concurrency)
+
+            report = run_checkout_scenario(
+
+                app=None if base_url else scratch, base_url=base_url, shoppers=shoppers, checkouts=checkouts,
+
+                concurrency=concurrency, poll_interval=poll_interval, timeout=timeout,
+
+            )
+
+            print(json.dumps(report, indent=2))
+
+            if base_url is None:
+
+                print(json.dumps({"daraja": daraja.metrics()}, indent=2))
+
 
 
     return app
@@ -3786,6 +4520,8 @@ if __name__ == "__main__":
 
     with app.app_context():
 
-        db.create_all()
+        from schema import upgrade_schema
+
+        upgrade_schema()
 
     app.run(host='127.0.0.1', port=5000, debug=True)
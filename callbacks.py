@@ -0,0 +1,230 @@
+"""
+Durable ingestion of M-Pesa STK Push callbacks.
+
+Each callback is written to the append-only mpesa_callback journal before
+Safaricom receives its acknowledgement, then applied to orders in batches by
+a background processor. The unique CheckoutRequestID turns re-deliveries into
+no-ops, and rows left unprocessed by a recycled worker are picked up later.
+An order is only marked paid when the amount Safaricom reports covers its
+total; a smaller successful payment marks it "underpaid" for the shop to
+follow up.
+"""
+import json
+import os
+import threading
+from datetime import datetime
+from decimal import Decimal
+
+
+def parse_callback(data):
+    """Extract the journal columns from a Daraja stkCallback body."""
+    stk_callback = (data or {}).get("Body", {}).get("stkCallback", {})
+    checkout_id = stk_callback.get("CheckoutRequestID")
+    if not checkout_id:
+        raise ValueError("Callback has no CheckoutRequestID")
+
+    metadata = {}
+    for item in stk_callback.get("CallbackMetadata", {}).get("Item", []):
+        metadata[item.get("Name")] = item.get("Value")
+
+    return {
+        "checkout_request_id": checkout_id,
+        "merchant_request_id": stk_callback.get("MerchantRequestID"),
+        "result_code": stk_callback.get("ResultCode"),
+        "result_desc": (stk_callback.get("ResultDesc") or "")[:255],
+        "amount": metadata.get("Amount"),
+        "receipt_number": metadata.get("MpesaReceiptNumber"),
+        "phone_number": str(metadata["PhoneNumber"]) if metadata.get("PhoneNumber") else None,
+        "payload": json.dumps(data),
+        "received_at": datetime.utcnow(),
+    }
+
+
+def record_callback(values):
+    """Append a callback to the journal. Returns False if it was already recorded."""
+    from sqlalchemy.exc import IntegrityError
+    from extensions import db
+    from models import MpesaCallback
+
+    with db.engine.begin() as conn:
+        dialect = conn.dialect.name
+        if dialect in ("sqlite", "postgresql"):
+            if dialect == "sqlite":
+                from sqlalchemy.dialects.sqlite import insert
+            else:
+                from sqlalchemy.dialects.postgresql import insert
+            stmt = insert(MpesaCallback).values(**values).on_conflict_do_nothing(
+                index_elements=[MpesaCallback.checkout_request_id]
+            )
+            return conn.execute(stmt).rowcount == 1
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(db.insert(MpesaCallback).values(**values))
+        return True
+    except IntegrityError:
+        return False
+
+
+def order_payment_status(result_code, amount, total):
+    """Payment status for an order of total that M-Pesa reported result_code and amount for."""
+    if result_code != 0:
+        return "failed"
+    if amount is None or Decimal(str(amount)) < Decimal(str(total)):
+        return "underpaid"
+    return "paid"
+
+
+def payment_status_sql(result_code, amount):
+    """order_payment_status() as a SQL expression against Order.total_amount, for bulk updates."""
+    from extensions import db
+    from models import Order
+
+    return db.case(
+        (result_code != 0, "failed"),
+        (Order.total_amount <= amount, "paid"),
+        else_="underpaid",
+    )
+
+
+def apply_recorded_callback(order):
+    """Copy an already journalled result onto an order that is being placed."""
+    from extensions import db
+    from models import MpesaCallback
+
+    if not order.checkout_request_id:
+        return
+    row = db.session.execute(
+        db.select(MpesaCallback.result_code, MpesaCallback.amount, MpesaCallback.receipt_number)
+        .where(MpesaCallback.checkout_request_id == order.checkout_request_id)
+    ).first()
+    if row is not None:
+        order.payment_status = order_payment_status(row.result_code, row.amount, order.total_amount)
+        order.mpesa_receipt = row.receipt_number
+
+
+def link_checkout_request(job_id, checkout_request_id):
+    """
+    Point orders saved with a queued STK Push job id at Safaricom's CheckoutRequestID.
+
+    An order confirmed before its job sent the push only knows the job id, and
+    callbacks and reconciliation match on CheckoutRequestID. A callback that
+    was already journalled is applied straight away. Returns the number of
+    orders relinked.
+    """
+    from extensions import db
+    from models import MpesaCallback, Order
+
+    with db.engine.begin() as conn:
+        relinked = conn.execute(
+            db.update(Order)
+            .where(Order.checkout_request_id == job_id)
+            .values(checkout_request_id=checkout_request_id)
+        ).rowcount
+        if relinked:
+            row = conn.execute(
+                db.select(MpesaCallback.result_code, MpesaCallback.amount, MpesaCallback.receipt_number)
+                .where(MpesaCallback.checkout_request_id == checkout_request_id)
+            ).first()
+            if row is not None:
+                conn.execute(
+                    db.update(Order)
+                    .where(Order.checkout_request_id == checkout_request_id)
+                    .values(
+                        payment_status=payment_status_sql(db.literal(row.result_code), db.literal(row.amount, db.Numeric(10, 2))),
+                        mpesa_receipt=row.receipt_number,
+                    )
+                )
+    return relinked
+
+
+class CallbackProcessor:
+    """Background thread that applies journalled callbacks to orders in batches."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.batch_size = 100
+        self.interval = 5
+        self._event = threading.Event()
+        self._thread = None
+        self._thread_pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("CALLBACK_BATCH_SIZE", 100)
+        app.config.setdefault("CALLBACK_PROCESS_INTERVAL", 5)
+        self.app = app
+        self.batch_size = int(app.config["CALLBACK_BATCH_SIZE"])
+        self.interval = float(app.config["CALLBACK_PROCESS_INTERVAL"])
+        app.extensions["callback_processor"] = self
+
+    def start(self):
+        """Start this worker's processor thread if it is not running yet."""
+        if self._thread is not None and self._thread_pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or self._thread_pid != os.getpid() or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="mpesa-callbacks", daemon=True)
+                self._thread_pid = os.getpid()
+                self._thread.start()
+
+    def wake(self):
+        self.start()
+        self._event.set()
+
+    def _run(self):
+        while True:
+            self._event.wait(self.interval)
+            self._event.clear()
+            try:
+                with self.app.app_context():
+                    self.process_pending()
+            except Exception as e:
+                print(f"Callback processing failed: {e}")
+
+    def process_pending(self):
+        """Apply every unprocessed journal row to its order. Returns the number of rows processed."""
+        from extensions import db
+        from models import MpesaCallback, Order
+
+        update_order = (
+            db.update(Order)
+            .where(Order.checkout_request_id == db.bindparam("b_checkout_id"))
+            .values(
+                payment_status=payment_status_sql(db.bindparam("b_result_code"), db.bindparam("b_amount", type_=db.Numeric(10, 2))),
+                mpesa_receipt=db.bindparam("b_receipt"),
+            )
+        )
+
+        processed = 0
+        while True:
+            with db.engine.begin() as conn:
+                rows = conn.execute(
+                    db.select(MpesaCallback.id, MpesaCallback.checkout_request_id, MpesaCallback.result_code,
+                              MpesaCallback.amount, MpesaCallback.receipt_number)
+                    .where(MpesaCallback.processed_at.is_(None))
+                    .order_by(MpesaCallback.id)
+                    .limit(self.batch_size)
+                ).all()
+                if not rows:
+                    break
+
+                conn.execute(update_order, [
+                    {
+                        "b_checkout_id": row.checkout_request_id,
+                        "b_result_code": row.result_code,
+                        "b_amount": row.amount,
+                        "b_receipt": row.receipt_number,
+                    }
+                    for row in rows
+                ])
+                conn.execute(
+                    db.update(MpesaCallback)
+                    .where(MpesaCallback.id.in_([row.id for row in rows]))
+                    .values(processed_at=datetime.utcnow())
+                )
+            processed += len(rows)
+            if len(rows) < self.batch_size:
+                break
+        return processed
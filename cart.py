@@ -0,0 +1,217 @@
+"""
+Cart repository.
+
+Loads a user's cart lines together with their products in one joined query
+and works out the totals once, so views never trigger a product lookup per
+line item. The cart badge reads a cached per-user summary instead, which every
+cart write must invalidate with invalidate_cart_summary().
+"""
+from decimal import Decimal
+
+# Shipping is charged per parcel of up to 72 pieces; store pickup is free
+PIECES_PER_PARCEL = 72
+SHIPPING_COST_PER_PARCEL = 300
+
+# Largest number of distinct products one bulk cart request may touch
+MAX_BULK_LINES = 200
+
+
+def shipping_cost(total_quantity, delivery_option="standard"):
+    if delivery_option == "pickup" or total_quantity <= 0:
+        return 0
+    parcels = -(-total_quantity // PIECES_PER_PARCEL)
+    return parcels * SHIPPING_COST_PER_PARCEL
+
+
+class Cart:
+    """A user's cart lines (with products loaded) and their totals."""
+
+    def __init__(self, items):
+        self.items = items
+        self.count = len(items)
+        self.total_quantity = 0
+        self.total = Decimal("0")
+        for item in items:
+            self.total_quantity += item.quantity
+            self.total += item.product.price * item.quantity
+
+    def __bool__(self):
+        return bool(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return self.count
+
+    def shipping_cost(self, delivery_option="standard"):
+        return shipping_cost(self.total_quantity, delivery_option)
+
+    def stock_issues(self):
+        """Messages for lines that cannot be fulfilled from current stock."""
+        issues = []
+        for item in self.items:
+            product = item.product
+            if not product.is_active:
+                issues.append(f"{product.name} is no longer available")
+            elif item.quantity > product.stock:
+                if product.stock == 0:
+                    issues.append(f"{product.name} is out of stock")
+                else:
+                    issues.append(f"Only {product.stock} {product.name} available (you have {item.quantity} in cart)")
+        return issues
+
+    def to_dict(self):
+        return {
+            "cart_items": [
+                {
+                    "id": item.id,
+                    "product_id": item.product_id,
+                    "name": item.product.name,
+                    "price": float(item.product.price),
+                    "quantity": item.quantity,
+                    "total": float(item.product.price * item.quantity),
+                    "stock": item.product.stock,
+                    "is_active": item.product.is_active,
+                    "image_url": item.product.image_url,
+                }
+                for item in self.items
+            ],
+            "total_quantity": self.total_quantity,
+            "total_amount": float(self.total),
+            "cart_count": self.count,
+            "shipping_cost": self.shipping_cost(),
+        }
+
+
+def load_cart(user_id):
+    """Load a user's cart and its products with a single joined SELECT."""
+    from sqlalchemy.orm import contains_eager
+    from extensions import db
+    from models import CartItem, Product
+
+    items = db.session.execute(
+        db.select(CartItem)
+        .join(Product, CartItem.product_id == Product.id)
+        .options(contains_eager(CartItem.product))
+        .where(CartItem.user_id == user_id)
+        .order_by(CartItem.id)
+    ).scalars().all()
+    return Cart(items)
+
+
+def _summary_key(user_id):
+    return f"cart_summary:{user_id}"
+
+
+def cart_summary(user_id):
+    """Cached {"count", "quantity", "subtotal"} for a user's cart."""
+    from flask import current_app
+    from extensions import cache, db
+    from models import CartItem, Product
+    from replica import use_primary
+
+    key = _summary_key(user_id)
+    summary = cache.get(key)
+    if summary is None:
+        # Cached until the next cart write, so never fill it from a lagging replica
+        with use_primary():
+            row = db.session.execute(
+                db.select(
+                    db.func.count(CartItem.id),
+                    db.func.coalesce(db.func.sum(CartItem.quantity), 0),
+                    db.func.coalesce(db.func.sum(CartItem.quantity * Product.price), 0),
+                )
+                .select_from(CartItem)
+                .join(Product, CartItem.product_id == Product.id)
+                .where(CartItem.user_id == user_id)
+            ).one()
+        summary = {"count": row[0], "quantity": int(row[1]), "subtotal": float(row[2])}
+        cache.set(key, summary, timeout=current_app.config["CART_SUMMARY_TTL"])
+    return summary
+
+
+def invalidate_cart_summary(user_id):
+    from extensions import cache
+
+    cache.delete(_summary_key(user_id))
+
+
+def apply_cart_deltas(user_id, deltas):
+    """
+    Apply many (product_id, quantity delta) changes to a cart at once.
+
+    Stock for every product is checked with one query, then changed and new
+    lines are written with one INSERT ... ON CONFLICT DO UPDATE on the
+    (user_id, product_id) unique index and emptied lines removed with one
+    DELETE. Nothing is written if any line fails validation. Returns a list
+    of error messages (empty on success).
+    """
+    from datetime import datetime
+    from extensions import db
+    from models import CartItem, Product
+
+    changes = {}
+    for product_id, delta in deltas:
+        changes[product_id] = changes.get(product_id, 0) + delta
+    if len(changes) > MAX_BULK_LINES:
+        return [f"At most {MAX_BULK_LINES} products can be changed at once"]
+
+    rows = db.session.execute(
+        db.select(Product.id, Product.name, Product.stock, Product.is_active,
+                  CartItem.id.label("item_id"), CartItem.quantity)
+        .outerjoin(CartItem, (CartItem.product_id == Product.id) & (CartItem.user_id == user_id))
+        .where(Product.id.in_(changes))
+    ).all()
+    found = {row.id: row for row in rows}
+
+    errors = []
+    upserts, deletes = [], []
+    now = datetime.utcnow()
+    for product_id, delta in changes.items():
+        row = found.get(product_id)
+        if row is None:
+            errors.append(f"Product {product_id} not found")
+            continue
+        current = row.quantity or 0
+        quantity = current + delta
+        if quantity <= 0:
+            if row.item_id is not None:
+                deletes.append(row.item_id)
+        elif not row.is_active:
+            errors.append(f"{row.name} is no longer available")
+        elif quantity > row.stock:
+            errors.append(f"Only {row.stock} {row.name} available (you would have {quantity} in cart)")
+        elif quantity != current:
+            upserts.append({"user_id": user_id, "product_id": product_id, "quantity": quantity,
+                            "created_at": now, "updated_at": now})
+    if errors:
+        return errors
+
+    conn = db.session.connection()
+    if upserts:
+        dialect = conn.dialect.name
+        if dialect in ("sqlite", "postgresql"):
+            if dialect == "sqlite":
+                from sqlalchemy.dialects.sqlite import insert
+            else:
+                from sqlalchemy.dialects.postgresql import insert
+            stmt = insert(CartItem).values(upserts)
+            conn.execute(stmt.on_conflict_do_update(
+                index_elements=[CartItem.user_id, CartItem.product_id],
+                set_={"quantity": stmt.excluded.quantity, "updated_at": stmt.excluded.updated_at},
+            ))
+        else:
+            for values in upserts:
+                updated = conn.execute(
+                    db.update(CartItem)
+                    .where(CartItem.user_id == user_id, CartItem.product_id == values["product_id"])
+                    .values(quantity=values["quantity"], updated_at=now)
+                ).rowcount
+                if not updated:
+                    conn.execute(db.insert(CartItem).values(**values))
+    if deletes:
+        conn.execute(db.delete(CartItem).where(CartItem.id.in_(deletes)))
+    db.session.commit()
+    invalidate_cart_summary(user_id)
+    return []
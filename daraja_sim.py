@@ -0,0 +1,204 @@
+"""
+Local stand-in for the Safaricom Daraja API.
+
+Serves the OAuth, STK Push and STK Push Query endpoints and sends the STK
+callback after a delay, so checkout can be exercised and benchmarked without
+the network. Response latency, error rate, declined payments and callback
+delay/loss are set with the DARAJA_SIM_* config keys.
+
+With MPESA_SIMULATOR enabled, DarajaClient routes its requests to a simulator
+inside the process and callbacks are posted straight to the app. The
+daraja-sim command runs it as a separate HTTP server instead.
+"""
+import json
+import math
+import random
+import secrets
+import string
+import threading
+import time
+import uuid
+from datetime import datetime
+from urllib.parse import urlsplit
+
+DEFAULTS = {
+    "DARAJA_SIM_LATENCY_MS": 150,
+    "DARAJA_SIM_LATENCY_SIGMA": 0.5,
+    "DARAJA_SIM_ERROR_RATE": 0.0,
+    "DARAJA_SIM_DECLINE_RATE": 0.1,
+    "DARAJA_SIM_CALLBACK_DELAY": 3.0,
+    "DARAJA_SIM_CALLBACK_DROP_RATE": 0.0,
+}
+
+
+class DarajaSimulator:
+    """
+    In-memory Daraja. Each STK Push draws its outcome up front; the callback
+    reports it after DARAJA_SIM_CALLBACK_DELAY seconds (exponentially
+    distributed) and STK Push Query answers "still processing" until then.
+    """
+
+    def __init__(self, config=None, deliver=None):
+        config = config or {}
+        settings = {key: config.get(key, default) for key, default in DEFAULTS.items()}
+        self.latency_ms = float(settings["DARAJA_SIM_LATENCY_MS"])
+        self.latency_sigma = float(settings["DARAJA_SIM_LATENCY_SIGMA"])
+        self.error_rate = float(settings["DARAJA_SIM_ERROR_RATE"])
+        self.decline_rate = float(settings["DARAJA_SIM_DECLINE_RATE"])
+        self.callback_delay = float(settings["DARAJA_SIM_CALLBACK_DELAY"])
+        self.callback_drop_rate = float(settings["DARAJA_SIM_CALLBACK_DROP_RATE"])
+        self.deliver = deliver or http_deliverer()
+        self._payments = {}
+        self._lock = threading.Lock()
+
+    def latency(self):
+        """Draw a response time in seconds from a log-normal around DARAJA_SIM_LATENCY_MS."""
+        if self.latency_ms <= 0:
+            return 0.0
+        return self.latency_ms / 1000 * math.exp(random.gauss(0, self.latency_sigma))
+
+    def handle(self, method, path, body=None):
+        """Answer one Daraja request. Returns (status_code, json_body)."""
+        time.sleep(self.latency())
+        if random.random() < self.error_rate:
+            return 503, {"errorCode": "503.001.1001", "errorMessage": "Service Unavailable (simulated)"}
+
+        if method == "GET" and path == "/oauth/v1/generate":
+            return 200, {"access_token": secrets.token_hex(14), "expires_in": "3599"}
+        if method == "POST" and path == "/mpesa/stkpush/v1/processrequest":
+            return self._stk_push(body or {})
+        if method == "POST" and path == "/mpesa/stkpushquery/v1/query":
+            return self._stk_query(body or {})
+        if path == "/":
+            return 200, {"simulator": True}
+        return 404, {"errorCode": "404.001.01", "errorMessage": "Resource not found"}
+
+    def _stk_push(self, body):
+        if not body.get("CallBackURL") or not body.get("PhoneNumber"):
+            return 400, {"errorCode": "400.002.02", "errorMessage": "Bad Request - Invalid PhoneNumber"}
+
+        checkout_id = f"ws_CO_{datetime.now():%d%m%Y%H%M%S}{uuid.uuid4().hex[:12]}"
+        merchant_id = f"{random.randint(10000, 99999)}-{random.randint(1000000, 9999999)}-1"
+        declined = random.random() < self.decline_rate
+        delay = random.expovariate(1 / self.callback_delay) if self.callback_delay > 0 else 0
+        payment = {
+            "merchant_id": merchant_id,
+            "result_code": 1032 if declined else 0,
+            "result_desc": "Request cancelled by user" if declined else "The service request is processed successfully.",
+            "amount": body.get("Amount"),
+            "phone": body.get("PhoneNumber"),
+            "receipt": None if declined else "".join(random.choices(string.ascii_uppercase + string.digits, k=10)),
+            "settles_at": time.monotonic() + delay,
+        }
+        with self._lock:
+            self._payments[checkout_id] = payment
+
+        if random.random() >= self.callback_drop_rate:
+            timer = threading.Timer(delay, self._send_callback, args=(body["CallBackURL"], checkout_id))
+            timer.daemon = True
+            timer.start()
+
+        return 200, {
+            "MerchantRequestID": merchant_id,
+            "CheckoutRequestID": checkout_id,
+            "ResponseCode": "0",
+            "ResponseDescription": "Success. Request accepted for processing",
+            "CustomerMessage": "Success. Request accepted for processing",
+        }
+
+    def _stk_query(self, body):
+        with self._lock:
+            payment = self._payments.get(body.get("CheckoutRequestID"))
+        if payment is None:
+            return 500, {"errorCode": "500.001.1001", "errorMessage": "The transaction could not be found"}
+        if time.monotonic() < payment["settles_at"]:
+            return 500, {"errorCode": "500.001.1001", "errorMessage": "The transaction is being processed"}
+        return 200, {
+            "ResponseCode": "0",
+            "ResponseDescription": "The service request has been accepted successfully",
+            "MerchantRequestID": payment["merchant_id"],
+            "CheckoutRequestID": body["CheckoutRequestID"],
+            "ResultCode": str(payment["result_code"]),
+            "ResultDesc": payment["result_desc"],
+        }
+
+    def callback_body(self, checkout_id):
+        with self._lock:
+            payment = self._payments[checkout_id]
+        callback = {
+            "MerchantRequestID": payment["merchant_id"],
+            "CheckoutRequestID": checkout_id,
+            "ResultCode": payment["result_code"],
+            "ResultDesc": payment["result_desc"],
+        }
+        if payment["result_code"] == 0:
+            callback["CallbackMetadata"] = {"Item": [
+                {"Name": "Amount", "Value": payment["amount"]},
+                {"Name": "MpesaReceiptNumber", "Value": payment["receipt"]},
+                {"Name": "TransactionDate", "Value": int(datetime.now().strftime("%Y%m%d%H%M%S"))},
+                {"Name": "PhoneNumber", "Value": int(payment["phone"])},
+            ]}
+        return {"Body": {"stkCallback": callback}}
+
+    def _send_callback(self, url, checkout_id):
+        try:
+            self.deliver(url, self.callback_body(checkout_id))
+        except Exception as e:
+            print(f"Simulated callback for {checkout_id} failed: {e}")
+
+
+def http_deliverer(timeout=10):
+    """Post callbacks over HTTP, as Safaricom does."""
+    def deliver(url, body):
+        import requests
+        requests.post(url, json=body, timeout=timeout)
+    return deliver
+
+
+def inprocess_deliverer(app):
+    """Post callbacks to the app's own URL map without going through the network."""
+    def deliver(url, body):
+        app.test_client().post(urlsplit(url).path, json=body)
+    return deliver
+
+
+def simulator_adapter(simulator):
+    """A requests transport adapter that answers from the simulator instead of the network."""
+    from requests.adapters import BaseAdapter
+    from requests.models import Response
+    from requests.structures import CaseInsensitiveDict
+
+    class SimulatorAdapter(BaseAdapter):
+        def send(self, request, **kwargs):
+            body = request.body
+            if isinstance(body, bytes):
+                body = body.decode("utf-8")
+            status, data = simulator.handle(request.method, urlsplit(request.url).path, json.loads(body) if body else None)
+            response = Response()
+            response.status_code = status
+            response._content = json.dumps(data).encode("utf-8")
+            response.headers = CaseInsensitiveDict({"Content-Type": "application/json"})
+            response.encoding = "utf-8"
+            response.url = request.url
+            response.request = request
+            return response
+
+        def close(self):
+            pass
+
+    return SimulatorAdapter()
+
+
+def create_simulator_app(simulator):
+    """Wrap a simulator in a Flask app so it can be served on its own port."""
+    from flask import Flask, jsonify, request
+
+    sim_app = Flask("daraja_sim")
+
+    @sim_app.route("/", defaults={"path": ""}, methods=["GET", "POST"])
+    @sim_app.route("/<path:path>", methods=["GET", "POST"])
+    def daraja(path):
+        status, data = simulator.handle(request.method, "/" + path, request.get_json(silent=True))
+        return jsonify(data), status
+
+    return sim_app
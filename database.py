@@ -0,0 +1,153 @@
+"""
+Database engine bootstrap.
+
+database_uri() reads DATABASE_URL (the SQLite file otherwise),
+engine_options() picks pool settings for its backend, and init_app()
+installs a connect hook that applies SQLITE_PRAGMAS to every new SQLite
+connection. worker_class(), worker_count() and thread_count() describe the
+gunicorn workers sharing the database, as gunicorn_config.py starts them. WAL lets readers run alongside the single writer,
+synchronous=NORMAL is durable enough under WAL, and busy_timeout makes a
+blocked writer wait for the lock instead of failing with "database is
+locked".
+"""
+import os
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool, StaticPool
+
+WORKER_CLASSES = ("gthread", "gevent", "sync")
+
+# Server connections left out of the per-worker pools, for psql, migrations and cron jobs
+RESERVED_CONNECTIONS = 10
+
+# Threads in every worker that use the database besides the request and STK Push job
+# threads: the callback processor and the reservation sweeper
+BACKGROUND_THREADS = 2
+
+# Applied in this order on every new SQLite connection
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,  # ms
+    "cache_size": -64000,  # negative = KiB, so 64 MB per connection
+    "mmap_size": 268435456,  # 256 MB of the file read through the page cache
+    "temp_store": "MEMORY",
+}
+
+
+def database_uri(database_url, sqlite_path):
+    """DATABASE_URL if set, else the SQLite file. Bare postgres:// URLs (as Render gives them) use psycopg2."""
+    if not database_url:
+        return f"sqlite:///{sqlite_path}"
+    for scheme in ("postgres://", "postgresql://"):
+        if database_url.startswith(scheme):
+            return "postgresql+psycopg2://" + database_url[len(scheme):]
+    return database_url
+
+
+def worker_class():
+    """Gunicorn worker class from GUNICORN_WORKER_CLASS: gthread (default), gevent or sync."""
+    name = os.getenv("GUNICORN_WORKER_CLASS") or "gthread"
+    if name not in WORKER_CLASSES:
+        raise ValueError(f"GUNICORN_WORKER_CLASS must be one of {', '.join(WORKER_CLASSES)}, not {name!r}")
+    return name
+
+
+def worker_count():
+    """Gunicorn worker processes. Threaded and gevent workers serve many requests each, so fewer are started."""
+    per_cpu = 2 if worker_class() == "sync" else 1
+    return int(os.getenv("WEB_CONCURRENCY") or (os.cpu_count() or 1) * per_cpu + 1)
+
+
+def thread_count():
+    """Request threads per gthread worker (GUNICORN_THREADS); the other worker classes run one."""
+    if worker_class() != "gthread":
+        return 1
+    return int(os.getenv("GUNICORN_THREADS") or 8)
+
+
+def is_sqlite(uri):
+    return make_url(uri).get_backend_name() == "sqlite"
+
+
+def engine_options(uri, pool_size=None, workers=1, threads=1, max_connections=100, statement_timeout=None):
+    """
+    SQLALCHEMY_ENGINE_OPTIONS suited to the backend of uri.
+
+    threads is the number of threads in a worker that may hold a connection
+    at once (request, job and background threads). For a server database,
+    unless pool_size is given, each worker keeps one connection per thread
+    and overflows into the rest of its share of max_connections, less
+    RESERVED_CONNECTIONS, so the pools of all workers together stay within
+    it; when that share is smaller than threads, the pool is capped at the
+    share (see pool_shortfall()). A SQLite pool holds at least one
+    connection per thread. statement_timeout (ms) cancels runaway queries on
+    PostgreSQL.
+    """
+    url = make_url(uri)
+    if url.get_backend_name() == "sqlite":
+        if url.database in (None, "", ":memory:"):
+            # One shared connection, or every thread would see its own empty database
+            return {"poolclass": StaticPool, "connect_args": {"check_same_thread": False}}
+        # Opening a file is cheap and cannot go stale, so no pre-ping or recycling;
+        # the pool just caps open handles per worker
+        pool_size = pool_size or max(10, threads)
+        return {
+            "poolclass": QueuePool,
+            "pool_size": pool_size,
+            "max_overflow": pool_size,
+            "connect_args": {"check_same_thread": False},
+        }
+
+    if pool_size:
+        max_overflow = pool_size
+    else:
+        # Overflow covers a thread briefly holding a second connection (e.g. a lease
+        # taken while its session is open); every worker at full overflow still fits
+        per_worker = max(1, (max_connections - RESERVED_CONNECTIONS) // max(workers, 1))
+        pool_size = min(max(1, threads), per_worker)
+        max_overflow = per_worker - pool_size
+    options = {
+        "poolclass": QueuePool,
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_timeout": 10,
+        "pool_recycle": 1800,
+        "pool_pre_ping": True,
+    }
+    if url.get_backend_name() == "postgresql" and statement_timeout:
+        options["connect_args"] = {"options": f"-c statement_timeout={int(statement_timeout)}"}
+    return options
+
+
+def pool_shortfall(options, threads):
+    """How many of threads may wait for a connection from a pool built with options (0 if none)."""
+    if "pool_size" not in options:
+        return 0
+    return max(0, threads - options["pool_size"] - options["max_overflow"])
+
+
+def apply_sqlite_pragmas(engine, pragmas=None):
+    """Run the PRAGMAs on each connection the engine opens."""
+    pragmas = dict(SQLITE_PRAGMAS if pragmas is None else pragmas)
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+        finally:
+            cursor.close()
+
+
+def init_app(app):
+    """Install the SQLite connect hook on the app's engines. Call after db.init_app(app)."""
+    from extensions import db
+
+    pragmas = {**SQLITE_PRAGMAS, **app.config.get("SQLITE_PRAGMAS", {})}
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == "sqlite":
+                apply_sqlite_pragmas(engine, pragmas)
@@ -0,0 +1,101 @@
+"""
+Copy every table from one database into another, e.g. shifaa.db into PostgreSQL.
+
+Tables are created on the target from the models, then copied parent before
+child. Rows are read from the source in batches with yield_per and written
+with COPY ... FROM STDIN on PostgreSQL (an executemany INSERT elsewhere), so
+neither side holds a whole table in memory. Afterwards id sequences are moved
+past the copied ids and row counts are compared table by table.
+"""
+import csv
+import io
+import time
+
+NULL = r"\N"
+
+
+def _copy_batch_postgres(raw_connection, table, columns, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        # An unquoted \N is NULL; empty strings stay empty strings
+        writer.writerow([NULL if value is None else value for value in row])
+    buffer.seek(0)
+    column_list = ", ".join(f'"{name}"' for name in columns)
+    with raw_connection.cursor() as cursor:
+        cursor.copy_expert(
+            f'COPY "{table.name}" ({column_list}) FROM STDIN WITH (FORMAT csv, NULL \'{NULL}\')', buffer
+        )
+
+
+def _reset_sequences(conn, table):
+    from sqlalchemy import Integer, text
+
+    for column in table.primary_key.columns:
+        if isinstance(column.type, Integer) and column.autoincrement in (True, "auto"):
+            conn.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('\"{table.name}\"', '{column.name}'), "
+                f"COALESCE((SELECT MAX(\"{column.name}\") FROM \"{table.name}\"), 0) + 1, false)"
+            ))
+
+
+def copy_database(source_uri, target_uri, batch_size=5000, truncate=False):
+    """
+    Copy all model tables from source_uri to target_uri and verify row counts.
+
+    Refuses to write into a non-empty target table unless truncate is set.
+    Returns a report with per-table source/target counts and an "ok" flag.
+    """
+    from sqlalchemy import create_engine, func, select
+    from extensions import db
+    import models  # noqa: F401 - registers every table on db.metadata
+
+    source = create_engine(source_uri)
+    target = create_engine(target_uri)
+    tables = db.metadata.sorted_tables
+    use_copy = target.dialect.name == "postgresql"
+
+    db.metadata.create_all(target)
+    with target.begin() as conn:
+        occupied = [t.name for t in tables if conn.execute(select(func.count()).select_from(t)).scalar()]
+        if occupied and not truncate:
+            raise RuntimeError(f"Target tables are not empty: {', '.join(occupied)} (use --truncate)")
+        for table in reversed(tables):
+            conn.execute(table.delete())
+
+    report = {"tables": {}, "ok": True}
+    started = time.perf_counter()
+    for table in tables:
+        columns = [column.name for column in table.columns]
+        table_started = time.perf_counter()
+        copied = 0
+        with source.connect() as src:
+            result = src.execution_options(yield_per=batch_size).execute(select(table))
+            # One transaction per table: a failed table leaves nothing half-copied
+            with target.begin() as conn:
+                raw = conn.connection.dbapi_connection if use_copy else None
+                for rows in result.partitions():
+                    if use_copy:
+                        _copy_batch_postgres(raw, table, columns, rows)
+                    else:
+                        conn.execute(table.insert(), [dict(zip(columns, row)) for row in rows])
+                    copied += len(rows)
+                if use_copy:
+                    _reset_sequences(conn, table)
+
+        with source.connect() as src, target.connect() as dst:
+            source_count = src.execute(select(func.count()).select_from(table)).scalar()
+            target_count = dst.execute(select(func.count()).select_from(table)).scalar()
+        matches = source_count == target_count == copied
+        report["tables"][table.name] = {
+            "source": source_count,
+            "target": target_count,
+            "seconds": round(time.perf_counter() - table_started, 2),
+            "ok": matches,
+        }
+        report["ok"] = report["ok"] and matches
+
+    report["seconds"] = round(time.perf_counter() - started, 2)
+    source.dispose()
+    target.dispose()
+    return report
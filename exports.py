@@ -0,0 +1,148 @@
+"""
+Streaming order exports.
+
+Rows are read with yield_per, so the driver hands them over in batches (a
+server-side cursor on PostgreSQL) and each batch is written out before the
+next is fetched. The response body is a generator, so memory stays flat
+however many orders match, and gzip is applied chunk by chunk when the
+client accepts it.
+"""
+import csv
+import io
+import json
+import zlib
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+BATCH_SIZE = 1000
+FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+
+def order_filters(args):
+    """WHERE clauses for the date_from, date_to, status and delivered_only parameters of the admin pages."""
+    from models import Order
+
+    filters = []
+    status = "delivered" if args.get("delivered_only") == "on" else args.get("status", "").strip()
+    if status:
+        filters.append(Order.status == status)
+    try:
+        filters.append(Order.created_at >= datetime.strptime(args.get("date_from", "").strip(), "%Y-%m-%d"))
+    except ValueError:
+        pass
+    try:
+        end_of_day = datetime.strptime(args.get("date_to", "").strip(), "%Y-%m-%d") + timedelta(days=1)
+        filters.append(Order.created_at < end_of_day)
+    except ValueError:
+        pass
+    return filters
+
+
+def orders_query(filters):
+    from extensions import db
+    from models import Order, User
+
+    return (
+        db.select(
+            Order.order_number,
+            Order.created_at,
+            Order.status,
+            Order.payment_status,
+            Order.mpesa_receipt,
+            User.name.label("customer"),
+            User.email,
+            Order.delivery_option,
+            Order.item_count,
+            Order.total_quantity,
+            Order.total_amount,
+        )
+        .select_from(Order)
+        .outerjoin(User, Order.user_id == User.id)
+        .where(*filters)
+        .order_by(Order.id)
+    )
+
+
+def order_items_query(filters):
+    from extensions import db
+    from models import Order, OrderItem, Product
+
+    return (
+        db.select(
+            Order.order_number,
+            Order.created_at,
+            Order.status,
+            OrderItem.product_id,
+            Product.name.label("product"),
+            OrderItem.quantity,
+            OrderItem.price,
+            (OrderItem.price * OrderItem.quantity).label("line_total"),
+        )
+        .select_from(OrderItem)
+        .join(Order, OrderItem.order_id == Order.id)
+        .outerjoin(Product, OrderItem.product_id == Product.id)
+        .where(*filters)
+        .order_by(OrderItem.id)
+    )
+
+
+EXPORTS = {"orders": orders_query, "order-items": order_items_query}
+
+
+def _json_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def generate_export(query, fmt="csv", compress=False, batch_size=BATCH_SIZE):
+    """Yield the encoded (and optionally gzipped) export one batch of rows at a time."""
+    from extensions import db
+
+    result = db.session.execute(query.execution_options(yield_per=batch_size))
+    columns = list(result.keys())
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if compress else None
+
+    def drain():
+        data = buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+        return compressor.compress(data) if compressor else data
+
+    if fmt == "csv":
+        writer.writerow(columns)
+    for rows in result.partitions():
+        if fmt == "csv":
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                buffer.write(json.dumps(dict(zip(columns, row)), default=_json_value))
+                buffer.write("\n")
+        chunk = drain()
+        if chunk:
+            yield chunk
+    tail = drain()
+    if compressor:
+        tail += compressor.flush()
+    if tail:
+        yield tail
+
+
+def export_response(kind, args, accept_encoding):
+    """Streaming download of an export ("orders" or "order-items") filtered by the request args."""
+    from flask import Response, stream_with_context
+
+    fmt = args.get("format", "csv")
+    if fmt not in FORMATS:
+        fmt = "csv"
+    compress = "gzip" in (accept_encoding or "")
+    filename = f"{kind}-{datetime.utcnow():%Y%m%d-%H%M%S}.{fmt}"
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"', "Vary": "Accept-Encoding"}
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+    body = generate_export(EXPORTS[kind](order_filters(args)), fmt, compress)
+    return Response(stream_with_context(body), mimetype=FORMATS[fmt], headers=headers)
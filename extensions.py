@@ -1,12 +1,28 @@
+from flask_caching import Cache
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 
+from callbacks import CallbackProcessor
+from jobs import JobQueue
+from mpesa import DarajaClient, MpesaTokenManager
+from order_numbers import OrderNumberGenerator
+from payment_store import PaymentStore
+from replica import ReplicaRouter, RoutingSession
+from reservations import ReservationSweeper
+from sales import SalesRollup
+from stats import DashboardStats
+
 # Single shared instances for the whole app
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 login_manager = LoginManager()
-
-
-
-
-
-
+cache = Cache()
+payment_store = PaymentStore()
+daraja = DarajaClient()
+mpesa_tokens = MpesaTokenManager()
+job_queue = JobQueue()
+callback_processor = CallbackProcessor()
+reservation_sweeper = ReservationSweeper()
+order_numbers = OrderNumberGenerator()
+dashboard_stats = DashboardStats()
+sales_rollup = SalesRollup()
+replica_router = ReplicaRouter()
@@ -2,16 +2,46 @@
 Gunicorn configuration for Render deployment
 """
 import os
-import multiprocessing
+import time
+
+# when_ready reports the time from here to a preloaded app, i.e. the master's cold start
+CONFIG_LOADED_AT = time.monotonic()
+
+if os.getenv("GUNICORN_WORKER_CLASS") == "gevent":
+    # Patch before the app is imported: preload_app loads it in the master, and requests/urllib3
+    # must bind to the cooperative socket, ssl and threading modules or calls to Daraja block the hub
+    try:
+        from gevent import monkey
+    except ImportError:
+        raise RuntimeError("GUNICORN_WORKER_CLASS=gevent requires the 'gevent' package") from None
+
+    monkey.patch_all()
+    try:
+        from psycogreen.gevent import patch_psycopg
+    except ImportError:
+        pass  # psycopg2 queries then block their worker; SQLite always does
+    else:
+        patch_psycopg()
+
+import database  # noqa: E402
 
 # Server socket
 bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
 
 # Worker processes
-workers = multiprocessing.cpu_count() * 2 + 1
-worker_class = "sync"
-worker_connections = 1000
-timeout = 30
+# GUNICORN_WORKER_CLASS picks the profile: gthread (default, GUNICORN_THREADS request threads per
+# worker), gevent (worker_connections greenlets per worker) or sync (one request per worker).
+# WEB_CONCURRENCY overrides the worker count; database.py sizes each worker's connection pool from
+# the same numbers. Use `flask tune-workers` to find the best combination for a machine.
+worker_class = database.worker_class()
+workers = database.worker_count()
+threads = database.thread_count()
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 1000))
+# gthread and gevent workers heartbeat independently of their requests, so a slow Daraja call or a
+# payment long-poll only occupies a thread or greenlet. A sync worker is silent for the whole request,
+# so its timeout must outlast the M-Pesa read timeout and retries.
+timeout = int(os.environ.get("GUNICORN_TIMEOUT") or (120 if worker_class == "sync" else 30))
+graceful_timeout = 60
 keepalive = 2
 
 # Logging
@@ -30,3 +60,36 @@ preload_app = True
 max_requests = 1000
 max_requests_jitter = 50
 
+
+# Server hooks
+def when_ready(server):
+    """Report how long the master took to preload the app"""
+    server.log.info("Application loaded in %.0f ms", (time.monotonic() - CONFIG_LOADED_AT) * 1000)
+
+
+def pre_fork(server, worker):
+    worker.boot_started = time.monotonic()
+
+
+def post_worker_init(worker):
+    """Report how long a new or recycled worker took from fork to accepting requests"""
+    worker.log.info("Worker %s booted in %.1f ms", worker.pid, (time.monotonic() - worker.boot_started) * 1000)
+
+
+def post_fork(server, worker):
+    """Drop database connections inherited from the master, then start applying journalled M-Pesa callbacks, including any a recycled worker left behind, and sweeping expired stock holds"""
+    from extensions import callback_processor, db, reservation_sweeper
+    if callback_processor.app is not None:
+        with callback_processor.app.app_context():
+            # preload_app opened these in the master; a SQLite handle must not cross a fork
+            db.engine.dispose(close=False)
+        callback_processor.start()
+    if reservation_sweeper.app is not None:
+        reservation_sweeper.start()
+
+
+def worker_exit(server, worker):
+    """Let queued STK Push jobs finish before a worker exits or is recycled, then free its order number node id"""
+    from extensions import job_queue, order_numbers
+    job_queue.shutdown()
+    order_numbers.release()
@@ -0,0 +1,101 @@
+"""
+Bounded background job queue for slow outbound calls.
+
+Request handlers hand work (such as sending an STK Push) to a small thread
+pool and return immediately, so a slow upstream API cannot tie up every
+gunicorn worker. The queue refuses new jobs when full instead of growing
+without limit, and drains in-flight jobs when the worker shuts down.
+"""
+import atexit
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JobQueue:
+    """Runs jobs on a per-process thread pool with a hard cap on queued work."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.max_workers = 4
+        self.max_pending = 50
+        self.job_timeout = 45
+        self._executor = None
+        self._executor_pid = None
+        self._slots = None
+        self._lock = threading.Lock()
+        self._accepting = True
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("JOB_QUEUE_WORKERS", 4)
+        app.config.setdefault("JOB_QUEUE_MAX_PENDING", 50)
+        app.config.setdefault("JOB_TIMEOUT", 45)
+        self.app = app
+        self.max_workers = int(app.config["JOB_QUEUE_WORKERS"])
+        self.max_pending = int(app.config["JOB_QUEUE_MAX_PENDING"])
+        self.job_timeout = float(app.config["JOB_TIMEOUT"])
+        app.extensions["job_queue"] = self
+        atexit.register(self.shutdown)
+
+    def _get_executor(self):
+        # Thread pools do not survive a fork, so each worker builds its own
+        if self._executor is None or self._executor_pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._executor_pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="job")
+                    self._executor_pid = os.getpid()
+                    self._slots = threading.BoundedSemaphore(self.max_pending)
+                    self._accepting = True
+        return self._executor
+
+    def submit(self, fn, *args, on_timeout=None):
+        """
+        Queue fn(*args, deadline=...) to run in the background.
+
+        Returns False without queueing when the queue is full or shutting down.
+        deadline is a time.monotonic() value the job must finish by; jobs still
+        waiting when it passes are skipped and on_timeout(*args) is called.
+        """
+        executor = self._get_executor()
+        if not self._accepting or not self._slots.acquire(blocking=False):
+            return False
+        deadline = time.monotonic() + self.job_timeout
+        try:
+            executor.submit(self._run, fn, args, deadline, on_timeout)
+        except RuntimeError:
+            self._slots.release()
+            return False
+        return True
+
+    def _run(self, fn, args, deadline, on_timeout):
+        try:
+            with self.app.app_context():
+                if time.monotonic() >= deadline:
+                    if on_timeout is not None:
+                        on_timeout(*args)
+                    return
+                fn(*args, deadline=deadline)
+        except Exception as e:
+            print(f"Background job {getattr(fn, '__name__', fn)} failed: {e}")
+        finally:
+            self._slots.release()
+
+    def pending(self):
+        """Number of queued or running jobs in this process."""
+        if self._slots is None or self._executor_pid != os.getpid():
+            return 0
+        return self.max_pending - self._slots._value
+
+    def shutdown(self, timeout=None):
+        """Stop accepting jobs and wait up to timeout seconds for queued ones to finish."""
+        if self._executor is None or self._executor_pid != os.getpid():
+            return
+        self._accepting = False
+        timeout = self.job_timeout if timeout is None else timeout
+        end = time.monotonic() + timeout
+        while self.pending() and time.monotonic() < end:
+            time.sleep(0.05)
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,1314 @@
+"""
+Load, stress and benchmark scenarios behind the CLI commands.
+
+The checkout scenario has each simulated shopper log in, check out its cart,
+call /initiate-stk-push and poll /check-payment-status until the callback
+settles the payment. Run it in process against an app using the Daraja
+simulator, or over HTTP against a running server (itself pointed at the
+simulator); either way the shoppers come from _seed_shoppers().
+"""
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+def summarize(samples):
+    """Latency summary in milliseconds."""
+    return {
+        "count": len(samples),
+        "p50_ms": round(percentile(samples, 50) * 1000, 1),
+        "p99_ms": round(percentile(samples, 99) * 1000, 1),
+        "max_ms": round(max(samples, default=0) * 1000, 1),
+    }
+
+
+class _HttpClient:
+    def __init__(self, base_url):
+        import requests
+
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+
+    def post(self, path, payload):
+        response = self.session.post(self.base_url + path, json=payload, timeout=60)
+        return response.status_code, response.json()
+
+    def form(self, path, data):
+        return self.session.post(self.base_url + path, data=data, allow_redirects=False, timeout=60).status_code
+
+
+class _AppClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def post(self, path, payload):
+        response = self.client.post(path, json=payload)
+        return response.status_code, response.get_json()
+
+    def form(self, path, data):
+        return self.client.post(path, data=data).status_code
+
+
+@contextmanager
+def scratch_app(database_url=None, env=None):
+    """
+    Yield an app on a throwaway database with an up-to-date schema.
+
+    database_url must not be the configured DATABASE_URL and must not hold
+    any orders; without one a new SQLite file in a temporary directory is
+    used and removed afterwards. The cache lives in the temporary directory
+    too, away from the app's shared CACHE_DIR. env sets extra environment
+    variables (read by create_app) while the app is created.
+    """
+    import shutil
+    import tempfile
+    from app import create_app
+    from database import database_uri
+    from extensions import db
+    from schema import upgrade_schema
+
+    configured = os.getenv("DATABASE_URL")
+    if database_url and configured and database_uri(database_url, None) == database_uri(configured, None):
+        raise RuntimeError("Refusing to use the configured DATABASE_URL as a scratch database")
+    workdir = tempfile.mkdtemp(prefix="shifaa-scratch-")
+    if database_url is None:
+        database_url = f"sqlite:///{os.path.join(workdir, 'scratch.db')}"
+
+    overrides = {
+        "DATABASE_URL": database_url,
+        "DATABASE_REPLICA_URL": "",
+        "CACHE_DIR": os.path.join(workdir, "cache"),
+        **(env or {}),
+    }
+    saved = {name: os.environ.get(name) for name in overrides}
+    os.environ.update(overrides)
+    try:
+        app = create_app()
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+    try:
+        with app.app_context():
+            from models import Order
+
+            if db.inspect(db.engine).has_table(Order.__tablename__) and db.session.query(Order.id).first():
+                raise RuntimeError(f"{database_url} already has orders; pass an empty scratch database")
+            upgrade_schema()
+        yield app
+    finally:
+        with app.app_context():
+            db.session.remove()
+            for engine in db.engines.values():
+                engine.dispose()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+SHOPPER_PASSWORD = "loadtest"
+
+
+def _seed_shoppers(app, count):
+    """Add count shoppers, each with one catalog product in the cart; returns their emails."""
+    from werkzeug.security import generate_password_hash
+    from extensions import db
+    from models import CartItem, Product, User
+
+    # A cheap hash keeps logging in from dominating the measurements
+    password_hash = generate_password_hash(SHOPPER_PASSWORD, method="pbkdf2:sha256:1000")
+    with app.app_context():
+        product_id = db.session.execute(
+            db.select(Product.id).where(Product.is_active.is_(True)).order_by(Product.id)
+        ).scalar()
+        if product_id is None:
+            raise RuntimeError("Seed the catalog before the shoppers")
+        shoppers = [
+            User(name=f"Bench shopper {i}", email=f"shopper-{i}@bench.invalid", role="user",
+                 phone="254712345678", password_hash=password_hash)
+            for i in range(count)
+        ]
+        db.session.add_all(shoppers)
+        db.session.flush()
+        db.session.add_all([CartItem(user_id=user.id, product_id=product_id, quantity=1) for user in shoppers])
+        db.session.commit()
+        return [user.email for user in shoppers]
+
+
+def run_checkout_scenario(app=None, base_url=None, shoppers=(), checkouts=100, concurrency=10,
+                          poll_interval=0.25, timeout=60, phone="254712345678"):
+    """
+    Drive checkouts through initiate -> callback -> status and report throughput and latency.
+
+    Pass either app (in process) or base_url (over HTTP), and the emails of
+    shoppers seeded with _seed_shoppers(); each client thread logs in as the
+    next one and checks out its cart before requesting pushes.
+    """
+    if not shoppers:
+        raise ValueError("run_checkout_scenario needs seeded shoppers")
+    local = threading.local()
+    lock = threading.Lock()
+    next_shopper = itertools.count()
+    latencies = {"initiate": [], "status_poll": [], "end_to_end": []}
+    outcomes = {"completed": 0, "failed": 0, "rejected": 0, "timed_out": 0, "errors": 0}
+
+    def client():
+        if not hasattr(local, "client"):
+            local.client = _HttpClient(base_url) if base_url else _AppClient(app)
+            with lock:
+                email = shoppers[next(next_shopper) % len(shoppers)]
+            local.client.form("/login", {"email": email, "password": SHOPPER_PASSWORD})
+            local.client.form("/checkout", {
+                "shipping_address": "Load test", "delivery_option": "pickup", "contact_name": "Load test",
+                "contact_email": email, "contact_phone": phone,
+            })
+        return local.client
+
+    def record(outcome, **samples):
+        with lock:
+            outcomes[outcome] += 1
+            for name, values in samples.items():
+                latencies[name].extend(values)
+
+    def checkout(_):
+        start = time.perf_counter()
+        try:
+            code, data = client().post("/initiate-stk-push", {"phone_number": phone})
+            initiated = time.perf_counter()
+            if code == 503:
+                return record("rejected", initiate=[initiated - start])
+            if not data.get("success"):
+                return record("errors", initiate=[initiated - start])
+
+            polls = []
+            deadline = start + timeout
+            status = "pending"
+            while status == "pending" and time.perf_counter() < deadline:
+                time.sleep(poll_interval)
+                poll_start = time.perf_counter()
+                _, result = client().post("/check-payment-status", {"checkout_request_id": data["checkout_request_id"]})
+                polls.append(time.perf_counter() - poll_start)
+                status = result.get("status")
+
+            finished = time.perf_counter()
+            if status == "pending":
+                return record("timed_out", initiate=[initiated - start], status_poll=polls)
+            outcome = "completed" if status == "completed" else "failed"
+            record(outcome, initiate=[initiated - start], status_poll=polls, end_to_end=[finished - start])
+        except Exception as e:
+            print(f"Checkout failed: {e}")
+            record("errors")
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(checkout, range(checkouts)))
+    elapsed = time.perf_counter() - started
+
+    settled = outcomes["completed"] + outcomes["failed"]
+    return {
+        "checkouts": checkouts,
+        "concurrency": concurrency,
+        **outcomes,
+        "elapsed_s": round(elapsed, 2),
+        "throughput_per_s": round(settled / elapsed, 2) if elapsed else 0.0,
+        "latency": {name: summarize(samples) for name, samples in latencies.items()},
+    }
+
+
+def run_queued_payment_check(database_url=None, timeout=10):
+    """
+    Check that orders confirmed before their STK Push job ran still settle.
+
+    On a scratch database with the Daraja simulator, a shopper confirms an
+    order with the job id while the job is still queued; then the job sends
+    the push, the simulated callback is journalled and the callback
+    processor runs. That order must end up paid under Safaricom's
+    CheckoutRequestID. A second order, whose job expired in the queue, must
+    be failed by reconciliation rather than stay pending for ever.
+    """
+    import uuid
+    from datetime import datetime, timedelta
+    from extensions import callback_processor, db, payment_store
+    from models import CartItem, MpesaCallback, Order, Product, User
+    from mpesa import JOB_ID_PREFIX, expire_stk_push, send_stk_push
+    from reconcile import reconcile_pending_payments
+
+    env = {
+        "MPESA_SIMULATOR": "true",
+        "DARAJA_SIM_LATENCY_MS": "0",
+        "DARAJA_SIM_ERROR_RATE": "0",
+        "DARAJA_SIM_DECLINE_RATE": "0",
+        "DARAJA_SIM_CALLBACK_DELAY": "0",
+        "DARAJA_SIM_CALLBACK_DROP_RATE": "0",
+        "DARAJA_SIM_CALLBACK_MODE": "inprocess",
+        "PAYMENT_STORE": "database",
+    }
+    with scratch_app(database_url, env) as app:
+        with app.app_context():
+            product = Product(name="Queued payment check", price=100, stock=10, is_active=True)
+            user = User(name="Queued payment check", email="queued-check@example.invalid", role="user", password_hash="!")
+            db.session.add_all([product, user])
+            db.session.commit()
+            product_id, user_id = product.id, user.id
+
+        client = app.test_client()
+
+        def confirm(job_id):
+            """Confirm an order on the payment page with the job id, as the page posts it."""
+            with app.app_context():
+                payment_store.set(job_id, "pending", owner=user_id, amount=100)
+                db.session.add(CartItem(user_id=user_id, product_id=product_id, quantity=1))
+                db.session.commit()
+            with client.session_transaction() as session:
+                session["_user_id"] = str(user_id)
+                session["_fresh"] = True
+                session["checkout_info"] = {"shipping_address": "Queued payment check", "delivery_option": "pickup"}
+            response = client.post("/payment", data={"checkout_request_id": job_id})
+            if response.status_code != 302:
+                raise RuntimeError(f"POST /payment returned {response.status_code}")
+            with app.app_context():
+                return db.session.execute(db.select(Order.id).order_by(Order.id.desc())).scalar()
+
+        def order(order_id):
+            with app.app_context():
+                row = db.session.get(Order, order_id)
+                return {"checkout_request_id": row.checkout_request_id, "payment_status": row.payment_status}
+
+        payload = {
+            "BusinessShortCode": app.config["MPESA_SHORTCODE"],
+            "TransactionType": "CustomerBuyGoodsOnline",
+            "Amount": 100,
+            "PartyA": "254712345678",
+            "PartyB": app.config["MPESA_SHORTCODE"],
+            "PhoneNumber": "254712345678",
+            "CallBackURL": "http://localhost/callback",
+            "AccountReference": "ShifaaHerbal",
+            "TransactionDesc": "Queued payment check",
+        }
+
+        paid_job = f"{JOB_ID_PREFIX}{uuid.uuid4().hex}"
+        paid_order = confirm(paid_job)
+        confirmed = order(paid_order)
+        with app.app_context():
+            send_stk_push(paid_job, payload, time.monotonic() + timeout)
+            checkout_request_id = payment_store.resolve(paid_job)
+            deadline = time.monotonic() + timeout
+            while time.monotonic() < deadline and not db.session.execute(
+                db.select(MpesaCallback.id).where(MpesaCallback.checkout_request_id == checkout_request_id)
+            ).first():
+                db.session.rollback()
+                time.sleep(0.05)
+            callback_processor.process_pending()
+        settled = order(paid_order)
+
+        expired_job = f"{JOB_ID_PREFIX}{uuid.uuid4().hex}"
+        expired_order = confirm(expired_job)
+        with app.app_context():
+            expire_stk_push(expired_job, payload)
+            # Reconciliation only looks at orders older than its cutoff
+            db.session.execute(
+                db.update(Order).where(Order.id == expired_order)
+                .values(created_at=datetime.utcnow() - timedelta(hours=1))
+            )
+            db.session.commit()
+            reconciled = reconcile_pending_payments(older_than=10)
+        expired = order(expired_order)
+
+    return {
+        "confirmed_with": confirmed,
+        "after_callback": settled,
+        "expired_job_after_reconcile": expired,
+        "reconcile": reconciled,
+        "ok": (
+            confirmed["checkout_request_id"] == paid_job
+            and settled == {"checkout_request_id": checkout_request_id, "payment_status": "paid"}
+            and checkout_request_id != paid_job
+            and expired["payment_status"] == "failed"
+        ),
+    }
+
+
+def run_payment_guard_check(database_url=None):
+    """
+    Check that an order is only paid by an STK Push its shopper made for its total.
+
+    On a scratch database two shoppers each confirm a KES 5000 order on the
+    payment page. The page must refuse a push requested for KES 1, a push
+    requested by the other shopper and a push that is already linked to an
+    order; and a successful callback for KES 1 on a properly linked order
+    must leave it underpaid, not paid.
+    """
+    import uuid
+    from extensions import callback_processor, db, payment_store
+    from models import CartItem, Order, Product, User
+    from mpesa import JOB_ID_PREFIX
+
+    with scratch_app(database_url, {"PAYMENT_STORE": "database"}) as app:
+        with app.app_context():
+            product = Product(name="Payment guard check", price=5000, stock=10, is_active=True)
+            shopper = User(name="Payment guard check", email="guard-check@example.invalid", role="user", password_hash="!")
+            other = User(name="Payment guard other", email="guard-other@example.invalid", role="user", password_hash="!")
+            db.session.add_all([product, shopper, other])
+            db.session.commit()
+            product_id, user_id, other_id = product.id, shopper.id, other.id
+
+        client = app.test_client()
+
+        def push(owner, amount, checkout_request_id=None):
+            """An STK Push job as /initiate-stk-push records it, optionally already answered by Safaricom."""
+            job_id = f"{JOB_ID_PREFIX}{uuid.uuid4().hex}"
+            with app.app_context():
+                payment_store.set(job_id, "pending", reference=checkout_request_id, owner=owner, amount=amount)
+            return job_id
+
+        def confirm(job_id):
+            """Confirm the shopper's cart on the payment page; returns the new order id or None."""
+            with app.app_context():
+                if not db.session.execute(db.select(CartItem.id).where(CartItem.user_id == user_id)).first():
+                    db.session.add(CartItem(user_id=user_id, product_id=product_id, quantity=1))
+                    db.session.commit()
+                before = db.session.execute(db.select(db.func.max(Order.id))).scalar()
+            with client.session_transaction() as session:
+                session["_user_id"] = str(user_id)
+                session["_fresh"] = True
+                session["checkout_info"] = {"shipping_address": "Payment guard check", "delivery_option": "pickup"}
+            client.post("/payment", data={"checkout_request_id": job_id})
+            with app.app_context():
+                after = db.session.execute(db.select(db.func.max(Order.id))).scalar()
+            return after if after != before else None
+
+        checkout_request_id = f"ws_CO_guard_{uuid.uuid4().hex[:12]}"
+        linked_job = push(user_id, 5000, checkout_request_id)
+        refused = {
+            "push_for_1": confirm(push(user_id, 1)) is None,
+            "other_shoppers_push": confirm(push(other_id, 5000)) is None,
+        }
+        order_id = confirm(linked_job)
+        refused["reused_push"] = confirm(linked_job) is None
+
+        client.post("/callback", json={"Body": {"stkCallback": {
+            "MerchantRequestID": "guard-check",
+            "CheckoutRequestID": checkout_request_id,
+            "ResultCode": 0,
+            "ResultDesc": "The service request is processed successfully.",
+            "CallbackMetadata": {"Item": [
+                {"Name": "Amount", "Value": 1},
+                {"Name": "MpesaReceiptNumber", "Value": "R1"},
+                {"Name": "PhoneNumber", "Value": 254712345678},
+            ]},
+        }}})
+        with app.app_context():
+            callback_processor.process_pending()
+            orders = {
+                row.id: row.payment_status
+                for row in db.session.execute(db.select(Order.id, Order.payment_status))
+            }
+
+    return {
+        "refused": refused,
+        "linked_order": order_id,
+        "orders": orders,
+        "ok": all(refused.values()) and order_id is not None and orders == {order_id: "underpaid"},
+    }
+
+
+def _checkout_worker(env, user_ids, concurrency):
+    """One process of the stock contention test: check out user_ids with concurrency threads."""
+    from app import create_app
+    from extensions import db
+    from cart import load_cart
+    from orders import InsufficientStock, place_order
+
+    os.environ.update(env)
+    app = create_app()
+    checkout_info = {"shipping_address": "Stress test", "delivery_option": "pickup"}
+
+    def checkout(user_id):
+        with app.app_context():
+            try:
+                place_order(user_id, load_cart(user_id), checkout_info, 0)
+                return user_id, "placed"
+            except InsufficientStock:
+                return user_id, "out_of_stock"
+            except Exception as e:
+                db.session.rollback()
+                return user_id, f"{type(e).__name__}: {e}"
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(checkout, user_ids))
+    with app.app_context():
+        db.engine.dispose()
+    return results
+
+
+def run_stock_contention(database_url=None, products=4, stock=50, shoppers=40, lines=3, quantity=3,
+                         processes=4, concurrency=4, seed=0):
+    """
+    Fire concurrent checkouts of overlapping carts and check that nothing is oversold.
+
+    On a scratch database (see scratch_app) creates products products with
+    stock units each and shoppers shoppers. Each cart holds quantity units of
+    lines products taken from a window that slides along the catalog, added
+    in a shuffled order, so carts share products and reach them in
+    different orders. The checkouts are split across processes processes
+    (as gunicorn workers would be), each placing orders through
+    orders.place_order from concurrency threads. The run is "ok" when no
+    checkout fails with a database error such as a deadlock, every product's
+    stock fell by exactly the units its placed orders hold and never below
+    zero, and every rejected cart has a product that is really short.
+    """
+    import random
+    from concurrent.futures import ProcessPoolExecutor
+    from extensions import db
+    from models import CartItem, OrderItem, Product, User
+
+    if lines > products:
+        raise ValueError("A cart holds each product once, so lines cannot exceed products")
+
+    lines = min(lines, products)
+    rng = random.Random(seed)
+    with scratch_app(database_url) as app:
+        with app.app_context():
+            catalog = [Product(name=f"Stress test {i}", price=100, stock=stock, is_active=True) for i in range(products)]
+            users = [
+                User(name=f"Stress {i}", email=f"stress-{i}@example.invalid", role="user", password_hash="!")
+                for i in range(shoppers)
+            ]
+            db.session.add_all(catalog + users)
+            db.session.flush()
+            carts = {}
+            for i, user in enumerate(users):
+                window = [catalog[(i + offset) % products].id for offset in range(lines)]
+                rng.shuffle(window)
+                carts[user.id] = window
+                # One flush per line, so CartItem ids (and load_cart's order) follow the shuffle
+                for product_id in window:
+                    db.session.add(CartItem(user_id=user.id, product_id=product_id, quantity=quantity))
+                    db.session.flush()
+            db.session.commit()
+            product_ids = [product.id for product in catalog]
+            backend = db.engine.dialect.name
+            env = {
+                "DATABASE_URL": app.config["SQLALCHEMY_DATABASE_URI"],
+                "DATABASE_REPLICA_URL": "",
+                "CACHE_DIR": app.config["CACHE_DIR"],
+            }
+            db.engine.dispose()
+
+        user_ids = list(carts)
+        rng.shuffle(user_ids)
+        chunks = [user_ids[i::processes] for i in range(processes)]
+        started = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            results = [
+                result
+                for chunk in pool.map(_checkout_worker, [env] * processes, chunks, [concurrency] * processes)
+                for result in chunk
+            ]
+        elapsed = time.perf_counter() - started
+
+        with app.app_context():
+            final_stock = dict(db.session.execute(db.select(Product.id, Product.stock).where(Product.id.in_(product_ids))).all())
+            sold = dict(db.session.execute(
+                db.select(OrderItem.product_id, db.func.sum(OrderItem.quantity)).group_by(OrderItem.product_id)
+            ).all())
+
+    outcomes = dict(results)
+    placed = [user_id for user_id, outcome in outcomes.items() if outcome == "placed"]
+    rejected = [user_id for user_id, outcome in outcomes.items() if outcome == "out_of_stock"]
+    errors = [outcome for outcome in outcomes.values() if outcome not in ("placed", "out_of_stock")]
+    expected_sold = {product_id: 0 for product_id in product_ids}
+    for user_id in placed:
+        for product_id in carts[user_id]:
+            expected_sold[product_id] += quantity
+    # Stock only goes down, so a cart rejected during the run is still short at the end
+    wrongly_rejected = [
+        user_id for user_id in rejected
+        if all(final_stock[product_id] >= quantity for product_id in carts[user_id])
+    ]
+    return {
+        "backend": backend,
+        "products": products,
+        "stock": stock,
+        "shoppers": shoppers,
+        "lines": lines,
+        "quantity": quantity,
+        "processes": processes,
+        "concurrency": concurrency,
+        "placed": len(placed),
+        "out_of_stock": len(rejected),
+        "wrongly_rejected": len(wrongly_rejected),
+        "errors": errors[:10],
+        "error_count": len(errors),
+        "sold": sum(sold.values()),
+        "final_stock": final_stock,
+        "elapsed_s": round(elapsed, 2),
+        "ok": (
+            not errors
+            and len(outcomes) == shoppers
+            and not wrongly_rejected
+            and all(
+                sold.get(product_id, 0) == stock - final_stock[product_id] == expected_sold[product_id]
+                and final_stock[product_id] >= 0
+                for product_id in product_ids
+            )
+        ),
+    }
+
+
+def _check_node_leases(database_url=None, batch=10_000, ttl=60):
+    """
+    Walk one node id through lease expiry, handover to a new pid and a clock stepping back.
+
+    On a scratch database every node id but one is held, so each generator
+    must take that id, and the generators share a clock that is set by hand.
+    The holders in turn: A claims and renews the lease, then stops without
+    releasing it; after it expires a process forked from A (a new pid) takes
+    the id, issues ids while its clock steps back 30s and releases the id;
+    C takes it once the clock passes the released lease, and releases it;
+    D takes it a second later, long before a lease would expire. A live lease and a release still ahead of the clock
+    must keep the id from anyone else, and the ids of all four holders,
+    batch from each after every clock change, must be strictly increasing.
+    """
+    import multiprocessing
+    from datetime import timedelta
+    from extensions import db
+    from models import OrderNumberNode
+    from order_numbers import MAX_NODE_ID, OrderNumberGenerator, _from_ms, decode
+
+    target = 7
+    start_ms = int(time.time() * 1000)
+    now_ms = [start_ms]
+
+    def clock():
+        return now_ms[0]
+
+    def generator():
+        numbers = OrderNumberGenerator(app, clock=clock)
+        numbers.lease_ttl = ttl
+        return numbers
+
+    def blocked(numbers):
+        try:
+            numbers.generate()
+        except RuntimeError:
+            return True
+        return False
+
+    def ids(numbers):
+        return [decode(numbers.generate()[3:]) for _ in range(batch)]
+
+    def lease_expiry():
+        return db.session.execute(
+            db.select(OrderNumberNode.expires_at).where(OrderNumberNode.node_id == target)
+        ).scalar()
+
+    def past_lease():
+        return (lease_expiry() - _from_ms(0)) // timedelta(milliseconds=1) + 1
+
+    checks = {}
+    with scratch_app(database_url) as app, app.app_context():
+        db.session.execute(db.insert(OrderNumberNode), [
+            {"node_id": node_id, "owner": "bench:held", "expires_at": _from_ms(start_ms + 86_400_000)}
+            for node_id in range(MAX_NODE_ID + 1) if node_id != target
+        ])
+        db.session.commit()
+
+        a = generator()
+        streams = [ids(a)]
+        checks["claims_only_free_id"] = a._snowflake.node_id == target
+        checks["live_lease_blocks_others"] = blocked(generator())
+        now_ms[0] = start_ms + ttl * 1000 * 2 // 3
+        streams.append(ids(a))
+        db.session.remove()
+        checks["renewed_past_half_ttl"] = a._snowflake.node_id == target and lease_expiry() > _from_ms(now_ms[0])
+
+        # A stops without releasing; a process forked from it takes the id once the lease has expired
+        now_ms[0] = past_lease()
+        db.engine.dispose()
+        context = multiprocessing.get_context("fork")
+        reader, writer = context.Pipe(duplex=False)
+
+        def forked():
+            db.engine.dispose(close=False)
+            child = [ids(a)]
+            node_id = a._snowflake.node_id
+            now_ms[0] -= 30_000
+            child.append(ids(a))
+            a.release()
+            writer.send((node_id, child))
+
+        process = context.Process(target=forked)
+        process.start()
+        node_id, child = reader.recv()
+        process.join()
+        streams.extend(child)
+        checks["new_pid_takes_expired_id"] = node_id == target and process.exitcode == 0
+
+        # The child released the id 30s behind its last id: it stays held until the clock passes it
+        now_ms[0] -= 30_000
+        checks["release_ahead_of_clock_holds"] = blocked(generator())
+        db.session.remove()
+        now_ms[0] = past_lease()
+        c = generator()
+        streams.append(ids(c))
+        c.release()
+        now_ms[0] += 1000
+        d = generator()
+        streams.append(ids(d))
+        checks["release_frees_before_ttl"] = d._snowflake.node_id == target
+        d.release()
+        a.release()
+
+    merged = [value for stream in streams for value in stream]
+    checks["ids_increase_across_holders"] = all(x < y for x, y in zip(merged, merged[1:]))
+    return {
+        "ids": len(merged),
+        "lease_ttl_s": ttl,
+        **checks,
+        "ok": all(checks.values()),
+    }
+
+
+def run_order_number_benchmark(count=10_000_000, nodes=4, sample=1_000_000, database_url=None):
+    """
+    Measure order number generation and check count ids for collisions.
+
+    Throughput is measured on sample ids from one generator, with and
+    without encoding. For the collision check, nodes generators (as separate
+    processes would have) each produce count / nodes ids on their own
+    thread. Every stream must be strictly increasing and the merged streams
+    must contain no duplicates. The node id leases are checked on a scratch
+    database (see _check_node_leases).
+    """
+    import heapq
+    from array import array
+    from order_numbers import PREFIX, Snowflake, encode
+
+    snowflake = Snowflake(0)
+    started = time.perf_counter()
+    for _ in range(sample):
+        snowflake.next_id()
+    ids_per_s = sample / (time.perf_counter() - started)
+
+    started = time.perf_counter()
+    numbers = [PREFIX + encode(snowflake.next_id()) for _ in range(sample)]
+    numbers_per_s = sample / (time.perf_counter() - started)
+    ordered = all(a < b for a, b in zip(numbers, numbers[1:]))
+    widths = {len(number) for number in numbers}
+    del numbers
+
+    streams = [array("q") for _ in range(nodes)]
+    monotonic = [True] * nodes
+
+    def generate(node_id):
+        source = Snowflake(node_id + 1)
+        stream = streams[node_id]
+        last = -1
+        for _ in range(count // nodes):
+            value = source.next_id()
+            if value <= last:
+                monotonic[node_id] = False
+            stream.append(value)
+            last = value
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=generate, args=(node_id,)) for node_id in range(nodes)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    generate_s = time.perf_counter() - started
+
+    total = sum(len(stream) for stream in streams)
+    duplicates = 0
+    last = None
+    for value in heapq.merge(*streams):
+        if value == last:
+            duplicates += 1
+        last = value
+
+    leases = _check_node_leases(database_url)
+    return {
+        "ids_per_s": round(ids_per_s),
+        "order_numbers_per_s": round(numbers_per_s),
+        "order_number_length": sorted(widths),
+        "string_order_matches_time_order": ordered,
+        "collision_check": {
+            "ids": total,
+            "nodes": nodes,
+            "generate_s": round(generate_s, 2),
+            "monotonic_per_node": all(monotonic),
+            "duplicates": duplicates,
+        },
+        "leases": leases,
+        "ok": ordered and all(monotonic) and duplicates == 0 and leases["ok"],
+    }
+
+
+def run_query_count_check(page_sizes=(5, 20, 50), lines=5, database_url=None):
+    """
+    Check that the admin order pages run a fixed number of queries.
+
+    On a scratch database (see scratch_app), creates max(page_sizes) orders,
+    each with lines items, for a customer, renders /admin/orders at every
+    page size and the detail page of one order, and counts SQL statements
+    per request. The run is "ok" when the list page costs the same at every
+    page size.
+    """
+    from decimal import Decimal
+    from sqlalchemy import event
+    from extensions import db
+    from models import Order, OrderItem, Product, User
+    from orders import order_summary
+
+    with scratch_app(database_url) as app:
+        with app.app_context():
+            products = [Product(name=f"Query check {i}", price=100, stock=0, is_active=False) for i in range(lines)]
+            admin = User(name="Query check admin", email="query-admin@example.invalid", role="admin", password_hash="!")
+            customer = User(name="Query check", email="query@example.invalid", role="user", password_hash="!")
+            db.session.add_all(products + [admin, customer])
+            db.session.flush()
+            summary = order_summary([(product.name, product.image_url, 1, Decimal(100)) for product in products])
+            orders = [
+                Order(user_id=customer.id, order_number=f"QC{i:05d}", total_amount=100 * lines,
+                      shipping_address="Query check", delivery_option="pickup", status="pending", **summary)
+                for i in range(max(page_sizes))
+            ]
+            db.session.add_all(orders)
+            db.session.flush()
+            db.session.execute(db.insert(OrderItem), [
+                {"order_id": order.id, "product_id": product.id, "quantity": 1, "price": 100}
+                for order in orders for product in products
+            ])
+            db.session.commit()
+            admin_id = admin.id
+            order_id = orders[0].id
+            engine = db.engine
+
+        statements = []
+
+        def count(*_):
+            statements.append(1)
+
+        def queries(client, path):
+            statements.clear()
+            event.listen(engine, "before_cursor_execute", count)
+            try:
+                response = client.get(path)
+            finally:
+                event.remove(engine, "before_cursor_execute", count)
+            if response.status_code != 200:
+                raise RuntimeError(f"GET {path} returned {response.status_code}")
+            return len(statements)
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = str(admin_id)
+            session["_fresh"] = True
+        client.get("/admin/orders")  # Warm per-user caches such as the cart badge
+        list_queries = {}
+        for size in page_sizes:
+            app.config["ORDERS_PER_PAGE"] = size
+            list_queries[size] = queries(client, "/admin/orders")
+        detail_queries = queries(client, f"/admin/orders/{order_id}")
+
+    return {
+        "list_queries_by_page_size": list_queries,
+        "detail_queries": detail_queries,
+        "detail_lines": lines,
+        "ok": len(set(list_queries.values())) == 1,
+    }
+
+
+def _rss_bytes():
+    """Current resident set size, or the peak where /proc is unavailable."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_export_benchmark(database_url=None, orders=1_000_000, kind="orders", fmt="csv", compress=True,
+                         batch_size=1000, max_rss_growth_mb=64):
+    """
+    Stream an export of orders synthetic orders and check that memory stays bounded.
+
+    On a scratch database (see scratch_app) seeds a customer with orders
+    orders of one line each, consumes the export generator exactly as the
+    download endpoint would (discarding the bytes) while a thread samples
+    RSS, then removes the test data. The run is "ok" when RSS grows by less
+    than max_rss_growth_mb.
+    """
+    import uuid
+    from datetime import datetime
+    from extensions import db
+    from exports import EXPORTS, generate_export
+    from models import Order, OrderItem, Product, User
+
+    tag = uuid.uuid4().hex[:8]
+    with scratch_app(database_url) as app:
+        seed_started = time.perf_counter()
+        with app.app_context():
+            product = Product(name=f"Export bench {tag}", price=250, stock=0, is_active=False)
+            customer = User(name=f"Export bench {tag}", email=f"export-{tag}@example.invalid", role="user", password_hash="!")
+            db.session.add_all([product, customer])
+            db.session.commit()
+            product_id, customer_id = product.id, customer.id
+
+            # Raw connection inserts: the synthetic orders never enter the sales rollup. The
+            # database assigns order ids; each batch's lines are inserted from its order numbers
+            now = datetime.utcnow()
+            with db.engine.begin() as conn:
+                for start in range(0, orders, 10_000):
+                    count = min(10_000, orders - start)
+                    numbers = [f"XB{tag}{start + i:08d}" for i in range(count)]
+                    conn.execute(db.insert(Order.__table__), [
+                        {"order_number": number, "user_id": customer_id,
+                         "total_amount": 250, "status": "delivered", "shipping_address": "Export bench",
+                         "delivery_option": "pickup", "payment_method": "mpesa", "payment_status": "completed",
+                         "item_count": 1, "total_quantity": 1, "created_at": now, "updated_at": now}
+                        for number in numbers
+                    ])
+                    conn.execute(db.insert(OrderItem.__table__).from_select(
+                        ["order_id", "product_id", "quantity", "price", "created_at"],
+                        db.select(Order.id, db.literal(product_id), db.literal(1), db.literal(250), db.literal(now))
+                        .where(Order.order_number.between(numbers[0], numbers[-1])),
+                    ))
+        seed_s = time.perf_counter() - seed_started
+
+        samples = []
+        done = threading.Event()
+
+        def sample():
+            while not done.wait(0.05):
+                samples.append(_rss_bytes())
+
+        exported = 0
+        try:
+            with app.app_context():
+                baseline = _rss_bytes()
+                sampler = threading.Thread(target=sample, daemon=True)
+                sampler.start()
+                started = time.perf_counter()
+                query = EXPORTS[kind]([Order.user_id == customer_id])
+                for chunk in generate_export(query, fmt, compress, batch_size):
+                    exported += len(chunk)
+                elapsed = time.perf_counter() - started
+                done.set()
+                sampler.join()
+                samples.append(_rss_bytes())
+        finally:
+            done.set()
+            # Leave a passed-in scratch database empty so it can be reused
+            with app.app_context():
+                with db.engine.begin() as conn:
+                    order_ids = db.select(Order.id).where(Order.user_id == customer_id)
+                    conn.execute(db.delete(OrderItem.__table__).where(OrderItem.order_id.in_(order_ids)))
+                    conn.execute(db.delete(Order.__table__).where(Order.user_id == customer_id))
+                    conn.execute(db.delete(User.__table__).where(User.id == customer_id))
+                    conn.execute(db.delete(Product.__table__).where(Product.id == product_id))
+
+    growth_mb = (max(samples) - baseline) / 2**20
+    return {
+        "orders": orders,
+        "kind": kind,
+        "format": fmt,
+        "gzip": compress,
+        "batch_size": batch_size,
+        "seed_s": round(seed_s, 1),
+        "export_s": round(elapsed, 2),
+        "rows_per_s": round(orders / elapsed) if elapsed else 0,
+        "bytes": exported,
+        "rss_baseline_mb": round(baseline / 2**20, 1),
+        "rss_peak_mb": round(max(samples) / 2**20, 1),
+        "rss_growth_mb": round(growth_mb, 1),
+        "ok": growth_mb < max_rss_growth_mb,
+    }
+
+
+# Engine options create_app used before database.py; the "default" side of the SQLite benchmark
+_UNTUNED_SQLITE_OPTIONS = {"pool_size": 10, "pool_recycle": 3600, "pool_pre_ping": True}
+
+
+def _sqlite_contention_worker(url, tuned, role, duration, seed):
+    """One process of the SQLite benchmark: run reads or writes until duration is up."""
+    import random
+    from sqlalchemy import create_engine, text
+    from sqlalchemy.exc import OperationalError
+    from database import apply_sqlite_pragmas, engine_options
+
+    if tuned:
+        engine = create_engine(url, **engine_options(url))
+        apply_sqlite_pragmas(engine)
+    else:
+        engine = create_engine(url, **_UNTUNED_SQLITE_OPTIONS)
+    rng = random.Random(seed)
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            if role == "write":
+                with engine.begin() as conn:
+                    conn.execute(
+                        text("INSERT INTO bench_order (status, total, created_at) VALUES ('pending', :total, :created_at)"),
+                        {"total": rng.randint(100, 10000), "created_at": time.time()},
+                    )
+                    conn.execute(
+                        text("UPDATE bench_order SET status = 'paid' WHERE id = :id"),
+                        {"id": rng.randint(1, 10000)},
+                    )
+            else:
+                with engine.connect() as conn:
+                    conn.execute(
+                        text("SELECT count(*), sum(total) FROM bench_order WHERE created_at >= :since"),
+                        {"since": time.time() - rng.uniform(1, 60)},
+                    ).one()
+                    conn.execute(text("SELECT * FROM bench_order WHERE id = :id"), {"id": rng.randint(1, 10000)}).first()
+        except OperationalError:
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - started)
+    engine.dispose()
+    return role, latencies, errors
+
+
+def run_sqlite_contention(writers=4, readers=8, duration=10, rows=10000):
+    """
+    Compare concurrent SQLite reads and writes with the old and the tuned engine settings.
+
+    For each mode a fresh database file is seeded with rows rows, then
+    writers + readers separate processes (as gunicorn workers would be)
+    hammer it for duration seconds. Reports operations per second, p50/p99
+    latency and "database is locked" style errors for reads and writes.
+    """
+    import shutil
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+    from sqlalchemy import create_engine, text
+
+    report = {"writers": writers, "readers": readers, "duration_s": duration}
+    workdir = tempfile.mkdtemp(prefix="sqlite-bench-")
+    try:
+        for mode in ("default", "tuned"):
+            url = f"sqlite:///{os.path.join(workdir, mode + '.db')}"
+            engine = create_engine(url)
+            with engine.begin() as conn:
+                conn.execute(text(
+                    "CREATE TABLE bench_order (id INTEGER PRIMARY KEY, status TEXT, total NUMERIC, created_at REAL)"
+                ))
+                conn.execute(text("CREATE INDEX ix_bench_order_created_at ON bench_order (created_at)"))
+                now = time.time()
+                conn.execute(
+                    text("INSERT INTO bench_order (status, total, created_at) VALUES ('pending', :total, :created_at)"),
+                    [{"total": 100 + i % 1000, "created_at": now - i % 3600} for i in range(rows)],
+                )
+            engine.dispose()
+
+            roles = ["write"] * writers + ["read"] * readers
+            with ProcessPoolExecutor(max_workers=len(roles)) as pool:
+                results = list(pool.map(
+                    _sqlite_contention_worker,
+                    [url] * len(roles), [mode == "tuned"] * len(roles), roles,
+                    [duration] * len(roles), range(len(roles)),
+                ))
+
+            report[mode] = {}
+            for role in ("write", "read"):
+                samples = [sample for kind, latencies, _ in results if kind == role for sample in latencies]
+                report[mode][role] = {
+                    "ops_per_s": round(len(samples) / duration, 1),
+                    "errors": sum(errors for kind, _, errors in results if kind == role),
+                    **summarize(samples),
+                }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+def _free_port():
+    import socket
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _seed_catalog(app, products):
+    """Add products active products to a scratch app; returns the environment that points a server at it."""
+    from extensions import db
+    from models import Product
+
+    with app.app_context():
+        db.session.add_all([
+            Product(name=f"Bench product {i}", price=100 + i, stock=1000, is_active=True,
+                    category="Bench", image_url=f"/static/images/bench-{i}.png")
+            for i in range(products)
+        ])
+        db.session.commit()
+    return {
+        "DATABASE_URL": app.config["SQLALCHEMY_DATABASE_URI"],
+        "DATABASE_REPLICA_URL": "",
+        "CACHE_DIR": app.config["CACHE_DIR"],
+    }
+
+
+def _wait_until_up(base_url, process, timeout=60, interval=0.2):
+    import requests
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with status {process.returncode}")
+        try:
+            requests.get(base_url + "/products", timeout=2)
+            return
+        except requests.RequestException:
+            time.sleep(interval)
+    raise RuntimeError(f"gunicorn did not answer on {base_url} within {timeout}s")
+
+
+def run_page_load(base_url, paths=("/products",), total=500, concurrency=20):
+    """GET paths in turn, total times in all, and report throughput, latency, errors and retries."""
+    import requests as http
+
+    local = threading.local()
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+    retries = [0]
+
+    def fetch(i):
+        if not hasattr(local, "session"):
+            local.session = http.Session()
+        started = time.perf_counter()
+        ok = False
+        for attempt in range(2):
+            try:
+                ok = local.session.get(base_url + paths[i % len(paths)], timeout=60).status_code == 200
+                break
+            except http.ConnectionError:
+                # A worker exiting (e.g. at max_requests) closes its idle keep-alive connections;
+                # like browsers and proxies, retry the GET once on a fresh connection
+                if not attempt:
+                    with lock:
+                        retries[0] += 1
+            except http.RequestException:
+                break
+        with lock:
+            if ok:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors[0] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(fetch, range(total)))
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": total,
+        "errors": errors[0],
+        "retried": retries[0],
+        "requests_per_s": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        **summarize(latencies),
+    }
+
+
+def run_worker_tuning(worker_counts, thread_counts, worker_class="gthread", checkouts=100,
+                      checkout_concurrency=20, page_requests=1000, page_concurrency=20,
+                      daraja_latency_ms=1000, paths=("/products",), database_url=None, products=100):
+    """
+    Find the gunicorn workers x threads combination with the best throughput on this machine.
+
+    For every combination a gunicorn server is started from gunicorn_config.py
+    with the Daraja simulator answering after daraja_latency_ms, and the
+    catalog pages are loaded while checkouts hold requests on slow M-Pesa
+    calls at the same time. A combination qualifies when no request errors
+    and no checkout times out; the best one serves the most pages per second,
+    fewer processes winning a tie. The servers run on a scratch database (see
+    scratch_app) stocked with products catalog products.
+    """
+    import signal
+    import subprocess
+    import sys
+
+    root = os.path.dirname(os.path.abspath(__file__))
+    if worker_class != "gthread":
+        thread_counts = [1]
+    results = []
+    with scratch_app(database_url) as app:
+        scratch_env = _seed_catalog(app, products)
+        shoppers = _seed_shoppers(app, checkout_concurrency)
+        for workers in worker_counts:
+            for threads in thread_counts:
+                port = _free_port()
+                base_url = f"http://127.0.0.1:{port}"
+                env = dict(
+                    os.environ,
+                    **scratch_env,
+                    PORT=str(port),
+                    WEB_CONCURRENCY=str(workers),
+                    GUNICORN_THREADS=str(threads),
+                    GUNICORN_WORKER_CLASS=worker_class,
+                    MPESA_SIMULATOR="true",
+                    DARAJA_SIM_LATENCY_MS=str(daraja_latency_ms),
+                    DARAJA_SIM_ERROR_RATE="0",
+                )
+                process = subprocess.Popen(
+                    [sys.executable, "-m", "gunicorn", "-c", "gunicorn_config.py", "wsgi:app"],
+                    cwd=root, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                )
+                try:
+                    _wait_until_up(base_url, process)
+                    with ThreadPoolExecutor(max_workers=1) as background:
+                        checkout_run = background.submit(
+                            run_checkout_scenario, base_url=base_url, shoppers=shoppers, checkouts=checkouts,
+                            concurrency=checkout_concurrency, timeout=120,
+                        )
+                        pages = run_page_load(base_url, paths, page_requests, page_concurrency)
+                        checkout = checkout_run.result()
+                finally:
+                    process.send_signal(signal.SIGTERM)
+                    try:
+                        process.wait(timeout=90)
+                    except subprocess.TimeoutExpired:
+                        process.kill()
+                        process.wait()
+                results.append({
+                    "workers": workers,
+                    "threads": threads,
+                    "pages": pages,
+                    "checkout": {key: checkout[key] for key in ("completed", "failed", "rejected", "timed_out", "errors",
+                                                                "throughput_per_s")},
+                    "checkout_initiate_p99_ms": checkout["latency"]["initiate"]["p99_ms"],
+                    "ok": not pages["errors"] and not checkout["errors"] and not checkout["timed_out"],
+                })
+
+    qualified = [result for result in results if result["ok"]]
+    best = max(qualified, key=lambda r: (r["pages"]["requests_per_s"], -r["workers"]), default=None)
+    return {
+        "worker_class": worker_class,
+        "daraja_latency_ms": daraja_latency_ms,
+        "results": results,
+        "best": {"workers": best["workers"], "threads": best["threads"]} if best else None,
+        "ok": best is not None,
+    }
+
+
+_STARTUP_PROBE = """
+import json, time
+started = time.perf_counter()
+import flask, flask_sqlalchemy, sqlalchemy.orm
+framework = time.perf_counter()
+import app
+imported = time.perf_counter()
+import wsgi
+built = time.perf_counter()
+print(json.dumps({
+    "framework_import_ms": (framework - started) * 1000,
+    "app_import_ms": (imported - framework) * 1000,
+    "build_app_ms": (built - imported) * 1000,
+}))
+"""
+
+
+def run_startup_benchmark(runs=5, workers=2, max_requests=50, page_requests=500, target_ms=200,
+                          database_url=None, products=100):
+    """
+    Measure cold start, server start and worker boot time.
+
+    Cold start: runs fresh interpreters each import wsgi (as the gunicorn
+    master does with preload_app), timed in phases: Flask and SQLAlchemy,
+    app.py, and building the app, plus the whole process. Server start: from
+    launching gunicorn until it first answers a catalog page. Worker boot:
+    that server, with max_requests set low (with jitter, so workers do not
+    all recycle at once), serves page_requests catalog pages so its workers
+    are recycled several times, and the "booted in" times its hooks log are
+    collected, along with page latency while workers recycle. Both run on a
+    scratch database (see scratch_app). The run is "ok" when the median cold
+    start process, the server start and every worker boot are within
+    target_ms and no page fails.
+    """
+    import json
+    import re
+    import signal
+    import subprocess
+    import sys
+    import tempfile
+
+    root = os.path.dirname(os.path.abspath(__file__))
+    with scratch_app(database_url) as app:
+        scratch_env = _seed_catalog(app, products)
+
+        phases = {"framework_import_ms": [], "app_import_ms": [], "build_app_ms": [], "process_ms": []}
+        for _ in range(runs):
+            started = time.perf_counter()
+            output = subprocess.run(
+                [sys.executable, "-c", _STARTUP_PROBE], cwd=root, env=dict(os.environ, **scratch_env),
+                capture_output=True, text=True, check=True,
+            ).stdout
+            phases["process_ms"].append((time.perf_counter() - started) * 1000)
+            for name, value in json.loads(output.strip().splitlines()[-1]).items():
+                phases[name].append(value)
+        cold_start = {name: round(percentile(values, 50), 1) for name, values in phases.items()}
+
+        port = _free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        env = dict(os.environ, **scratch_env, PORT=str(port), WEB_CONCURRENCY=str(workers))
+        with tempfile.TemporaryFile(mode="w+") as log:
+            started = time.perf_counter()
+            process = subprocess.Popen(
+                [sys.executable, "-m", "gunicorn", "-c", "gunicorn_config.py", "--access-logfile", "/dev/null",
+                 "--max-requests", str(max_requests), "--max-requests-jitter", str(max_requests // 4), "wsgi:app"],
+                cwd=root, env=env, stdout=subprocess.DEVNULL, stderr=log,
+            )
+            try:
+                _wait_until_up(base_url, process, interval=0.01)
+                server_start_ms = (time.perf_counter() - started) * 1000
+                pages = run_page_load(base_url, total=page_requests, concurrency=workers * 2)
+            finally:
+                process.send_signal(signal.SIGTERM)
+                try:
+                    process.wait(timeout=90)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.wait()
+            log.seek(0)
+            output = log.read()
+
+    boots = [float(ms) for ms in re.findall(r"Worker \d+ booted in ([\d.]+) ms", output)]
+    loaded = re.search(r"Application loaded in ([\d.]+) ms", output)
+    return {
+        "cold_start_ms": cold_start,
+        "server_start_ms": round(server_start_ms, 1),
+        "master_app_load_ms": float(loaded.group(1)) if loaded else None,
+        "worker_boot_ms": {
+            "boots": len(boots),
+            "p50": round(percentile(boots, 50), 1),
+            "max": round(max(boots, default=0), 1),
+        },
+        "pages_while_recycling": pages,
+        "target_ms": target_ms,
+        "ok": (
+            bool(boots) and max(boots) <= target_ms
+            and cold_start["process_ms"] <= target_ms
+            and server_start_ms <= target_ms
+            and not pages["errors"]
+        ),
+    }
@@ -1,3 +1,4 @@
+import json
 from datetime import datetime
 from flask_login import UserMixin
 from extensions import db
@@ -145,9 +146,9 @@ class CartItem(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
-    # Composite index for faster lookups
+    # One line per product in a cart; cart.apply_cart_deltas() upserts on it
     __table_args__ = (
-        db.Index('idx_cart_user_product', 'user_id', 'product_id'),
+        db.Index('idx_cart_user_product', 'user_id', 'product_id', unique=True),
     )
     
     def __repr__(self):
@@ -166,12 +167,21 @@ class Order(db.Model):
     delivery_option = db.Column(db.String(50), default='standard')
     payment_method = db.Column(db.String(50), default='mpesa')
     payment_status = db.Column(db.String(50), default='pending', index=True)  # Added index
+    checkout_request_id = db.Column(db.String(100), unique=True, index=True)  # Links the order to its STK Push; one order per push
+    mpesa_amount = db.Column(db.Numeric(10, 2))  # Amount of the linked STK Push, checked against total_amount when it was linked
+    mpesa_receipt = db.Column(db.String(50))
+    # Written once when the order is placed, so list pages need no item queries
+    item_count = db.Column(db.Integer)
+    total_quantity = db.Column(db.Integer)
+    item_preview = db.Column(db.Text)  # JSON list of the first two lines
     notes = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)  # Added index
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     # Relationships
     items = db.relationship('OrderItem', backref='order', lazy='dynamic', cascade='all, delete-orphan')
+    # Plain list of the same rows, so it can be eager-loaded (see orders.order_loaders)
+    item_list = db.relationship('OrderItem', viewonly=True, order_by='OrderItem.id')
     
     # Composite index for common queries
     __table_args__ = (
@@ -184,8 +194,23 @@ class Order(db.Model):
     
     @property
     def total_items(self):
+        if self.total_quantity is not None:
+            return self.total_quantity
         return sum(item.quantity for item in self.items)
 
+    @property
+    def preview_items(self):
+        """First two lines as dicts with name, image_url, quantity and line_total."""
+        if self.item_preview is not None:
+            return json.loads(self.item_preview)
+        # Not backfilled yet (see the backfill-order-summaries command)
+        items = self.item_list[:2] if 'item_list' in self.__dict__ else self.items.limit(2)
+        return [
+            {"name": item.product.name, "image_url": item.product.image_url,
+             "quantity": item.quantity, "line_total": float(item.price * item.quantity)}
+            for item in items
+        ]
+
 
 class OrderItem(db.Model):
     __tablename__ = 'order_item'
@@ -210,6 +235,61 @@ class OrderItem(db.Model):
         return self.price * self.quantity
 
 
+class SalesDaily(db.Model):
+    __tablename__ = 'sales_daily'
+
+    # Orders per UTC day and status, kept in step with the order table by sales.py
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    status = db.Column(db.String(50), nullable=False)
+    order_count = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Numeric(14, 2), nullable=False, default=0)
+    items = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('day', 'status', name='uq_sales_daily_day_status'),
+    )
+
+    def __repr__(self):
+        return f'<SalesDaily {self.day} {self.status} Orders:{self.order_count}>'
+
+
+class StockReservation(db.Model):
+    __tablename__ = 'stock_reservation'
+
+    # Units held for a shopper between checkout and payment; ignored once expires_at passes
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)  # Sweeper range scan
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        # Covers the active-holds SUM per product without touching the table
+        db.Index('idx_reservation_product_expiry', 'product_id', 'expires_at', 'quantity'),
+    )
+
+    def __repr__(self):
+        return f'<StockReservation User:{self.user_id} Product:{self.product_id} Qty:{self.quantity}>'
+
+
+class PaymentStatus(db.Model):
+    __tablename__ = 'payment_status'
+
+    checkout_request_id = db.Column(db.String(100), primary_key=True)
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    reference = db.Column(db.String(100))  # CheckoutRequestID of a queued STK Push job
+    message = db.Column(db.String(255))  # Why the payment failed, shown to the shopper
+    user_id = db.Column(db.Integer)  # Shopper who requested the STK Push (job entries)
+    amount = db.Column(db.Numeric(10, 2))  # Amount the STK Push asked for (job entries)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)  # Used for TTL eviction
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<PaymentStatus {self.checkout_request_id} Status:{self.status}>'
+
+
 class Practitioner(db.Model):
     __tablename__ = 'practitioner'
     
@@ -332,4 +412,47 @@ class Notification(db.Model):
     
     def mark_as_read(self):
         self.is_read = True
-        db.session.commit()
\ No newline at end of file
+        db.session.commit()
+
+
+class MpesaCallback(db.Model):
+    __tablename__ = 'mpesa_callback'
+
+    # Append-only journal; one row per CheckoutRequestID, so re-deliveries are ignored
+    id = db.Column(db.Integer, primary_key=True)
+    checkout_request_id = db.Column(db.String(100), unique=True, nullable=False)
+    merchant_request_id = db.Column(db.String(100))
+    result_code = db.Column(db.Integer)
+    result_desc = db.Column(db.String(255))
+    amount = db.Column(db.Numeric(10, 2))
+    receipt_number = db.Column(db.String(50))
+    phone_number = db.Column(db.String(20))
+    payload = db.Column(db.Text, nullable=False)
+    received_at = db.Column(db.DateTime, default=datetime.utcnow)
+    processed_at = db.Column(db.DateTime, index=True)  # NULL until applied to orders
+
+    def __repr__(self):
+        return f'<MpesaCallback {self.checkout_request_id} Result:{self.result_code}>'
+
+
+class ApiToken(db.Model):
+    __tablename__ = 'api_token'
+
+    name = db.Column(db.String(50), primary_key=True)
+    token = db.Column(db.String(500), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<ApiToken {self.name}>'
+
+
+class OrderNumberNode(db.Model):
+    __tablename__ = 'order_number_node'
+
+    # Node id leases for the order number generator; one live process per node id
+    node_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    owner = db.Column(db.String(100), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<OrderNumberNode {self.node_id} {self.owner}>'
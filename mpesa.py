@@ -0,0 +1,398 @@
+"""
+M-Pesa (Safaricom Daraja) API helpers.
+"""
+import base64
+import os
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+
+class DarajaClient:
+    """
+    HTTP client for the Daraja API.
+
+    All calls share one pooled keep-alive session per process, so OAuth, STK
+    Push and probe requests reuse TCP/TLS connections. Failed calls are retried
+    with jittered exponential backoff and every call's latency is recorded.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._session = None
+        self._session_pid = None
+        self._session_lock = threading.Lock()
+        self.simulator = None
+        self._metrics = {}
+        self._metrics_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("MPESA_BASE_URL", "https://sandbox.safaricom.co.ke")
+        app.config.setdefault("MPESA_POOL_SIZE", 10)
+        app.config.setdefault("MPESA_CONNECT_TIMEOUT", 5)
+        app.config.setdefault("MPESA_READ_TIMEOUT", 30)
+        app.config.setdefault("MPESA_MAX_RETRIES", 2)
+        app.config.setdefault("MPESA_RETRY_BACKOFF", 0.5)
+        app.config.setdefault("MPESA_SIMULATOR", False)
+        app.config.setdefault("DARAJA_SIM_CALLBACK_MODE", "inprocess")
+        self.app = app
+        self.simulator = None
+        if app.config["MPESA_SIMULATOR"]:
+            from daraja_sim import DarajaSimulator, inprocess_deliverer
+
+            deliver = inprocess_deliverer(app) if app.config["DARAJA_SIM_CALLBACK_MODE"] == "inprocess" else None
+            self.simulator = DarajaSimulator(app.config, deliver=deliver)
+        app.extensions["daraja"] = self
+
+    @property
+    def session(self):
+        # Sessions must not be shared across a fork, so each worker builds its own
+        if self._session is None or self._session_pid != os.getpid():
+            with self._session_lock:
+                if self._session is None or self._session_pid != os.getpid():
+                    import requests
+                    from requests.adapters import HTTPAdapter
+
+                    pool_size = int(self.app.config["MPESA_POOL_SIZE"])
+                    session = requests.Session()
+                    if self.simulator is not None:
+                        from daraja_sim import simulator_adapter
+
+                        adapter = simulator_adapter(self.simulator)
+                    else:
+                        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self._session = session
+                    self._session_pid = os.getpid()
+        return self._session
+
+    def request(self, method, path, name=None, idempotent=True, retries=None, **kwargs):
+        """
+        Send a request to MPESA_BASE_URL + path.
+
+        Connection failures are always retried. Read timeouts and 5xx responses
+        are only retried for idempotent calls, since a non-idempotent STK Push
+        may already have reached the customer's phone.
+        """
+        import requests
+
+        config = self.app.config
+        name = name or path
+        url = config["MPESA_BASE_URL"].rstrip("/") + path
+        kwargs.setdefault("timeout", (float(config["MPESA_CONNECT_TIMEOUT"]), float(config["MPESA_READ_TIMEOUT"])))
+        max_retries = int(config["MPESA_MAX_RETRIES"]) if retries is None else retries
+
+        for attempt in range(max_retries + 1):
+            last_attempt = attempt == max_retries
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.exceptions.ConnectionError:
+                self._record(name, time.perf_counter() - start, error=True)
+                if last_attempt:
+                    raise
+            except requests.exceptions.Timeout:
+                self._record(name, time.perf_counter() - start, error=True)
+                if last_attempt or not idempotent:
+                    raise
+            else:
+                self._record(name, time.perf_counter() - start, error=response.status_code >= 500)
+                if response.status_code < 500 or last_attempt or not idempotent:
+                    return response
+            self._backoff(attempt)
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def fetch_token(self):
+        """Request a new OAuth token. Returns (access_token, expires_in)."""
+        config = self.app.config
+        response = self.get(
+            "/oauth/v1/generate?grant_type=client_credentials",
+            name="oauth",
+            auth=(config["MPESA_CONSUMER_KEY"], config["MPESA_CONSUMER_SECRET"]),
+        )
+        print(f"Token response status: {response.status_code}")
+        if response.status_code != 200:
+            raise RuntimeError(f"Failed to get token: {response.text}")
+        token_data = response.json()
+        return token_data["access_token"], int(token_data.get("expires_in", 3599))
+
+    def stk_push(self, access_token, payload, **kwargs):
+        return self.post(
+            "/mpesa/stkpush/v1/processrequest",
+            name="stk_push",
+            idempotent=False,
+            json=payload,
+            headers={"Authorization": f"Bearer {access_token}"},
+            **kwargs,
+        )
+
+    def stk_password(self, timestamp=None):
+        """Return the (Password, Timestamp) pair Daraja expects on STK requests."""
+        config = self.app.config
+        timestamp = timestamp or datetime.now().strftime("%Y%m%d%H%M%S")
+        raw = f"{config['MPESA_SHORTCODE']}{config['MPESA_PASSKEY']}{timestamp}"
+        return base64.b64encode(raw.encode()).decode("utf-8"), timestamp
+
+    def stk_query(self, access_token, checkout_request_id):
+        """Ask Daraja for the result of an STK Push (safe to retry)."""
+        password, timestamp = self.stk_password()
+        return self.post(
+            "/mpesa/stkpushquery/v1/query",
+            name="stk_query",
+            json={
+                "BusinessShortCode": self.app.config["MPESA_SHORTCODE"],
+                "Password": password,
+                "Timestamp": timestamp,
+                "CheckoutRequestID": checkout_request_id,
+            },
+            headers={"Authorization": f"Bearer {access_token}"},
+        )
+
+    def metrics(self):
+        """Per-call latency summary in milliseconds."""
+        with self._metrics_lock:
+            snapshot = {}
+            for name, entry in self._metrics.items():
+                samples = sorted(entry["samples"])
+                snapshot[name] = {
+                    "calls": entry["calls"],
+                    "errors": entry["errors"],
+                    "avg_ms": round(entry["total"] / entry["calls"] * 1000, 1),
+                    "p50_ms": round(samples[len(samples) // 2] * 1000, 1),
+                    "p99_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000, 1),
+                    "max_ms": round(entry["max"] * 1000, 1),
+                }
+            return snapshot
+
+    def _record(self, name, elapsed, error=False):
+        with self._metrics_lock:
+            entry = self._metrics.setdefault(
+                name, {"calls": 0, "errors": 0, "total": 0.0, "max": 0.0, "samples": deque(maxlen=1000)}
+            )
+            entry["calls"] += 1
+            entry["errors"] += int(error)
+            entry["total"] += elapsed
+            entry["max"] = max(entry["max"], elapsed)
+            entry["samples"].append(elapsed)
+
+    def _backoff(self, attempt):
+        base = float(self.app.config["MPESA_RETRY_BACKOFF"])
+        time.sleep(random.uniform(0, base * (2 ** attempt)))
+
+
+class MpesaTokenManager:
+    """
+    Caches the Daraja OAuth token for its lifetime.
+
+    The token is refreshed in a background thread once it is within
+    MPESA_TOKEN_REFRESH_MARGIN seconds of expiry, and only one refresh runs
+    per worker at a time. Fresh tokens are written to the api_token table so
+    other workers can pick them up instead of calling Safaricom themselves.
+    """
+
+    token_name = "mpesa_oauth"
+
+    def __init__(self, app=None):
+        self.app = None
+        self.refresh_margin = 300
+        self.share = True
+        self._token = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+        self._refreshing = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("MPESA_TOKEN_REFRESH_MARGIN", 300)
+        app.config.setdefault("MPESA_TOKEN_SHARED", True)
+        self.app = app
+        self.refresh_margin = int(app.config["MPESA_TOKEN_REFRESH_MARGIN"])
+        self.share = bool(app.config["MPESA_TOKEN_SHARED"])
+        app.extensions["mpesa_tokens"] = self
+
+    def get_token(self):
+        """Return a valid access token, fetching one only when none is cached."""
+        now = time.time()
+        if self._token and now < self._expires_at:
+            if self._expires_at - now < self.refresh_margin:
+                self._refresh_in_background()
+            return self._token
+
+        with self._lock:
+            # Another thread may have refreshed while we waited for the lock
+            if self._token and time.time() < self._expires_at:
+                return self._token
+            self._refresh()
+            return self._token
+
+    def invalidate(self, token=None):
+        """
+        Drop the cached token, e.g. after Daraja rejects it.
+
+        The shared copy is deleted too, but only while it still holds the
+        rejected token (the cached one unless token is given), so a fresh
+        token another worker has stored meanwhile survives.
+        """
+        with self._lock:
+            token = token or self._token
+            self._token = None
+            self._expires_at = 0.0
+        if self.share and token:
+            with self.app.app_context():
+                self._delete_shared(token)
+
+    def _refresh(self):
+        with self.app.app_context():
+            if self.share:
+                shared = self._load_shared()
+                if shared and shared[1] - time.time() > self.refresh_margin:
+                    self._token, self._expires_at = shared
+                    return
+
+            token, expires_in = self._fetch()
+            self._token = token
+            self._expires_at = time.time() + expires_in
+            if self.share:
+                self._store_shared(token, self._expires_at)
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                with self._lock:
+                    self._refresh()
+            except Exception as e:
+                print(f"Background token refresh failed: {e}")
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, name="mpesa-token-refresh", daemon=True).start()
+
+    def _fetch(self):
+        from extensions import daraja
+
+        print("Fetching access token...")
+        return daraja.fetch_token()
+
+    def _load_shared(self):
+        from extensions import db
+        from models import ApiToken
+
+        try:
+            with db.engine.connect() as conn:
+                row = conn.execute(
+                    db.select(ApiToken.token, ApiToken.expires_at).where(ApiToken.name == self.token_name)
+                ).first()
+        except Exception as e:
+            print(f"Could not read shared token: {e}")
+            return None
+        if row is None:
+            return None
+        remaining = row.expires_at.replace(tzinfo=None) - datetime.utcnow()
+        return row.token, time.time() + remaining.total_seconds()
+
+    def _delete_shared(self, token):
+        from extensions import db
+        from models import ApiToken
+
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(
+                    db.delete(ApiToken).where(ApiToken.name == self.token_name, ApiToken.token == token)
+                )
+        except Exception as e:
+            print(f"Could not delete shared token: {e}")
+
+    def _store_shared(self, token, expires_at):
+        from sqlalchemy.exc import IntegrityError
+        from extensions import db
+        from models import ApiToken
+
+        expires = datetime.utcnow() + timedelta(seconds=expires_at - time.time())
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(db.delete(ApiToken).where(ApiToken.name == self.token_name))
+                conn.execute(db.insert(ApiToken).values(name=self.token_name, token=token, expires_at=expires))
+        except IntegrityError:
+            # Another worker stored its token at the same moment; either is valid
+            pass
+        except Exception as e:
+            print(f"Could not store shared token: {e}")
+
+
+# Queued STK Pushes are tracked under a job id until Safaricom assigns a CheckoutRequestID
+JOB_ID_PREFIX = "job_"
+
+
+def send_stk_push(job_id, payload, deadline):
+    """
+    Background job that sends a queued STK Push.
+
+    On success the job's status entry is pointed at Safaricom's
+    CheckoutRequestID, so the callback for that id completes the job, and
+    orders already confirmed with the job id are relinked to it.
+    """
+    from flask import current_app
+    from callbacks import link_checkout_request
+    from extensions import daraja, mpesa_tokens, payment_store
+
+    try:
+        try:
+            access_token = mpesa_tokens.get_token()
+        except Exception as e:
+            print(f"Error getting access token for {job_id}: {e}")
+            payment_store.set(job_id, "failed", message="Failed to authenticate with M-Pesa. Please try again.")
+            return
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("STK Push job timed out before it was sent")
+        timeout = (
+            min(float(current_app.config["MPESA_CONNECT_TIMEOUT"]), remaining),
+            min(float(current_app.config["MPESA_READ_TIMEOUT"]), remaining),
+        )
+
+        print(f"Sending STK Push payload for {job_id}: {payload}")
+        response_data = daraja.stk_push(access_token, payload, timeout=timeout).json()
+        print(f"STK Push Response: {response_data}")
+
+        if response_data.get("ResponseCode") == "0":
+            checkout_request_id = response_data.get("CheckoutRequestID")
+            payment_store.set(job_id, "pending", reference=checkout_request_id)
+            link_checkout_request(job_id, checkout_request_id)
+            return
+
+        error_msg = response_data.get("errorMessage", response_data.get("ResponseDescription", "STK Push failed"))
+        print(f"STK Push failed for {job_id}: {error_msg}")
+        # Provide user-friendly error messages
+        if "Invalid TransactionType" in error_msg:
+            error_msg = "Your till number may not support STK Push. Please use the manual payment method below."
+        elif "Invalid Access Token" in error_msg:
+            mpesa_tokens.invalidate(access_token)
+            error_msg = "Authentication failed. Please try again."
+        payment_store.set(job_id, "failed", message=error_msg)
+    except Exception as e:
+        print(f"STK Push error for {job_id}: {e}")
+        payment_store.set(job_id, "failed", message="An error occurred. Please use manual payment method.")
+
+
+def expire_stk_push(job_id, payload):
+    """Called instead of send_stk_push when a job waited past its deadline."""
+    from extensions import payment_store
+
+    print(f"STK Push job {job_id} expired in the queue")
+    payment_store.set(job_id, "failed", message="M-Pesa did not respond in time. Please try again or use manual payment.")
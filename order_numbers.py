@@ -0,0 +1,231 @@
+"""
+Collision-free, time-ordered order numbers.
+
+An order number is "SHF" followed by a 64-bit id written as 13 base-36
+digits, so string order matches numeric order and new rows are appended to
+the right-hand edge of the order_number index. The id packs:
+
+    41 bits  milliseconds since 2024-01-01 (good until 2093)
+    10 bits  node id, unique among running processes
+    12 bits  sequence within the millisecond
+
+Each process leases a node id from the order_number_node table (or takes
+ORDER_NODE_ID from config), so no two live processes share one and numbers
+never collide without any retry on insert. Leases are short (a minute by
+default): generate() renews them as it goes, exiting workers release them,
+and a crashed process's id is free again once its lease runs out. A lease
+always outlasts the ids issued under it, even ones ahead of a clock that
+stepped back, so the next holder of an id only starts numbering once its
+clock has passed them. Leases are written on their own connection, so call
+generate() before opening a write transaction.
+"""
+import atexit
+import os
+import random
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+EPOCH_MS = 1704067200000  # 2024-01-01T00:00:00Z
+NODE_BITS = 10
+SEQUENCE_BITS = 12
+MAX_NODE_ID = (1 << NODE_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+PREFIX = "SHF"
+WIDTH = 13
+DIGITS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+
+def encode(value):
+    """Fixed-width base-36, so lexical order is numeric order."""
+    chars = []
+    while value:
+        value, digit = divmod(value, 36)
+        chars.append(DIGITS[digit])
+    return "".join(reversed(chars)).rjust(WIDTH, "0")
+
+
+def decode(code):
+    return int(code, 36)
+
+
+def _wall_clock():
+    return int(time.time() * 1000)
+
+
+def _from_ms(ms):
+    """Naive UTC datetime of unix milliseconds."""
+    return datetime(1970, 1, 1) + timedelta(milliseconds=ms)
+
+
+class Snowflake:
+    """Monotonic 63-bit id source for one node id. Thread-safe."""
+
+    def __init__(self, node_id, clock=None):
+        if not 0 <= node_id <= MAX_NODE_ID:
+            raise ValueError(f"node id must be between 0 and {MAX_NODE_ID}")
+        self.node_id = node_id
+        self._clock = clock or _wall_clock
+        self._last_ms = 0
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    @property
+    def last_ms(self):
+        """Unix milliseconds of the latest id issued."""
+        return self._last_ms + EPOCH_MS
+
+    def next_id(self):
+        with self._lock:
+            now = self._clock() - EPOCH_MS
+            if now > self._last_ms:
+                self._last_ms = now
+                self._sequence = 0
+            else:
+                # Same millisecond or the clock stepped back: keep counting from the
+                # last timestamp, borrowing the next millisecond when the sequence runs out
+                self._sequence += 1
+                if self._sequence > MAX_SEQUENCE:
+                    self._last_ms += 1
+                    self._sequence = 0
+            return (self._last_ms << (NODE_BITS + SEQUENCE_BITS)) | (self.node_id << SEQUENCE_BITS) | self._sequence
+
+
+class OrderNumberGenerator:
+    """Hands out order numbers, leasing a node id per process on first use and renewing it as it goes."""
+
+    def __init__(self, app=None, clock=None):
+        self.app = None
+        self.lease_ttl = 60
+        self._clock = clock or _wall_clock
+        self._snowflake = None
+        self._pid = None
+        self._owner = None
+        self._lease_expires = None
+        self._release_registered = False
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("ORDER_NODE_ID", None)
+        app.config.setdefault("ORDER_NODE_LEASE_TTL", 60)
+        self.app = app
+        self.lease_ttl = int(app.config["ORDER_NODE_LEASE_TTL"])
+        app.extensions["order_numbers"] = self
+
+    def generate(self):
+        return PREFIX + encode(self._get_snowflake().next_id())
+
+    def release(self):
+        """Give up this process's node id lease (on worker exit) so another process can take it at once."""
+        if self._pid != os.getpid():
+            return  # Nothing leased yet, or the lease belongs to the process we were forked from
+        from extensions import db
+        from models import OrderNumberNode
+
+        with self._lock:
+            if self._owner is None or self._snowflake is None:
+                return
+            with self.app.app_context(), db.engine.begin() as conn:
+                conn.execute(
+                    db.update(OrderNumberNode)
+                    .where(OrderNumberNode.node_id == self._snowflake.node_id, OrderNumberNode.owner == self._owner)
+                    .values(expires_at=self._held_until())
+                )
+            self._snowflake = None
+            self._owner = None
+            self._lease_expires = None
+
+    def _release_at_exit(self):
+        from sqlalchemy.exc import SQLAlchemyError
+
+        try:
+            self.release()
+        except SQLAlchemyError:
+            pass  # Database already gone; the lease simply runs out
+
+    def _get_snowflake(self):
+        # A forked worker must not reuse its parent's node id
+        if self._snowflake is not None and self._pid == os.getpid() and not self._lease_due():
+            return self._snowflake
+        with self._lock:
+            if self._snowflake is None or self._pid != os.getpid():
+                configured = self.app.config["ORDER_NODE_ID"]
+                if configured is not None and configured != "":
+                    self._owner = None
+                    self._lease_expires = None
+                    self._snowflake = Snowflake(int(configured), self._clock)
+                else:
+                    self._snowflake = self._claim_node()
+                self._pid = os.getpid()
+            elif self._lease_due() and not self._renew():
+                # Our lease lapsed and another process took the id; move to a free one
+                self._snowflake = self._claim_node()
+        return self._snowflake
+
+    def _now(self):
+        return _from_ms(self._clock())
+
+    def _held_until(self):
+        """The lease must outlast every id issued, which may be ahead of a clock that stepped back."""
+        now = self._now()
+        if self._snowflake is None:
+            return now
+        return max(now, _from_ms(self._snowflake.last_ms))
+
+    def _lease_due(self):
+        return (
+            self._lease_expires is not None
+            and self._held_until() > self._lease_expires - timedelta(seconds=self.lease_ttl / 2)
+        )
+
+    def _claim_node(self):
+        from sqlalchemy.exc import IntegrityError
+        from extensions import db
+        from models import OrderNumberNode
+
+        self._owner = f"{socket.gethostname()}:{os.getpid()}:{random.getrandbits(32):08x}"
+        while True:
+            now = self._now()
+            with db.engine.connect() as conn:
+                taken = set(conn.execute(
+                    db.select(OrderNumberNode.node_id).where(OrderNumberNode.expires_at > now)
+                ).scalars())
+            free = [node_id for node_id in range(MAX_NODE_ID + 1) if node_id not in taken]
+            if not free:
+                raise RuntimeError("No free order number node ids")
+            node_id = random.choice(free)
+            expires = now + timedelta(seconds=self.lease_ttl)
+            try:
+                with db.engine.begin() as conn:
+                    conn.execute(db.delete(OrderNumberNode).where(
+                        OrderNumberNode.node_id == node_id, OrderNumberNode.expires_at <= now
+                    ))
+                    conn.execute(db.insert(OrderNumberNode).values(
+                        node_id=node_id, owner=self._owner, expires_at=expires
+                    ))
+            except IntegrityError:
+                continue  # Another process claimed the same id at the same moment
+            self._lease_expires = expires
+            if not self._release_registered:
+                # Forked workers inherit this and release their own lease; gunicorn's worker_exit also calls release()
+                atexit.register(self._release_at_exit)
+                self._release_registered = True
+            return Snowflake(node_id, self._clock)
+
+    def _renew(self):
+        from extensions import db
+        from models import OrderNumberNode
+
+        expires = self._held_until() + timedelta(seconds=self.lease_ttl)
+        with db.engine.begin() as conn:
+            renewed = conn.execute(
+                db.update(OrderNumberNode)
+                .where(OrderNumberNode.node_id == self._snowflake.node_id, OrderNumberNode.owner == self._owner)
+                .values(expires_at=expires)
+            ).rowcount
+        if renewed:
+            self._lease_expires = expires
+        return bool(renewed)
@@ -0,0 +1,224 @@
+"""
+Order placement.
+
+Stock is taken with a conditional UPDATE (stock = stock - q WHERE stock >= q)
+instead of read-modify-write in Python, so concurrent checkouts in different
+workers can never oversell a product. Units held by other shoppers'
+reservations are not available to take. The stock update, the order, its
+items, the cart clear and the release of the shopper's own holds all commit
+in one transaction, or none of them do.
+"""
+import json
+from datetime import datetime
+
+# Lines copied into Order.item_preview for the order list pages
+PREVIEW_ITEMS = 2
+
+
+class InsufficientStock(Exception):
+    """Raised when at least one cart line can no longer be filled."""
+
+    def __init__(self, products):
+        self.products = products
+        super().__init__(", ".join(products))
+
+
+def order_loaders(profile):
+    """
+    Loader options for the order pages, by profile name.
+
+    "list" joins each order's customer; the item columns come from the
+    denormalized summary. "detail" also selects the items and their products
+    in one query each, so a page costs the same number of queries however
+    many orders or lines it shows.
+    """
+    from extensions import db
+    from models import Order, OrderItem
+
+    profiles = {
+        "list": [db.joinedload(Order.user)],
+        "detail": [
+            db.joinedload(Order.user),
+            db.selectinload(Order.item_list).joinedload(OrderItem.product),
+        ],
+    }
+    return profiles[profile]
+
+
+def decrement_stock(quantities, user_id):
+    """
+    Take quantities ({product_id: qty}) from stock with one conditional UPDATE.
+
+    Returns True if every product had enough active stock that is not held
+    for another shopper. On False some rows may already be decremented, so
+    the caller must roll back.
+    """
+    from extensions import db
+    from models import Product
+    from reservations import held_quantity
+
+    product_ids = sorted(quantities)
+    if len(product_ids) > 1 and db.engine.dialect.name == "postgresql":
+        # The UPDATE locks its rows in scan order; take them in id order first so two
+        # checkouts sharing products cannot each hold a row the other is waiting for
+        db.session.execute(db.select(Product.id).where(Product.id.in_(product_ids)).order_by(Product.id).with_for_update())
+    wanted = db.case(quantities, value=Product.id)
+    held_by_others = held_quantity(Product.id, datetime.utcnow(), exclude_user_id=user_id)
+    result = db.session.execute(
+        db.update(Product)
+        .where(Product.id.in_(product_ids), Product.is_active.is_(True), Product.stock - held_by_others >= wanted)
+        .values(stock=Product.stock - wanted)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount == len(product_ids)
+
+
+def short_products(quantities, user_id):
+    """Names of products that cannot currently cover the requested quantities."""
+    from extensions import db
+    from models import Product
+    from reservations import available_stock
+
+    available = available_stock(quantities, exclude_user_id=user_id)
+    rows = db.session.execute(
+        db.select(Product.id, Product.name, Product.is_active).where(Product.id.in_(quantities))
+    ).all()
+    return [row.name for row in rows if not row.is_active or available[row.id] < quantities[row.id]]
+
+
+def order_summary(lines):
+    """
+    Denormalized item_count, total_quantity and item_preview for an order.
+
+    lines are (name, image_url, quantity, price) tuples in display order.
+    """
+    return {
+        "item_count": len(lines),
+        "total_quantity": sum(quantity for _, _, quantity, _ in lines),
+        "item_preview": json.dumps([
+            {"name": name, "image_url": image_url, "quantity": quantity, "line_total": float(price * quantity)}
+            for name, image_url, quantity, price in lines[:PREVIEW_ITEMS]
+        ]),
+    }
+
+
+def place_order(user_id, cart, checkout_info, shipping_cost, checkout_request_id=None, mpesa_amount=None):
+    """
+    Turn a loaded cart into an order in one transaction.
+
+    Everything that only reads (order number, recorded callback, item rows
+    priced from the cart's joined product load) is prepared first, so the
+    write transaction is just the stock UPDATE, one order INSERT, one
+    executemany INSERT for the items and two DELETEs. That keeps SQLite's
+    database-wide write lock held as briefly as possible.
+
+    mpesa_amount is the amount of the STK Push the order is linked to; a
+    callback only marks the order paid when it covers total_amount.
+
+    Raises InsufficientStock (after rolling back) if any line is short.
+    """
+    from extensions import db, order_numbers
+    from models import CartItem, Order, OrderItem
+    from callbacks import apply_recorded_callback
+    from reservations import release_reservations
+
+    quantities = {}
+    for item in cart:
+        quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+
+    # Leasing a node id uses its own connection, which SQLite would block
+    # behind this transaction's write lock, so number the order first
+    order = Order(
+        user_id=user_id,
+        order_number=order_numbers.generate(),
+        total_amount=float(cart.total) + shipping_cost,
+        shipping_address=checkout_info["shipping_address"],
+        delivery_option=checkout_info["delivery_option"],
+        status="pending",
+        checkout_request_id=checkout_request_id,
+        mpesa_amount=mpesa_amount,
+        **order_summary([
+            (item.product.name, item.product.image_url, item.quantity, item.product.price) for item in cart
+        ]),
+    )
+    apply_recorded_callback(order)
+    now = datetime.utcnow()
+    item_rows = [
+        {"product_id": item.product_id, "quantity": item.quantity, "price": item.product.price, "created_at": now}
+        for item in cart
+    ]
+
+    if not decrement_stock(quantities, user_id):
+        db.session.rollback()
+        raise InsufficientStock(short_products(quantities, user_id))
+
+    db.session.add(order)
+    db.session.flush()
+    for row in item_rows:
+        row["order_id"] = order.id
+    db.session.execute(db.insert(OrderItem), item_rows)
+    db.session.execute(
+        db.delete(CartItem).where(CartItem.user_id == user_id).execution_options(synchronize_session=False)
+    )
+    release_reservations(user_id)
+    db.session.commit()
+    return order
+
+
+def backfill_order_summaries(batch_size=500, recompute=False):
+    """
+    Fill item_count, total_quantity and item_preview for existing orders.
+
+    Orders are walked by id in batches; each batch reads its items with one
+    joined query and is written back with one executemany UPDATE. Only orders
+    without a summary are touched unless recompute is set. Returns the number
+    of orders updated.
+    """
+    from extensions import db
+    from models import Order, OrderItem, Product
+
+    update_order = (
+        db.update(Order)
+        .where(Order.id == db.bindparam("b_id"))
+        .values(
+            item_count=db.bindparam("b_item_count"),
+            total_quantity=db.bindparam("b_total_quantity"),
+            item_preview=db.bindparam("b_item_preview"),
+        )
+    )
+
+    updated = 0
+    last_id = 0
+    while True:
+        query = db.select(Order.id).where(Order.id > last_id).order_by(Order.id).limit(batch_size)
+        if not recompute:
+            query = query.where(Order.item_count.is_(None))
+        order_ids = db.session.execute(query).scalars().all()
+        if not order_ids:
+            break
+        last_id = order_ids[-1]
+
+        lines = {order_id: [] for order_id in order_ids}
+        for row in db.session.execute(
+            db.select(OrderItem.order_id, Product.name, Product.image_url, OrderItem.quantity, OrderItem.price)
+            .join(Product, OrderItem.product_id == Product.id)
+            .where(OrderItem.order_id.in_(order_ids))
+            .order_by(OrderItem.order_id, OrderItem.id)
+        ):
+            lines[row.order_id].append((row.name, row.image_url, row.quantity, row.price))
+
+        rows = []
+        for order_id, order_lines in lines.items():
+            summary = order_summary(order_lines)
+            rows.append({
+                "b_id": order_id,
+                "b_item_count": summary["item_count"],
+                "b_total_quantity": summary["total_quantity"],
+                "b_item_preview": summary["item_preview"],
+            })
+        db.session.connection().execute(update_order, rows)
+        db.session.commit()
+        updated += len(rows)
+        if len(order_ids) < batch_size:
+            break
+    return updated
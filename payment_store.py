@@ -0,0 +1,260 @@
+"""
+Shared payment status store for M-Pesa STK Push requests.
+
+The STK Push, the Safaricom callback and the status polls can each land on a
+different gunicorn worker (or node), so statuses must live outside the
+worker process. Backends are selected with the PAYMENT_STORE config key.
+
+Each entry holds a status, an optional reference to another entry and an
+optional message for the shopper. Queued STK Push jobs use the reference to
+point at the CheckoutRequestID that Safaricom assigns once the push has been
+sent, and the message to say why a push failed. A job entry also records the
+shopper who requested the push and its amount, so an order is only linked to
+a push its own shopper made for enough money; later updates keep them.
+"""
+import threading
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+
+class MemoryPaymentBackend:
+    """Process-local backend. Only correct with a single worker process."""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            status, reference, message, owner, amount, expires_at = entry
+            if expires_at < time.time():
+                del self._data[key]
+                return None
+            return status, reference, message, owner, amount
+
+    def set(self, key, status, ttl, reference=None, message=None, owner=None, amount=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if owner is None and entry is not None:
+                owner, amount = entry[3], entry[4]
+            self._data[key] = (status, reference, message, owner, amount, time.time() + ttl)
+
+    def purge_expired(self):
+        now = time.time()
+        with self._lock:
+            expired = [key for key, entry in self._data.items() if entry[5] < now]
+            for key in expired:
+                del self._data[key]
+        return len(expired)
+
+
+class DatabasePaymentBackend:
+    """Stores statuses in the payment_status table of the application database."""
+
+    def get(self, key):
+        from extensions import db
+        from models import PaymentStatus
+
+        with db.engine.connect() as conn:
+            row = conn.execute(
+                db.select(PaymentStatus.status, PaymentStatus.reference, PaymentStatus.message,
+                          PaymentStatus.user_id, PaymentStatus.amount, PaymentStatus.expires_at)
+                .where(PaymentStatus.checkout_request_id == key)
+            ).first()
+        if row is None or row.expires_at < datetime.utcnow():
+            return None
+        return row.status, row.reference, row.message, row.user_id, row.amount
+
+    def set(self, key, status, ttl, reference=None, message=None, owner=None, amount=None):
+        from extensions import db
+        from models import PaymentStatus
+
+        now = datetime.utcnow()
+        values = {
+            "checkout_request_id": key,
+            "status": status,
+            "reference": reference,
+            "message": message,
+            "user_id": owner,
+            "amount": amount,
+            "expires_at": now + timedelta(seconds=ttl),
+            "updated_at": now,
+        }
+        with db.engine.begin() as conn:
+            dialect = conn.dialect.name
+            if dialect in ("sqlite", "postgresql"):
+                if dialect == "sqlite":
+                    from sqlalchemy.dialects.sqlite import insert
+                else:
+                    from sqlalchemy.dialects.postgresql import insert
+                stmt = insert(PaymentStatus).values(**values)
+                set_ = {k: stmt.excluded[k] for k in ("status", "reference", "message", "expires_at", "updated_at")}
+                if owner is not None:
+                    set_.update(user_id=owner, amount=amount)
+                stmt = stmt.on_conflict_do_update(index_elements=[PaymentStatus.checkout_request_id], set_=set_)
+                conn.execute(stmt)
+            else:
+                updated = conn.execute(
+                    db.update(PaymentStatus)
+                    .where(PaymentStatus.checkout_request_id == key)
+                    .values(
+                        status=status, reference=reference, message=message,
+                        expires_at=values["expires_at"], updated_at=now,
+                        **({"user_id": owner, "amount": amount} if owner is not None else {}),
+                    )
+                ).rowcount
+                if not updated:
+                    conn.execute(db.insert(PaymentStatus).values(**values))
+
+    def purge_expired(self):
+        from extensions import db
+        from models import PaymentStatus
+
+        with db.engine.begin() as conn:
+            return conn.execute(
+                db.delete(PaymentStatus).where(PaymentStatus.expires_at < datetime.utcnow())
+            ).rowcount
+
+
+class RedisPaymentBackend:
+    """Redis (or any Redis-compatible server); one hash per entry, expiry is handled by the server."""
+
+    prefix = "shifaa:stk:"
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("PAYMENT_STORE=redis requires the 'redis' package") from None
+        self._client = redis.Redis.from_url(url, decode_responses=True)
+
+    def get(self, key):
+        entry = self._client.hgetall(self.prefix + key)
+        if not entry:
+            return None
+        owner, amount = entry.get("user_id"), entry.get("amount")
+        return (
+            entry["status"], entry.get("reference") or None, entry.get("message") or None,
+            int(owner) if owner else None, Decimal(amount) if amount else None,
+        )
+
+    def set(self, key, status, ttl, reference=None, message=None, owner=None, amount=None):
+        fields = {"status": status, "reference": reference or "", "message": message or ""}
+        if owner is not None:
+            fields.update(user_id=owner, amount=str(amount))
+        with self._client.pipeline() as pipe:
+            pipe.hset(self.prefix + key, mapping=fields)
+            pipe.expire(self.prefix + key, ttl)
+            pipe.execute()
+
+    def purge_expired(self):
+        return 0
+
+
+class PaymentStore:
+    """Looks up and records STK Push statuses keyed by CheckoutRequestID or job id."""
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.ttl = 3600
+        self.purge_interval = 300
+        self.wait_interval = 0.5
+        self._last_purge = 0.0
+        self._changed = threading.Condition()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("PAYMENT_STORE", "database")
+        app.config.setdefault("PAYMENT_STORE_URL", "redis://localhost:6379/0")
+        app.config.setdefault("PAYMENT_STATUS_TTL", 3600)
+        app.config.setdefault("PAYMENT_STORE_PURGE_INTERVAL", 300)
+        app.config.setdefault("PAYMENT_WAIT_INTERVAL", 0.5)
+
+        kind = app.config["PAYMENT_STORE"]
+        if kind == "database":
+            self.backend = DatabasePaymentBackend()
+        elif kind == "redis":
+            self.backend = RedisPaymentBackend(app.config["PAYMENT_STORE_URL"])
+        elif kind == "memory":
+            self.backend = MemoryPaymentBackend()
+        else:
+            raise ValueError(f"Unknown PAYMENT_STORE backend: {kind}")
+
+        self.ttl = int(app.config["PAYMENT_STATUS_TTL"])
+        self.purge_interval = int(app.config["PAYMENT_STORE_PURGE_INTERVAL"])
+        self.wait_interval = float(app.config["PAYMENT_WAIT_INTERVAL"])
+        app.extensions["payment_store"] = self
+
+    def get(self, key, default="pending"):
+        entry = self.backend.get(key)
+        if entry is None:
+            return default
+        status, reference = entry[0], entry[1]
+        if reference:
+            # Follow a queued job to the CheckoutRequestID the callback reports on
+            referenced = self.backend.get(reference)
+            if referenced is not None:
+                return referenced[0]
+        return status
+
+    def message(self, key):
+        """The shopper-facing reason a payment failed, if one was recorded."""
+        entry = self.backend.get(key)
+        if entry is None:
+            return None
+        reference, message = entry[1], entry[2]
+        if reference:
+            referenced = self.backend.get(reference)
+            if referenced is not None and referenced[2]:
+                return referenced[2]
+        return message
+
+    def resolve(self, key):
+        """Return the CheckoutRequestID behind a job id (or key itself if there is none)."""
+        entry = self.backend.get(key)
+        if entry is not None and entry[1]:
+            return entry[1]
+        return key
+
+    def requested(self, key):
+        """(user id, amount) of the STK Push job key, or None if it is unknown or has expired."""
+        entry = self.backend.get(key)
+        if entry is None or entry[3] is None:
+            return None
+        return entry[3], entry[4]
+
+    def set(self, key, status, reference=None, message=None, owner=None, amount=None):
+        """Record a status; owner and amount are written when given and kept otherwise."""
+        self.backend.set(key, status, self.ttl, reference=reference, message=message, owner=owner, amount=amount)
+        with self._changed:
+            self._changed.notify_all()
+        # Expired rows are cleared opportunistically instead of by a separate job
+        if time.monotonic() - self._last_purge > self.purge_interval:
+            self._last_purge = time.monotonic()
+            self.backend.purge_expired()
+
+    def wait(self, key, timeout):
+        """
+        Block until the status of key is no longer "pending" or timeout passes.
+
+        Writes from this process wake waiters immediately; writes from other
+        workers are seen by re-reading the backend every PAYMENT_WAIT_INTERVAL.
+        """
+        deadline = time.monotonic() + timeout
+        status = self.get(key)
+        while status == "pending":
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            with self._changed:
+                self._changed.wait(min(self.wait_interval, remaining))
+            status = self.get(key)
+        return status
+
+    def purge_expired(self):
+        return self.backend.purge_expired()
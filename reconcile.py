@@ -0,0 +1,159 @@
+"""
+Reconciliation of orders whose M-Pesa callback never arrived.
+
+Pending orders older than a cutoff are read in keyset-paginated batches, each
+CheckoutRequestID (resolved from its STK Push job id where the order was
+confirmed before the push was sent) is checked with the STK Push Query API on a bounded,
+rate-limited thread pool, and the settled results are written back in bulk.
+The query does not report an amount, so a successful payment is checked
+against the push amount recorded on the order when it was linked.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+
+class RateLimiter:
+    """Token bucket shared by the query threads."""
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self._tokens = self.rate
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def query_payment(checkout_request_id, limiter):
+    """
+    Return (result_code, result_desc) for a CheckoutRequestID.
+
+    result_code is None while Safaricom is still processing the payment or
+    the query itself failed; such orders stay pending for the next run.
+    """
+    from extensions import daraja, mpesa_tokens
+
+    limiter.acquire()
+    try:
+        data = daraja.stk_query(mpesa_tokens.get_token(), checkout_request_id).json()
+    except Exception as e:
+        print(f"STK query failed for {checkout_request_id}: {e}")
+        return None, None
+    if data.get("ResultCode") is None:
+        return None, data.get("errorMessage")
+    return int(data["ResultCode"]), data.get("ResultDesc")
+
+
+def checkout_request_for(checkout_id):
+    """
+    The CheckoutRequestID to query for an order's stored id.
+
+    Orders confirmed while their STK Push job was queued may still hold the
+    job id; it is resolved (and the order relinked) here. Returns None when
+    the job failed before reaching Safaricom, and the job id while it is
+    still queued.
+    """
+    from callbacks import link_checkout_request
+    from extensions import payment_store
+    from mpesa import JOB_ID_PREFIX
+
+    if not checkout_id.startswith(JOB_ID_PREFIX):
+        return checkout_id
+    resolved = payment_store.resolve(checkout_id)
+    if resolved != checkout_id:
+        link_checkout_request(checkout_id, resolved)
+        return resolved
+    if payment_store.get(checkout_id, default="failed") == "failed":
+        return None
+    return checkout_id
+
+
+def check(checkout_id, limiter):
+    """(result_code, result_desc) for what checkout_request_for() returned."""
+    from mpesa import JOB_ID_PREFIX
+
+    if checkout_id is None:
+        return 1, "STK Push was never sent"
+    if checkout_id.startswith(JOB_ID_PREFIX):
+        return None, "STK Push is still queued"
+    return query_payment(checkout_id, limiter)
+
+
+def reconcile_pending_payments(older_than=10, batch_size=100, workers=4, rate=5.0):
+    """
+    Settle pending orders created more than older_than minutes ago.
+
+    Returns counts of the orders checked, marked paid, underpaid or failed and
+    left pending. Orders linked before push amounts were recorded are left
+    pending when their payment succeeded and counted as unverified.
+    """
+    from extensions import db, payment_store
+    from models import Order
+    from callbacks import order_payment_status
+
+    cutoff = datetime.utcnow() - timedelta(minutes=older_than)
+    limiter = RateLimiter(rate)
+    stats = {"checked": 0, "paid": 0, "underpaid": 0, "failed": 0, "unresolved": 0, "unverified": 0}
+    update_order = (
+        db.update(Order)
+        .where(Order.id == db.bindparam("b_id"), Order.payment_status == "pending")
+        .values(payment_status=db.bindparam("b_status"), updated_at=datetime.utcnow())
+    )
+
+    last_id = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="reconcile") as pool:
+        while True:
+            # Keyset pagination keeps every page an index range scan, however far in we are
+            rows = db.session.execute(
+                db.select(Order.id, Order.checkout_request_id, Order.total_amount, Order.mpesa_amount)
+                .where(
+                    Order.payment_status == "pending",
+                    Order.checkout_request_id.isnot(None),
+                    Order.created_at < cutoff,
+                    Order.id > last_id,
+                )
+                .order_by(Order.id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+
+            checkout_ids = [checkout_request_for(row.checkout_request_id) for row in rows]
+            results = list(pool.map(lambda checkout_id: check(checkout_id, limiter), checkout_ids))
+
+            updates = []
+            for row, checkout_id, (result_code, result_desc) in zip(rows, checkout_ids, results):
+                stats["checked"] += 1
+                if result_code is None:
+                    stats["unresolved"] += 1
+                    continue
+                if result_code == 0 and row.mpesa_amount is None:
+                    stats["unverified"] += 1
+                    continue
+                status = order_payment_status(result_code, row.mpesa_amount, row.total_amount)
+                stats[status] += 1
+                updates.append({"b_id": row.id, "b_status": status})
+                payment_store.set(checkout_id or row.checkout_request_id, "completed" if status == "paid" else "failed")
+
+            if updates:
+                db.session.connection().execute(update_order, updates)
+                db.session.commit()
+
+            if len(rows) < batch_size:
+                break
+    return stats
@@ -0,0 +1,108 @@
+"""
+Read-replica routing.
+
+Views decorated with @use_replica send their SELECTs to the "replica" bind
+(DATABASE_REPLICA_URL); everything else, and every flush or UPDATE/INSERT/
+DELETE, stays on the primary. Replicas lag, so reads go back to the primary:
+
+- for the rest of a request once its session has written anything,
+- inside a use_primary() block (e.g. the cart badge, which must reflect
+  the shopper's last change),
+- for REPLICA_STICKY_SECONDS after a request by the same browser wrote,
+  so a redirect after a POST shows what was just saved.
+
+Without a replica configured the decorator does nothing. For local testing a
+second SQLite file can act as the replica, refreshed from the primary with
+sync_sqlite_replica() (the sync-replica command).
+"""
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import g, has_app_context, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy.sql import Select
+
+REPLICA_BIND = "replica"
+STICKY_KEY = "_db_primary_until"
+
+
+class RoutingSession(Session):
+    """Session that reads from the replica bind while a @use_replica view runs."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            if isinstance(clause, Select) and clause._for_update_arg is None and not self._flushing:
+                if self._reads_from_replica():
+                    return self._db.engines[REPLICA_BIND]
+            else:
+                # Flushes, DML, locking reads, text() and bare connection() calls may all write
+                self.info["wrote"] = True
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def _reads_from_replica(self):
+        return (
+            has_app_context()
+            and g.get("db_replica", False)
+            and not self.info.get("wrote")
+            and REPLICA_BIND in self._db.engines
+        )
+
+
+def use_replica(view):
+    """Serve GET/HEAD requests of the view from the read replica."""
+
+    @wraps(view)
+    def decorated(*args, **kwargs):
+        if request.method in ("GET", "HEAD") and session.get(STICKY_KEY, 0) < time.time():
+            # Kept for the whole request, so streamed responses read from the replica too
+            g.db_replica = True
+        return view(*args, **kwargs)
+
+    return decorated
+
+
+@contextmanager
+def use_primary():
+    """Read from the primary inside the block, even in a @use_replica view."""
+    routed = g.get("db_replica", False)
+    g.db_replica = False
+    try:
+        yield
+    finally:
+        g.db_replica = routed
+
+
+class ReplicaRouter:
+    """Keeps a browser on the primary for a short while after it wrote."""
+
+    def __init__(self, app=None):
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("REPLICA_STICKY_SECONDS", 10)
+        self.app = app
+        app.after_request(self._stick_after_write)
+        app.extensions["replica_router"] = self
+
+    def _stick_after_write(self, response):
+        from extensions import db
+
+        if has_request_context() and db.session().info.get("wrote") and REPLICA_BIND in db.engines:
+            session[STICKY_KEY] = time.time() + self.app.config["REPLICA_STICKY_SECONDS"]
+        return response
+
+
+def sync_sqlite_replica(primary_path, replica_path):
+    """Copy the primary SQLite file into the replica file with the online backup API."""
+    import sqlite3
+
+    source = sqlite3.connect(primary_path)
+    target = sqlite3.connect(replica_path)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
@@ -0,0 +1,165 @@
+"""
+Inventory holds between checkout and payment.
+
+Submitting the checkout form reserves the cart's units for RESERVATION_TTL
+seconds. Other shoppers see stock minus every active hold, and placing the
+order turns the holds into a real stock decrement. Holds that expire simply
+stop counting; a background sweeper deletes them so the table stays small.
+"""
+import os
+import threading
+from datetime import datetime, timedelta
+
+
+def held_quantity(product_id, now, exclude_user_id=None):
+    """Correlated subquery: units of product_id held by active reservations."""
+    from extensions import db
+    from models import StockReservation
+
+    query = db.select(db.func.coalesce(db.func.sum(StockReservation.quantity), 0)).where(
+        StockReservation.product_id == product_id,
+        StockReservation.expires_at > now,
+    )
+    if exclude_user_id is not None:
+        query = query.where(StockReservation.user_id != exclude_user_id)
+    return query.scalar_subquery()
+
+
+def available_stock(product_ids, exclude_user_id=None):
+    """{product_id: stock minus active holds}, ignoring the holds of exclude_user_id."""
+    from extensions import db
+    from models import Product
+
+    now = datetime.utcnow()
+    rows = db.session.execute(
+        db.select(Product.id, Product.stock - held_quantity(Product.id, now, exclude_user_id))
+        .where(Product.id.in_(product_ids))
+    ).all()
+    return {product_id: available for product_id, available in rows}
+
+
+def reserve_cart(user_id, cart, ttl):
+    """
+    Replace the user's holds with holds for everything in cart.
+
+    Product rows are locked (SELECT ... FOR UPDATE on PostgreSQL; SQLite has
+    already serialized writers) so two shoppers cannot both claim the last
+    units. Returns a list of messages for lines that cannot be held; nothing
+    is reserved in that case.
+    """
+    from extensions import db
+    from models import Product, StockReservation
+
+    quantities = {}
+    for item in cart:
+        quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+    now = datetime.utcnow()
+
+    db.session.execute(db.delete(StockReservation).where(StockReservation.user_id == user_id))
+    products = db.session.execute(
+        db.select(Product.id, Product.name, Product.stock, Product.is_active)
+        .where(Product.id.in_(quantities))
+        .order_by(Product.id)
+        .with_for_update()
+    ).all()
+    held = dict(db.session.execute(
+        db.select(StockReservation.product_id, db.func.sum(StockReservation.quantity))
+        .where(StockReservation.product_id.in_(quantities), StockReservation.expires_at > now)
+        .group_by(StockReservation.product_id)
+    ).all())
+
+    issues = []
+    for product in products:
+        available = product.stock - held.get(product.id, 0)
+        wanted = quantities[product.id]
+        if not product.is_active:
+            issues.append(f"{product.name} is no longer available")
+        elif wanted > available:
+            if available <= 0:
+                issues.append(f"{product.name} is out of stock")
+            else:
+                issues.append(f"Only {available} {product.name} available (you have {wanted} in cart)")
+    if issues:
+        db.session.rollback()
+        return issues
+
+    expires_at = now + timedelta(seconds=ttl)
+    db.session.execute(db.insert(StockReservation).values([
+        {"user_id": user_id, "product_id": product_id, "quantity": quantity,
+         "expires_at": expires_at, "created_at": now}
+        for product_id, quantity in quantities.items()
+    ]))
+    db.session.commit()
+    return []
+
+
+def release_reservations(user_id):
+    """Drop a user's holds as part of the caller's transaction."""
+    from extensions import db
+    from models import StockReservation
+
+    db.session.execute(db.delete(StockReservation).where(StockReservation.user_id == user_id))
+
+
+class ReservationSweeper:
+    """Background thread that deletes expired holds in batches."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.ttl = 900
+        self.interval = 60
+        self.batch_size = 500
+        self._thread = None
+        self._thread_pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("RESERVATION_TTL", 900)
+        app.config.setdefault("RESERVATION_SWEEP_INTERVAL", 60)
+        app.config.setdefault("RESERVATION_SWEEP_BATCH_SIZE", 500)
+        self.app = app
+        self.ttl = int(app.config["RESERVATION_TTL"])
+        self.interval = float(app.config["RESERVATION_SWEEP_INTERVAL"])
+        self.batch_size = int(app.config["RESERVATION_SWEEP_BATCH_SIZE"])
+        app.extensions["reservation_sweeper"] = self
+
+    def start(self):
+        """Start this worker's sweeper thread if it is not running yet."""
+        if self._thread is not None and self._thread_pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or self._thread_pid != os.getpid() or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="reservation-sweeper", daemon=True)
+                self._thread_pid = os.getpid()
+                self._thread.start()
+
+    def _run(self):
+        stop = threading.Event()
+        while not stop.wait(self.interval):
+            try:
+                with self.app.app_context():
+                    self.sweep()
+            except Exception as e:
+                print(f"Reservation sweep failed: {e}")
+
+    def sweep(self):
+        """Delete every expired hold. Returns the number of rows removed."""
+        from extensions import db
+        from models import StockReservation
+
+        removed = 0
+        while True:
+            with db.engine.begin() as conn:
+                expired = (
+                    db.select(StockReservation.id)
+                    .where(StockReservation.expires_at <= datetime.utcnow())
+                    .limit(self.batch_size)
+                )
+                count = conn.execute(
+                    db.delete(StockReservation).where(StockReservation.id.in_(expired))
+                ).rowcount
+            removed += count
+            if count < self.batch_size:
+                return removed
@@ -0,0 +1,202 @@
+"""
+Daily sales rollup.
+
+sales_daily keeps one row per UTC day and order status with the number of
+orders, their revenue and units sold. Session events maintain it inside the
+transaction that writes the orders: inserting an Order, changing its status
+or deleting it (one by one or with a bulk DELETE) applies +/- deltas through
+an upsert. Reports sum a few hundred rollup rows instead of scanning every
+order. Bulk UPDATEs of order.status are not tracked; rebuild() recomputes the
+table from the order table when needed.
+"""
+from datetime import datetime
+from decimal import Decimal
+
+from sqlalchemy import event, inspect
+
+
+class SalesRollup:
+    """Reads and rebuilds sales_daily; registers the session events that maintain it."""
+
+    def __init__(self, app=None):
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        from extensions import db
+
+        self.app = app
+        if not event.contains(db.session, "after_flush", _after_flush):
+            event.listen(db.session, "before_flush", _before_flush)
+            event.listen(db.session, "after_flush", _after_flush)
+            event.listen(db.session, "do_orm_execute", _on_orm_execute)
+            event.listen(db.session, "after_rollback", _after_rollback)
+        app.extensions["sales_rollup"] = self
+
+    def totals(self, date_from=None, date_to=None, status=None):
+        """Order count, revenue and items between two dates (inclusive), optionally for one status."""
+        from extensions import db
+        from models import SalesDaily
+
+        query = db.select(
+            db.func.coalesce(db.func.sum(SalesDaily.order_count), 0),
+            db.func.coalesce(db.func.sum(SalesDaily.revenue), 0),
+            db.func.coalesce(db.func.sum(SalesDaily.items), 0),
+        )
+        if date_from is not None:
+            query = query.where(SalesDaily.day >= date_from)
+        if date_to is not None:
+            query = query.where(SalesDaily.day <= date_to)
+        if status is not None:
+            query = query.where(SalesDaily.status == status)
+        order_count, revenue, items = db.session.execute(query).one()
+        return {"order_count": int(order_count), "revenue": float(revenue), "items": int(items)}
+
+    def rebuild(self):
+        """Recompute sales_daily from the order table. Returns the number of rollup rows."""
+        from extensions import db
+        from models import SalesDaily
+
+        if db.engine.dialect.name == "postgresql":
+            # Orders placed meanwhile wait for us instead of updating rows we are replacing
+            db.session.execute(db.text("LOCK TABLE sales_daily IN EXCLUSIVE MODE"))
+        db.session.execute(db.delete(SalesDaily))
+        db.session.execute(
+            db.insert(SalesDaily).from_select(["day", "status", "order_count", "revenue", "items"], _order_totals())
+        )
+        db.session.commit()
+        return db.session.execute(db.select(db.func.count(SalesDaily.id))).scalar()
+
+
+def _order_totals():
+    """(day, status, order_count, revenue, items) per day and status, straight from the order table."""
+    from extensions import db
+    from models import Order, OrderItem
+
+    item_totals = (
+        db.select(OrderItem.order_id, db.func.sum(OrderItem.quantity).label("quantity"))
+        .group_by(OrderItem.order_id)
+        .subquery()
+    )
+    day = db.func.date(Order.created_at, type_=db.Date)
+    status = db.func.coalesce(Order.status, "pending")
+    return (
+        db.select(
+            day,
+            status,
+            db.func.count(Order.id),
+            db.func.coalesce(db.func.sum(Order.total_amount), 0),
+            db.func.coalesce(db.func.sum(db.func.coalesce(Order.total_quantity, item_totals.c.quantity, 0)), 0),
+        )
+        .select_from(Order)
+        .outerjoin(item_totals, item_totals.c.order_id == Order.id)
+        .group_by(day, status)
+    )
+
+
+def _add(deltas, day, status, count, revenue, items):
+    key = (day, status or "pending")
+    current = deltas.get(key, (0, Decimal(0), 0))
+    deltas[key] = (current[0] + count, current[1] + count * Decimal(str(revenue or 0)), current[2] + count * (items or 0))
+
+
+def _add_order(deltas, order, status, count):
+    created_at = order.created_at or datetime.utcnow()
+    _add(deltas, created_at.date(), status, count, order.total_amount, order.total_quantity)
+
+
+def _before_flush(session, flush_context, instances):
+    # Old values of updated or deleted orders, read while their rows still exist
+    from models import Order
+
+    deltas = session.info.setdefault("sales_deltas", {})
+    for obj in session.dirty:
+        if isinstance(obj, Order):
+            history = inspect(obj).attrs.status.history
+            if history.deleted and history.added:
+                _add_order(deltas, obj, history.deleted[0], -1)
+                _add_order(deltas, obj, history.added[0], 1)
+    for obj in session.deleted:
+        if isinstance(obj, Order):
+            history = inspect(obj).attrs.status.history
+            _add_order(deltas, obj, history.deleted[0] if history.deleted else obj.status, -1)
+
+
+def _after_flush(session, flush_context):
+    # New orders are counted after the INSERT has filled in created_at and status defaults
+    from models import Order
+
+    deltas = session.info.pop("sales_deltas", {})
+    for obj in session.new:
+        if isinstance(obj, Order):
+            _add_order(deltas, obj, obj.status, 1)
+    _apply(session.connection(), deltas)
+
+
+def _on_orm_execute(orm_execute_state):
+    # Bulk DELETEs skip the flush, so take their orders out before they go
+    if not orm_execute_state.is_delete:
+        return
+    statement = orm_execute_state.statement
+    if getattr(statement, "table", None) is None or statement.table.name != "order":
+        return
+    query = _order_totals()
+    if statement.whereclause is not None:
+        query = query.where(statement.whereclause)
+    deltas = {}
+    connection = orm_execute_state.session.connection()
+    for row_day, status, count, revenue, items in connection.execute(query):
+        key = (row_day, status)
+        current = deltas.get(key, (0, Decimal(0), 0))
+        deltas[key] = (current[0] - count, current[1] - Decimal(str(revenue)), current[2] - int(items))
+    _apply(connection, deltas)
+
+
+def _after_rollback(session):
+    session.info.pop("sales_deltas", None)
+
+
+def _apply(connection, deltas):
+    """Add each (day, status) delta to its sales_daily row, creating the row if needed."""
+    from extensions import db
+    from models import SalesDaily
+
+    rows = [
+        {"day": day, "status": status, "order_count": count, "revenue": revenue, "items": items}
+        for (day, status), (count, revenue, items) in sorted(deltas.items())
+        if count or revenue or items
+    ]
+    if not rows:
+        return
+
+    dialect = connection.dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert
+        stmt = insert(SalesDaily)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[SalesDaily.day, SalesDaily.status],
+            set_={
+                "order_count": SalesDaily.order_count + stmt.excluded["order_count"],
+                "revenue": SalesDaily.revenue + stmt.excluded["revenue"],
+                "items": SalesDaily.items + stmt.excluded["items"],
+            },
+        )
+        connection.execute(stmt, rows)
+        return
+
+    for row in rows:
+        updated = connection.execute(
+            db.update(SalesDaily)
+            .where(SalesDaily.day == row["day"], SalesDaily.status == row["status"])
+            .values(
+                order_count=SalesDaily.order_count + row["order_count"],
+                revenue=SalesDaily.revenue + row["revenue"],
+                items=SalesDaily.items + row["items"],
+            )
+        ).rowcount
+        if not updated:
+            connection.execute(db.insert(SalesDaily).values(**row))
@@ -0,0 +1,105 @@
+"""
+Schema creation and in-place upgrades.
+
+db.create_all() only creates missing tables, so columns and indexes added to
+existing models are applied here with ALTER TABLE ... ADD COLUMN. Indexes
+that became unique are rebuilt once the rows they cover have been made unique
+by the table's entry in DEDUPLICATE. Tables that summarise existing rows
+(sales_daily) are filled from them when created.
+"""
+from sqlalchemy import bindparam, delete, func, inspect, select, update
+from sqlalchemy.schema import DropIndex
+
+
+def _unlink_repeated_checkout_requests(conn, table):
+    """Leave each STK Push linked to the first order that claimed it; later ones go back to pending."""
+    first = (
+        select(func.min(table.c.id))
+        .where(table.c.checkout_request_id.isnot(None))
+        .group_by(table.c.checkout_request_id)
+    )
+    repeated = conn.execute(
+        select(table.c.id).where(table.c.checkout_request_id.isnot(None), table.c.id.notin_(first))
+    ).scalars().all()
+    if repeated:
+        conn.execute(
+            update(table)
+            .where(table.c.id.in_(repeated))
+            .values(checkout_request_id=None, mpesa_amount=None, mpesa_receipt=None, payment_status="pending")
+        )
+    return len(repeated)
+
+
+def _merge_repeated_cart_lines(conn, table):
+    """Fold repeated lines for a product in a cart into the first one, adding up their quantities."""
+    groups = conn.execute(
+        select(func.min(table.c.id).label("b_id"), func.sum(table.c.quantity).label("b_quantity"))
+        .group_by(table.c.user_id, table.c.product_id)
+        .having(func.count() > 1)
+    ).all()
+    if not groups:
+        return 0
+    conn.execute(
+        update(table).where(table.c.id == bindparam("b_id")).values(quantity=bindparam("b_quantity")),
+        [row._asdict() for row in groups],
+    )
+    first = select(func.min(table.c.id)).group_by(table.c.user_id, table.c.product_id)
+    repeated = conn.execute(select(table.c.id).where(table.c.id.notin_(first))).scalars().all()
+    conn.execute(delete(table).where(table.c.id.in_(repeated)))
+    return len(repeated)
+
+
+# Unique indexes added to existing tables, with what makes the rows unique first
+DEDUPLICATE = {
+    "ix_order_checkout_request_id": _unlink_repeated_checkout_requests,
+    "idx_cart_user_product": _merge_repeated_cart_lines,
+}
+
+
+def upgrade_schema():
+    """
+    Create missing tables, add missing columns and make indexes unique.
+
+    Returns a description of each change, e.g. "column order.mpesa_amount".
+    """
+    from extensions import db, sales_rollup
+    import models  # noqa: F401 - registers every table on db.metadata
+
+    # Session events only track orders written after the table exists, so a new
+    # rollup would report zero sales for every order placed before the upgrade
+    had_rollup = inspect(db.engine).has_table(models.SalesDaily.__tablename__)
+    db.create_all()
+
+    inspector = inspect(db.engine)
+    added = []
+    with db.engine.begin() as conn:
+        preparer = conn.dialect.identifier_preparer
+        for table in db.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            new_columns = [column for column in table.columns if column.name not in existing]
+            unique = {index["name"]: index["unique"] for index in inspector.get_indexes(table.name)}
+
+            for column in new_columns:
+                ddl = (
+                    f"ALTER TABLE {preparer.format_table(table)} "
+                    f"ADD COLUMN {preparer.format_column(column)} {column.type.compile(dialect=conn.dialect)}"
+                )
+                if column.server_default is not None:
+                    ddl += f" DEFAULT {column.server_default.arg}"
+                conn.exec_driver_sql(ddl)
+                added.append(f"column {table.name}.{column.name}")
+
+            new_names = {column.name for column in new_columns}
+            for index in table.indexes:
+                if new_names.intersection(column.name for column in index.columns):
+                    index.create(conn, checkfirst=True)
+                elif index.unique and not unique.get(index.name):
+                    fixed = DEDUPLICATE[index.name](conn, table) if index.name in DEDUPLICATE else 0
+                    if index.name in unique:
+                        conn.execute(DropIndex(index))
+                    index.create(conn)
+                    added.append(f"unique index {index.name} ({fixed} duplicate rows fixed)")
+
+    if not had_rollup:
+        sales_rollup.rebuild()
+    return added
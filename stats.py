@@ -0,0 +1,111 @@
+"""
+Admin dashboard counters.
+
+All counters come from one SELECT that reads each table once, using
+conditional aggregation (pending orders and revenue are summed in the same
+pass as the order count, low stock with the product count). The result is cached for
+DASHBOARD_STATS_TTL seconds and dropped as soon as a session commits a
+write to one of the counted tables, so an auto-refreshing dashboard does
+not recount the order table on every load.
+"""
+from sqlalchemy import event
+
+CACHE_KEY = "dashboard_stats"
+LOW_STOCK_THRESHOLD = 10
+# Tables whose writes change a counter
+WATCHED_TABLES = {"product", "order", "user", "practitioner"}
+
+
+class DashboardStats:
+    """Cached dashboard counters, invalidated by commits that touch them."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.ttl = 30
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        from extensions import db
+
+        app.config.setdefault("DASHBOARD_STATS_TTL", 30)
+        self.app = app
+        self.ttl = int(app.config["DASHBOARD_STATS_TTL"])
+        if not event.contains(db.session, "after_commit", _after_commit):
+            event.listen(db.session, "after_flush", _after_flush)
+            event.listen(db.session, "do_orm_execute", _on_orm_execute)
+            event.listen(db.session, "after_commit", _after_commit)
+            event.listen(db.session, "after_rollback", _after_rollback)
+        app.extensions["dashboard_stats"] = self
+
+    def get(self):
+        """{product_count, low_stock, order_count, pending_orders, total_revenue, user_count, practitioner_count}."""
+        from extensions import cache
+
+        stats = cache.get(CACHE_KEY)
+        if stats is None:
+            stats = self.compute()
+            cache.set(CACHE_KEY, stats, timeout=self.ttl)
+        return stats
+
+    def compute(self):
+        from extensions import db
+        from models import Order, Practitioner, Product, User
+
+        def count_if(condition):
+            return db.func.coalesce(db.func.sum(db.case((condition, 1), else_=0)), 0)
+
+        products = db.select(
+            db.func.count(Product.id).label("product_count"),
+            count_if((Product.stock > 0) & (Product.stock < LOW_STOCK_THRESHOLD)).label("low_stock"),
+        ).subquery()
+        orders = db.select(
+            db.func.count(Order.id).label("order_count"),
+            count_if(Order.status == "pending").label("pending_orders"),
+            db.func.coalesce(db.func.sum(Order.total_amount), 0).label("total_revenue"),
+        ).subquery()
+        row = db.session.execute(
+            db.select(
+                products.c.product_count,
+                products.c.low_stock,
+                orders.c.order_count,
+                orders.c.pending_orders,
+                orders.c.total_revenue,
+                db.select(db.func.count(User.id)).scalar_subquery().label("user_count"),
+                db.select(db.func.count(Practitioner.id)).scalar_subquery().label("practitioner_count"),
+            ).select_from(products).join(orders, db.true())
+        ).one()
+        stats = dict(row._mapping)
+        stats["total_revenue"] = float(stats["total_revenue"])
+        return stats
+
+    def invalidate(self):
+        from extensions import cache
+
+        cache.delete(CACHE_KEY)
+
+
+def _after_flush(session, flush_context):
+    changed = list(session.new) + list(session.dirty) + list(session.deleted)
+    if any(getattr(obj, "__tablename__", None) in WATCHED_TABLES for obj in changed):
+        session.info["dashboard_stale"] = True
+
+
+def _on_orm_execute(orm_execute_state):
+    # Bulk UPDATE/DELETE/INSERT statements skip the flush
+    if orm_execute_state.is_select:
+        return
+    table = getattr(orm_execute_state.statement, "table", None)
+    if table is not None and table.name in WATCHED_TABLES:
+        orm_execute_state.session.info["dashboard_stale"] = True
+
+
+def _after_commit(session):
+    if session.info.pop("dashboard_stale", False):
+        from extensions import dashboard_stats
+
+        dashboard_stats.invalidate()
+
+
+def _after_rollback(session):
+    session.info.pop("dashboard_stale", None)
@@ -1,36 +1,23 @@
 """
-WSGI entry point for Render deployment
+WSGI entry point for Render deployment.
+
+Importing this module only builds the app; it does not touch the database.
+Run `flask --app app:create_app init-db` once per deploy to create or upgrade
+the schema and the admin account.
 """
-import os
+from sqlalchemy.orm import configure_mappers
+
 from app import create_app
 
 # Create the Flask application instance
 app = create_app()
 
-# Initialize database on startup
-with app.app_context():
-    from extensions import db
-    from models import User, Product, Order, Appointment, Practitioner, CartItem, OrderItem
-    
-    # Create all tables
-    db.create_all()
-    
-    # Create admin user if it doesn't exist
-    admin_email = os.getenv("ADMIN_EMAIL", "admin@shifaa.local")
-    admin_password = os.getenv("ADMIN_PASSWORD", "admin123")
-    
-    if not User.query.filter_by(email=admin_email).first():
-        from werkzeug.security import generate_password_hash
-        admin = User(
-            name="Admin",
-            email=admin_email,
-            role="admin",
-            password_hash=generate_password_hash(admin_password),
-        )
-        db.session.add(admin)
-        db.session.commit()
-        print(f"✅ Created admin user: {admin_email}")
+# Resolve model relationships now: with preload_app the forked workers inherit
+# them instead of each paying for it on its first request
+configure_mappers()
 
 if __name__ == "__main__":
+    import os
+
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)